@@ -4,11 +4,20 @@ from . import views
 
 urlpatterns = [
     url(r'^$', views.index, name='index'),
+    url(r'^metrics$', views.metrics),
+    url(r'^healthz$', views.healthz),
+    url(r'^readyz$', views.readyz),
+    url(r'^profiles$', views.profiles),
+    url(r'^profiles/(?P<file_name>[^/]+)$', views.download_profile),
     url(r'^get_models$', views.get_models),
+    url(r'^models$', views.models),
+    url(r'^models/(?P<model_name>[^/]+)$', views.model_details),
     url(r'^add_model$', views.add_model),
     url(r'^predict_images$', views.predict_images),
+    url(r'^predict_ensemble$', views.predict_ensemble),
     url(r'^predict_random_frame$', views.predict_random_frame),
     url(r'^start_train$', views.start_train),
+    url(r'^cross_validate$', views.cross_validate),
     url(r'^full_plan$', views.full_plan),
     url(r'^good_plan$', views.good_plan),
     url(r'^random_plan$', views.random_plan),
@@ -1,33 +1,158 @@
 import os
 import json
+import time
+import hashlib
 
+from django.conf import settings
 from django.shortcuts import render
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
 from rest_framework.decorators import api_view
 from rest_framework import status
 from rest_framework.response import Response
 from django.http import HttpResponse
 from manage import ROOT_DIR
-from core.cnn import CNN
-from core.cnn_manager import CNNManager
-from utils.configurations import get_random_conf
+from core.cnn_manager import CNNManager, ModelLoading
+from core.prediction_cache import prediction_cache
+from utils.configurations import get_random_conf, iter_full_plan
+from utils import profiling
+from utils.metrics import registry, track_view
+from utils.profiling import profile_view
 
 from PIL import Image
 
-cnn_manager = CNNManager()
+if getattr(settings, 'PROFILING', None) is not None:
+    profiling.set_enabled(settings.PROFILING)
+prediction_cache.configure(getattr(settings, 'PREDICTION_CACHE_MB', 32) * 1024 * 1024,
+                           getattr(settings, 'PREDICTION_CACHE_PATH', None))
+# Keras / Theano are imported and the models compiled by the warm-up thread, not by importing the views
+cnn_manager = CNNManager(warmup=getattr(settings, 'BACKGROUND_WARMUP', True))
+started = time.time()
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+RETRY_AFTER = 5  # seconds a client waits before asking again for a loading model
+
+
+def _loading_response(e):
+    return Response({'status': 'loading', 'msg': e.message, 'warmup': cnn_manager.get_warmup_status()},
+                    status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={'Retry-After': str(RETRY_AFTER)})
 
 
 def index(request):
     return render(request, "index.html", {})
 
 
+def metrics(request):
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4')
+
+
+def healthz(request):
+    '''
+    Liveness, the process answers, also while the models are loading
+    '''
+    return HttpResponse(json.dumps({'status': 'alive', 'uptime': time.time() - started}),
+                        content_type='application/json')
+
+
+def readyz(request):
+    '''
+    Readiness, 200 once the warm-up loaded every model, 503 with the progress before that
+    '''
+    warmup = cnn_manager.get_warmup_status()
+    return HttpResponse(json.dumps({'status': 'ready' if warmup['ready'] else 'loading', 'warmup': warmup}),
+                        content_type='application/json',
+                        status=status.HTTP_200_OK if warmup['ready'] else status.HTTP_503_SERVICE_UNAVAILABLE)
+
+
+def profiles(request):
+    return HttpResponse(json.dumps(profiling.list_profiles(int(request.GET.get('limit', 50)))))
+
+
+def download_profile(request, file_name):
+    path = profiling.get_profile_path(file_name)
+    if path is None:
+        return HttpResponse(status=status.HTTP_404_NOT_FOUND)
+    if request.GET.get('format') == 'text':
+        try:
+            text = profiling.summary(path, request.GET.get('sort', 'cumulative'))
+        except Exception as e:
+            return HttpResponse(e.message, content_type='text/plain', status=status.HTTP_400_BAD_REQUEST)
+        return HttpResponse(text, content_type='text/plain')
+    with open(path, 'rb') as _input:
+        response = HttpResponse(_input.read(), content_type='application/octet-stream')
+    response['Content-Disposition'] = 'attachment; filename="%s"' % (os.path.basename(path),)
+    return response
+
+
+def _models_etag(request, *args, **kwargs):
+    return hashlib.sha1(cnn_manager.get_models_etag() + request.GET.urlencode()).hexdigest()
+
+
+def _model_etag(request, model_name):
+    return cnn_manager.get_model_etag(model_name)
+
+
+@track_view('get_models')
+@profile_view('get_models')
+@condition(etag_func=_models_etag)
 def get_models(request):
     return HttpResponse(json.dumps(cnn_manager.get_models()))
 
 
+def _summary_field(summary, field):
+    return summary[field] if field in summary else summary['params'].get(field)
+
+
+@track_view('models')
+@condition(etag_func=_models_etag)
+def models(request):
+    '''
+    Paginated and sorted summary of the models, ?sort=-best_score&page=1&page_size=50
+    '''
+    try:
+        page = max(1, int(request.GET.get('page', 1)))
+        page_size = min(MAX_PAGE_SIZE, max(1, int(request.GET.get('page_size', DEFAULT_PAGE_SIZE))))
+    except ValueError:
+        return HttpResponse(json.dumps({'msg': 'page and page_size must be numbers'}),
+                            status=status.HTTP_400_BAD_REQUEST)
+    sort = request.GET.get('sort', 'model_name')
+    field = sort.lstrip('-')
+    summaries = cnn_manager.get_summaries()
+    # models without a value for the field (e.g. not evaluated yet) go last
+    with_value = [m for m in summaries if _summary_field(m, field) is not None]
+    with_value.sort(key=lambda m: _summary_field(m, field), reverse=sort.startswith('-'))
+    without_value = sorted([m for m in summaries if _summary_field(m, field) is None], key=lambda m: m['model_name'])
+    summaries = with_value + without_value
+    start = (page - 1) * page_size
+    return HttpResponse(json.dumps({
+        'count': len(summaries),
+        'page': page,
+        'page_size': page_size,
+        'models': summaries[start:start + page_size]
+    }))
+
+
+@track_view('model_details')
+@condition(etag_func=_model_etag)
+def model_details(request, model_name):
+    cnn = cnn_manager.models.get(model_name)
+    if cnn is None and cnn_manager.is_loading(model_name):
+        response = HttpResponse(json.dumps({'status': 'loading', 'msg': ModelLoading(model_name).message}),
+                                status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        response['Retry-After'] = str(RETRY_AFTER)
+        return response
+    if cnn is None:
+        return HttpResponse(json.dumps({'msg': 'Model not found'}), status=status.HTTP_404_NOT_FOUND)
+    return HttpResponse(json.dumps(cnn.get_info()))
+
+
 @api_view(['GET', 'POST', ])
 @csrf_exempt
+@track_view('add_model')
 def add_model(request):
+    from core.cnn import CNN
+
     cnn = CNN(request.POST)
     success, msg = cnn_manager.add_model(cnn)
     if success:
@@ -38,14 +163,19 @@ def add_model(request):
 
 @api_view(['GET', 'POST', ])
 @csrf_exempt
+@track_view('predict_images')
+@profile_view('predict_images')
 def predict_images(request, *args, **kwargs):
     predictions = {}
     try:
         if request.method == 'POST':
             model_name = request.POST['model_name']
-            cnn = cnn_manager.models[model_name]
-            for image in request.FILES.keys():
-                predictions[image] = cnn.predict(request.FILES[image])
+            cnn = cnn_manager.get_model(model_name)
+            images = request.FILES.keys()
+            labels = cnn.predict_batch([request.FILES[image] for image in images], request.POST.get('source'))
+            predictions = dict(zip(images, labels))
+    except ModelLoading as e:
+        return _loading_response(e)
     except Exception as e:
         return Response({'msg': e.message}, status=status.HTTP_400_BAD_REQUEST)
 
@@ -54,6 +184,27 @@ def predict_images(request, *args, **kwargs):
 
 @api_view(['GET', 'POST', ])
 @csrf_exempt
+@track_view('predict_ensemble')
+@profile_view('predict_ensemble')
+def predict_ensemble(request, *args, **kwargs):
+    try:
+        model_names = request.POST.getlist('model_names')
+        if len(model_names) == 1:
+            model_names = model_names[0].split(',')
+        mode = request.POST.get('mode', 'average')
+        result = cnn_manager.predict_ensemble(model_names, request.FILES, mode, request.POST.get('source'))
+    except ModelLoading as e:
+        return _loading_response(e)
+    except Exception as e:
+        return Response({'msg': e.message}, status=status.HTTP_400_BAD_REQUEST)
+
+    return Response(result, status=status.HTTP_200_OK)
+
+
+@api_view(['GET', 'POST', ])
+@csrf_exempt
+@track_view('predict_random_frame')
+@profile_view('predict_random_frame')
 def predict_random_frame(request, *args, **kwargs):
     try:
         model_name = request.POST['model_name']
@@ -66,93 +217,103 @@ def predict_random_frame(request, *args, **kwargs):
             response = HttpResponse(content_type="image/png", status=status.HTTP_200_OK)
             red.save(response, "PNG")
             return response
+    except ModelLoading as e:
+        return _loading_response(e)
     except Exception as e:
         return Response({'msg': e.message}, status=status.HTTP_400_BAD_REQUEST)
 
 
 @api_view(['GET', 'POST', ])
 @csrf_exempt
+@track_view('start_train')
+@profile_view('start_train')
 def start_train(request):
     try:
         if request.method == 'POST':
             model_name = request.POST['model_name']
             epoch = int(request.POST['epoch'])
-            cnn = cnn_manager.models[model_name]
+            cnn = cnn_manager.get_model(model_name)
             cnn.train_model(epoch)
         return Response({'msg': 'ok'}, status=status.HTTP_200_OK)
+    except ModelLoading as e:
+        return _loading_response(e)
     except Exception as e:
         return Response({'msg': e.message}, status=status.HTTP_400_BAD_REQUEST)
 
 
+@api_view(['GET', 'POST', ])
+@csrf_exempt
+@track_view('cross_validate')
+@profile_view('cross_validate')
+def cross_validate(request):
+    from core.data_set_manager import DataSetManager
+
+    try:
+        params = request.POST.dict()
+        params.setdefault('model_name', 'cv')
+        k = int(params.pop('k', 5))
+        epoch = int(params.pop('epoch', 1))
+        n_jobs = int(params.pop('n_jobs', 1))
+        result = DataSetManager().cross_validate(params, k, epoch, n_jobs)
+    except Exception as e:
+        return Response({'msg': e.message}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(result, status=status.HTTP_200_OK)
+
+
 @api_view(['GET', 'POST', ])
 @csrf_exempt
 def full_plan(request):
+    from core.cnn import CNN, graph_cache
+
     try:
-        item = 1
-        for split_cases in ['True', 'False']:
-            for dropout in [0.25, 0.5]:
-                for activation_function in ['softmax', 'sigmoid']:
-                    for img_size in [(75, 75), (50, 50)]:
-                        for nb_filters in [32, 64]:
-                            for kernel_size in [5, 6, 7, 8, 9, 10]:
-                                for pool_size in [2, 4, 6, 8]:
-                                    for batch_size in [32, 64, 128]:
-                                        for sigma in [180, 90, 30]:
-                                            for theta in [45, 90, 135]:
-                                                for lammbd in [45, 90, 135]:
-                                                    for gamma in [0.3, 0.5, 0.7, 0.9]:
-                                                        for psi in [0.2, 0.5, 0.8]:
-                                                            try:
-                                                                item_path = os.path.join(ROOT_DIR,'cnn_models','item%s.json' % item)
-                                                                if os.path.exists(item_path):
-                                                                    item += 1
-                                                                    break
-                                                                params = {}
-                                                                params['model_name'] = "item%s" % item
-                                                                item += 1
-                                                                params['split_cases'] = split_cases
-                                                                params['img_rows'] = img_size[0]
-                                                                params['img_cols'] = img_size[1]
-                                                                params['batch_size'] = batch_size
-                                                                params['nb_filters'] = nb_filters
-                                                                params['dropout'] = dropout
-                                                                params['activation_function'] = activation_function
-                                                                params['pool_size'] = pool_size
-                                                                params['kernel_size'] = kernel_size
-                                                                params['sigma'] = sigma
-                                                                params['theta'] = theta
-                                                                params['lammbd'] = lammbd
-                                                                params['gamma'] = gamma
-                                                                params['psi'] = psi
-
-                                                                cnn = CNN(params)
-                                                                cnn.train_model(150)
-                                                            except Exception as e:
-                                                                print e
+        for params in iter_full_plan():
+            try:
+                item_path = os.path.join(ROOT_DIR, 'cnn_models', '%s.json' % (params['model_name'],))
+                if os.path.exists(item_path):
+                    continue
+                cnn = CNN(params)
+                cnn.train_model(150)
+                cnn.release_model()
+            except Exception as e:
+                print e
     except Exception as e:
         print e
         return Response({'msg': e.message}, status=status.HTTP_400_BAD_REQUEST)
     print 'finish all plan'
-    return Response({}, status=status.HTTP_200_OK)
+    return Response({'graph_cache': graph_cache.get_stats()}, status=status.HTTP_200_OK)
 
 
 @api_view(['GET', 'POST', ])
 @csrf_exempt
 def random_plan(request):
+    '''
+    Train configurations until stopped, proposed by the TPE sampler on the trained models,
+    ?sampler=random draws them uniformly (get_random_conf)
+    '''
+    from core.cnn import CNN, graph_cache
+    from utils.tpe import TPESampler, trial_score
+
+    sampler = TPESampler() if request.GET.get('sampler', 'tpe') == 'tpe' else None
     while True:
-        conf = get_random_conf()
+        conf = sampler.propose()[0] if sampler is not None else get_random_conf()
         cnn = CNN(conf)
         cnn.train_model(1)
         if 0 in cnn.con_mat_val[-1]:
-            continue
+            cnn.release_model()
+            print 'graph cache: %s' % (graph_cache.get_stats(),)
         else:
             print 'we find normal model'
             cnn.train_model(10)
+            cnn.release_model()
+        if sampler is not None:
+            sampler.observe(conf, trial_score(cnn.con_mat_train, cnn.con_mat_val))
 
 
 @api_view(['GET', 'POST', ])
 @csrf_exempt
 def good_plan(request):
+    from core.cnn import CNN
+
     try:
         # cnn = CNN({'model_name': 'good_plan_50', 'img_rows': 50, 'img_cols': 50})
         cnn = CNN({'model_name': 'good_plan_50'}, True)
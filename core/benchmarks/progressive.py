@@ -0,0 +1,81 @@
+'''
+Time to a target score of progressive resizing against fixed size training of the same configuration.
+
+    python -m core.benchmarks.progressive --params '{"img_rows": 100, "img_cols": 100}' \
+        --schedule 50x50:3 --epochs 5 --target 0.7 --output progressive.json
+
+Both models use the global pooling head and train the same number of epochs, the fixed one all of them at
+img_rows x img_cols, the progressive one the schedule stages first. They train on the real data sets
+(DataSetManager), the models are removed at the end.
+'''
+import os
+import sys
+import glob
+import json
+import argparse
+
+from core.cnn import CNN, EPOCH_TIMES, parse_schedule, weight_store
+
+BENCHMARK_MODEL_NAME = '_progressive_benchmark'
+
+
+def _train(params, n_epoch, target):
+    cnn = CNN(params)
+    try:
+        cnn.train_model(n_epoch)
+        seconds, epoch = cnn.time_to_score(target)
+        scores = cnn._get_avg_score_list()
+        return {
+            'time_to_score': seconds,
+            'epoch_to_score': epoch,
+            'best_score': max(scores) if scores else None,
+            'epochs': len(scores) - 1,
+            'train_time': sum(sum(stats.get(key) or 0 for key in EPOCH_TIMES) for stats in cnn.epoch_stats if stats)
+        }
+    finally:
+        cnn.release_model()
+        for path in glob.glob(cnn.model_path + '.*'):
+            os.remove(path)
+
+
+def run(params, schedule, n_epoch, target):
+    '''
+    {'fixed': result, 'progressive': result}, the progressive run trains n_epoch epochs after the schedule
+    '''
+    schedule = parse_schedule(schedule)
+    params = dict(params, global_pool=True)
+    total_epochs = n_epoch + sum(epochs for rows, cols, epochs in schedule)
+    results = {
+        'fixed': _train(dict(params, model_name=BENCHMARK_MODEL_NAME + '_fixed'), total_epochs, target),
+        'progressive': _train(dict(params, model_name=BENCHMARK_MODEL_NAME, resize_schedule=schedule),
+                              n_epoch, target)
+    }
+    weight_store.collect_garbage()
+    fixed, progressive = results['fixed']['time_to_score'], results['progressive']['time_to_score']
+    results['speedup'] = fixed / progressive if fixed and progressive else None
+    for name in ('fixed', 'progressive'):
+        result = results[name]
+        print '%-12s time to %.3f: %s (epoch %s)  best score %.4f  train time %.1fs' % (
+            name, target, '%.1fs' % result['time_to_score'] if result['time_to_score'] is not None else 'never',
+            result['epoch_to_score'], result['best_score'] or 0, result['train_time'])
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='progressive resizing against fixed size training')
+    parser.add_argument('--params', default='{}', help='json params of the configuration')
+    parser.add_argument('--schedule', required=True, help='stages before the final size, like 50x50:2,75x75:2')
+    parser.add_argument('--epochs', type=int, default=5, help='epochs at the final size')
+    parser.add_argument('--target', type=float, default=0.7, help='target avg score')
+    parser.add_argument('--output', help='write the results as json')
+    args = parser.parse_args(argv)
+
+    results = run(json.loads(args.params), args.schedule, args.epochs, args.target)
+    if args.output:
+        with open(args.output, 'wb') as output:
+            output.write(json.dumps(results, sort_keys=True, indent=4, separators=(',', ': ')))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,178 @@
+'''
+Micro benchmarks of the data, training and inference hot paths on a synthetic data set.
+
+    python -m core.benchmarks.suite --cases 4 --frames 50 --size 50 --output bench.json
+    python -m core.benchmarks.suite --output new.json --compare bench.json --tolerance 0.2
+
+With --compare the exit status is 1 when a benchmark got slower than the baseline by more than the tolerance.
+'''
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+from datetime import datetime
+
+import numpy as np
+
+from core.benchmarks.synthetic import make_synthetic_dataset
+from core.data_set import DataSet
+from utils.prepare_dataset import reshape_images
+
+FORMAT = '%Y-%m-%d %H:%M:%S'
+BENCHMARK_MODEL_NAME = '_benchmark'
+
+
+def timeit(fn, repeat=3, setup=None):
+    '''
+    Run fn repeat times (setup before each run is not timed), return the timing summary in seconds
+    '''
+    times = []
+    for _ in xrange(repeat):
+        arg = setup() if setup is not None else None
+        start = time.time()
+        fn(arg) if setup is not None else fn()
+        times.append(time.time() - start)
+    return {'min': min(times), 'median': float(np.median(times)), 'mean': float(np.mean(times)), 'repeat': repeat}
+
+
+class BenchmarkSuite(object):
+    def __init__(self, nb_cases=4, nb_frames=20, img_size=50, source_size=200, repeat=3, with_keras=True):
+        self.nb_cases = nb_cases
+        self.nb_frames = nb_frames
+        self.img_size = img_size
+        self.source_size = source_size
+        self.repeat = repeat
+        self.with_keras = with_keras
+        self.root_dir = None
+        self.results = {}
+
+    def _record(self, name, timing, **extra):
+        timing.update(extra)
+        self.results[name] = timing
+        print '%-32s median %.4fs  min %.4fs' % (name, timing['median'], timing['min'])
+
+    def _data_set(self):
+        return DataSet(self.img_size, self.img_size, root_dir=self.root_dir)
+
+    def run_data(self):
+        input_dataset_path = make_synthetic_dataset(self.root_dir, self.nb_cases, self.nb_frames, self.source_size)
+        adaptation = os.path.join(self.root_dir, 'dataset_%sX%s_adaptation' % (self.img_size, self.img_size))
+
+        def _reshape():
+            if os.path.exists(adaptation):
+                shutil.rmtree(adaptation)
+            reshape_images(input_dataset_path, adaptation, self.img_size, self.img_size, self.nb_frames)
+        self._record('reshape_images', timeit(_reshape, 1))
+
+        nb_samples = 2 * self.nb_cases * self.nb_frames
+        self._record('data_set_load', timeit(lambda _set: _set._load(), self.repeat, self._data_set),
+                     samples=nb_samples)
+        _set = self._data_set()
+        _set._load()
+        self._record('split_frames', timeit(lambda: _set.get_data_set_split_frames(0.5), self.repeat))
+        self._record('split_cases', timeit(lambda: _set.get_data_set_split_cases(0.5), self.repeat))
+        return _set
+
+    def run_keras(self, data_set):
+        from core.cnn import CNN, data_set_manager
+
+        params = {'model_name': BENCHMARK_MODEL_NAME, 'img_rows': self.img_size, 'img_cols': self.img_size}
+        cnn = CNN(params)
+        gabor = cnn.get_custom_gabor()
+        shape = cnn.kernel_size + (cnn.nb_channel, cnn.nb_filters)
+        self._record('get_custom_gabor', timeit(lambda: gabor(shape), self.repeat))
+
+        data_set.build_frame_index(persist=False)
+        frames = [path for path, category, case in data_set.frame_index[:32]]
+        self._record('predict_single', timeit(lambda: [cnn.predict(f) for f in frames], self.repeat),
+                     samples=len(frames))
+        self._record('predict_batch', timeit(lambda: cnn.predict_batch(frames), self.repeat),
+                     samples=len(frames))
+        self._record('get_activations', timeit(lambda: cnn.get_activations(frames[0]), self.repeat))
+
+        # train on the synthetic data set instead of the real one
+        data_set_manager.data_sets.insert(0, data_set)
+        try:
+            self._record('train_epoch', timeit(lambda: cnn.train_model(1), 1),
+                         samples=2 * self.nb_cases * self.nb_frames)
+        finally:
+            data_set_manager.data_sets.remove(data_set)
+            for path in glob.glob(cnn.model_path + '.*'):
+                os.remove(path)
+
+    def run(self):
+        self.root_dir = tempfile.mkdtemp(prefix='reflux_benchmark_')
+        try:
+            data_set = self.run_data()
+            if self.with_keras:
+                self.run_keras(data_set)
+        finally:
+            shutil.rmtree(self.root_dir)
+        return self.report()
+
+    def report(self):
+        return {
+            'meta': {
+                'date': datetime.now().strftime(FORMAT),
+                'python': platform.python_version(),
+                'machine': platform.node(),
+                'nb_cases': self.nb_cases,
+                'nb_frames': self.nb_frames,
+                'img_size': self.img_size,
+                'source_size': self.source_size,
+            },
+            'results': self.results
+        }
+
+
+def compare(current, baseline, tolerance=0.2):
+    '''
+    Return [(name, baseline median, current median, ratio)] of the benchmarks that got slower than tolerance
+    '''
+    regressions = []
+    for name, timing in sorted(current['results'].items()):
+        if name not in baseline['results']:
+            continue
+        base = baseline['results'][name]['median']
+        ratio = timing['median'] / base if base else 1.
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = 'REGRESSION'
+            regressions.append((name, base, timing['median'], ratio))
+        print '%-32s %.4fs -> %.4fs  x%.2f %s' % (name, base, timing['median'], ratio, flag)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='reflux_analyze hot path benchmarks')
+    parser.add_argument('--cases', type=int, default=4, help='cases per category')
+    parser.add_argument('--frames', type=int, default=20, help='frames per case')
+    parser.add_argument('--size', type=int, default=50, help='img_rows and img_cols of the adaptation data set')
+    parser.add_argument('--source-size', type=int, default=200, help='size of the synthetic source frames')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-keras', action='store_true', help='only the data benchmarks')
+    parser.add_argument('--output', help='write the results as json')
+    parser.add_argument('--compare', help='baseline json to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slow down ratio')
+    args = parser.parse_args(argv)
+
+    suite = BenchmarkSuite(args.cases, args.frames, args.size, args.source_size, args.repeat, not args.no_keras)
+    result = suite.run()
+    if args.output:
+        with open(args.output, 'wb') as output:
+            output.write(json.dumps(result, sort_keys=True, indent=4, separators=(',', ': ')))
+    if args.compare:
+        with open(args.compare, 'rb') as _input:
+            baseline = json.loads(_input.read())
+        if compare(result, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,34 @@
+import os
+import cv2
+import numpy as np
+
+
+def make_frame(rng, size, positive):
+    '''
+    Noisy ultrasound like frame: dark background, a bright fan and a few blobs
+    '''
+    frame = rng.randint(0, 40, (size, size)).astype(np.uint8)
+    cv2.ellipse(frame, (size // 2, 0), (size // 2, size - 1), 0, 30, 150, int(rng.randint(90, 140)), -1)
+    for _ in xrange(3 if positive else 1):
+        center = (int(rng.randint(size // 4, 3 * size // 4)), int(rng.randint(size // 4, 3 * size // 4)))
+        cv2.circle(frame, center, int(rng.randint(size // 20 + 1, size // 8 + 2)), int(rng.randint(150, 255)), -1)
+    frame = cv2.GaussianBlur(frame, (5, 5), 0)
+    return cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+
+
+def make_synthetic_dataset(root_dir, nb_cases=4, nb_frames=20, size=200, seed=7,
+                           categories=('negative', 'positive')):
+    '''
+    Write root_dir/dataset/<category>/<case>/frame<i>.png with the layout of the real data set,
+    no patient data is involved. Return the path of the 'dataset' folder.
+    '''
+    rng = np.random.RandomState(seed)
+    dataset_path = os.path.join(root_dir, 'dataset')
+    for idx, category in enumerate(categories):
+        for case in xrange(nb_cases):
+            case_path = os.path.join(dataset_path, category, '%03d' % (case,))
+            if not os.path.exists(case_path):
+                os.makedirs(case_path)
+            for i in xrange(nb_frames):
+                cv2.imwrite(os.path.join(case_path, 'frame%d.png' % (i,)), make_frame(rng, size, idx == 1))
+    return dataset_path
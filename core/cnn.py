@@ -1,22 +1,26 @@
 import os
 import gc
+import time
+import math
+import itertools
+import resource
 import traceback
 import json
+import hashlib
 import cv2
 import io
 from cv2.cv2 import CV_64F
-from random import randint
 from datetime import datetime
 import numpy as np
-from sklearn.model_selection import train_test_split
-from sklearn.utils import shuffle
 from sklearn.metrics import confusion_matrix
 from keras.callbacks import LambdaCallback
 from keras.layers import Conv2D
 from keras.utils import np_utils
 from keras.layers.convolutional import MaxPooling2D
-from keras.layers.core import Dense, Dropout, Activation, Flatten
-from keras.models import Sequential, load_model
+from keras.layers.pooling import GlobalAveragePooling2D
+from keras.layers.core import Dense, Activation, Flatten
+from keras.layers import Input
+from keras.models import Model, Sequential, load_model
 import keras.backend as K
 from theano import shared
 from PIL import Image
@@ -25,13 +29,63 @@ import base64
 from scipy.misc import toimage
 
 from core.data_set_manager import DataSetManager
+from core.feature_cache import block1_features, iterate_feature_batches, predict_feature_classes
+from core.graph_cache import GraphCache, VariableDropout, reset_optimizer
+from core.numpy_engine import export_model
+from core.prediction_cache import PredictionCache, frame_digest, prediction_cache
+from core.preprocessing import DEFAULT_CROP_BOX, ROI_AUTO, normalize, preprocess_batch
+from core.weight_store import WeightStore
 from manage import ROOT_DIR
+from utils import profiling
+from utils.metrics import inference_batch_size, inference_latency, model_compile_time, model_load_time
 
 
 FORMAT = '%Y-%m-%d %H:%M:%S'
+METRICS_LOG_EXTENSION = '.metrics.jsonl'
+_versions = itertools.count(1)
+# get_info fields that change every epoch, they are kept in the metrics log instead of <model>.json
+EPOCH_FIELDS = ('con_mat_train', 'con_mat_val', 'epoch_stats', 'times_start_test', 'times_start_train',
+                'times_finish', 'index_best')
+# get_info fields that are only meaningful while the model is in memory
+RUNTIME_FIELDS = ('hist', 'total_train_epoch', 'done_train_epoch')
+# weights files of the models saved before the weight store, read once and moved to the store on save
+LEGACY_WEIGHTS_EXTENSIONS = ('.h5(weights)', '.h5(best)', '.h5')
+# epoch_stats timings that add up to the training time of an epoch
+EPOCH_TIMES = ('data_time', 'fit_time', 'eval_time', 'checkpoint_time')
+# conv + relu + max pool, the block that is computed once and cached with freeze_gabor
+FROZEN_LAYERS = 3
 
 
 data_set_manager = DataSetManager()
+weight_store = WeightStore()
+graph_cache = GraphCache()
+
+
+def _pair(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(int(v) for v in value)
+    return int(value), int(value)
+
+
+def parse_schedule(value):
+    '''
+    resize_schedule as [[rows, cols, epochs], ...], value is a list of such stages or a '50x50:2,100x100:3' string
+    '''
+    if not value:
+        return []
+    if isinstance(value, basestring):
+        stages = []
+        for stage in value.split(','):
+            size, epochs = stage.strip().split(':')
+            rows, cols = size.lower().split('x')
+            stages.append([rows, cols, epochs])
+        value = stages
+    return [[int(rows), int(cols), int(epochs)] for rows, cols, epochs in value]
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
 
 
 def calculate_score(_confusion_matrix):
@@ -49,12 +103,45 @@ def calculate_score(_confusion_matrix):
         return 0
 
 
+def gabor_bank(shape, sigma, theta, lambd, gamma, psi):
+    '''
+    Gabor kernels of the Gabor params in the keras kernel shape (rows, cols, input_depth, filters)
+    '''
+    total_ker = []
+    for t in np.arange(0, np.pi, np.pi /shape[3]):
+        kernels = []
+        for z in np.arange(0, np.pi, np.pi /shape[2]):
+            tmp_filter = cv2.getGaborKernel(ksize=(shape[0], shape[1]),
+                                            sigma=sigma,
+                                            theta=theta + t,
+                                            lambd=lambd,
+                                            gamma=gamma + z,
+                                            psi=psi,
+                                            ktype=CV_64F)
+            _filter = []
+            if shape[0]%2 == 0:
+                for i in xrange(len(tmp_filter)-1):
+                    _filter.append(tmp_filter[i][0: shape[1]])
+            else:
+                _filter = tmp_filter
+            kernels.append(_filter)
+        total_ker.append(kernels)
+    return np.array(total_ker).reshape(shape)
+
+
 class CNN(object):
     def __init__(self, params, _reload=False):
         self.model_name = params['model_name']
         self.model_path = os.path.join(ROOT_DIR, 'cnn_models', self.model_name)
         self.input_dataset_path = os.path.join(ROOT_DIR, 'dataset')  # the original data set
         self.model = None  # the deep learning model
+        self._graph_key = None  # graph_key of self.model when it may go back to the graph cache
+        self.epoch_callbacks = []  # called with (cnn, stats) at the end of every epoch
+        self._logged_epochs = None  # epochs already in the metrics log, None - the log is not started yet
+        self.version = next(_versions)
+        self.weights = None  # digests of the saved weights in the weight store, kept in <model>.json
+        self._weights_version = None  # weights_version, None while self.model differs from the saved weights
+        self._target_size = None  # (img_rows, img_cols) of the model while a resize_schedule stage trains
         if _reload:
             self._load()
         else:
@@ -79,6 +166,10 @@ class CNN(object):
             self.lambd = float(params.get('lambd', 0.5))
             self.gamma = float(params.get('gamma', 0.3))
             self.psi = float(params.get('psi', 1.57))
+            # drop near duplicate frames from the data set (utils.prepare_dataset.select_distinct_frames)
+            self.dedup_threshold = params.get('dedup_threshold')
+            if self.dedup_threshold is not None:
+                self.dedup_threshold = float(self.dedup_threshold)
 
             self.con_mat_val = []
             self.con_mat_train = []
@@ -86,6 +177,7 @@ class CNN(object):
             self.times_start_test = []
             self.times_start_train = []
             self.times_finish = []
+            self.epoch_stats = []  # timing and memory of every epoch, aligned with con_mat_val
             self.category = ["negative", "positive"]
             self.total_train_epoch = 0
             self.done_train_epoch = 0
@@ -115,37 +207,70 @@ class CNN(object):
                     self.with_gabor = False
                 else:
                     self.with_gabor = True
+            # keep the Gabor bank of layer 1 fixed and train the other layers on its cached output
+            self.freeze_gabor = params.get('freeze_gabor', False)
+            if type(self.freeze_gabor) is not bool:
+                self.freeze_gabor = self.freeze_gabor.lower() not in ('false', '0', '')
+            if self.freeze_gabor and not self.with_gabor:
+                raise Exception('freeze_gabor needs with_gabor')
+            # crop the frames to the detected ultrasound region (core.roi) instead of the fixed box
+            self.roi = params.get('roi', False)
+            if type(self.roi) is not bool:
+                self.roi = self.roi.lower() not in ('false', '0', '')
+            # global average pooling instead of Flatten before the dense layers, the weights fit any input size
+            self.global_pool = params.get('global_pool', False)
+            if type(self.global_pool) is not bool:
+                self.global_pool = self.global_pool.lower() not in ('false', '0', '')
+            # [[rows, cols, epochs], ...] a new model trains before img_rows x img_cols (progressive resizing)
+            self.resize_schedule = parse_schedule(params.get('resize_schedule'))
+            if self.resize_schedule and not self.global_pool:
+                raise Exception('resize_schedule needs global_pool')
 
             self._build_model()
         # self.load_datasets()
 
+    def _gabor_bank(self, shape):
+        '''
+        Gabor kernels of the model params in the keras kernel shape (rows, cols, input_depth, filters)
+        '''
+        return gabor_bank(shape, self.sigma, self.theta, self.lambd, self.gamma, self.psi)
+
     def get_custom_gabor(self):
+        # the initializer stays on the layers of a cached graph, it keeps the params and not the CNN
+        params = (self.sigma, self.theta, self.lambd, self.gamma, self.psi)
+
         def custom_gabor(shape, dtype=None):
-            total_ker = []
-            for t in np.arange(0, np.pi, np.pi /shape[3]):
-                kernels = []
-                for z in np.arange(0, np.pi, np.pi /shape[2]):
-                    tmp_filter = cv2.getGaborKernel(ksize=(shape[0], shape[1]),
-                                                    sigma=self.sigma,
-                                                    theta=self.theta + t,
-                                                    lambd=self.lambd,
-                                                    gamma=self.gamma + z,
-                                                    psi=self.psi,
-                                                    ktype=CV_64F)
-                    _filter = []
-                    if shape[0]%2 == 0:
-                        for i in xrange(len(tmp_filter)-1):
-                            _filter.append(tmp_filter[i][0: shape[1]])
-                    else:
-                        _filter = tmp_filter
-                    kernels.append(_filter)
-                total_ker.append(kernels)
-            np_tot = shared(np.array(total_ker).reshape(shape))
+            np_tot = shared(gabor_bank(shape, *params))
             return K.variable(np_tot, dtype=dtype)
         return custom_gabor
 
+    @property
+    def data_set_options(self):
+        '''
+        The build options of the data set of this model (DataSetManager kwargs)
+        '''
+        return {'dedup_threshold': self.dedup_threshold, 'nb_channel': self.nb_channel, 'roi': self.roi}
+
+    @property
+    def graph_key(self):
+        '''
+        The params that set the shapes of the compiled graph, models with the same key share graphs (GraphCache)
+        '''
+        return (self.img_rows, self.img_cols, self.nb_channel, self.nb_filters, _pair(self.kernel_size),
+                _pair(self.pool_size), self.activation_function, len(self.category), self.global_pool)
+
     def _build_model(self):
+        start = time.time()
+        self._weights_version = None
+        self._graph_key = self.graph_key
+        self.model = graph_cache.acquire(self._graph_key)
+        if self.model is not None:
+            self._reset_model()
+        else:
+            self._compile_model()
+        model_compile_time.set(time.time() - start, model=self.model_name)
 
+    def _compile_model(self):
         self.model = Sequential()
 
         # Layer 1
@@ -166,13 +291,16 @@ class CNN(object):
         self.model.add(MaxPooling2D(pool_size=self.pool_size))
 
         # # Layer 3
-        self.model.add(Dropout(self.dropout))
-        self.model.add(Flatten())
+        self.model.add(VariableDropout(self.dropout))
+        if self.global_pool:
+            self.model.add(GlobalAveragePooling2D())
+        else:
+            self.model.add(Flatten())
 
         # Layer 4
         self.model.add(Dense(64))
         self.model.add(Activation('relu'))
-        self.model.add(Dropout(self.dropout))
+        self.model.add(VariableDropout(self.dropout))
 
         # Layer 5
         self.model.add(Dense(len(self.category)))
@@ -180,6 +308,44 @@ class CNN(object):
 
         self.model.compile(loss='binary_crossentropy', optimizer='adam', metrics=['accuracy'])
 
+    def _reset_model(self):
+        '''
+        Make a cached compiled model a new model of this CNN: fresh initial weights, dropout rate and optimizer
+        '''
+        weights = []
+        for layer in self.model.layers:
+            if not layer.weights:
+                continue
+            kernel, bias = layer.weights
+            shape = K.get_value(kernel).shape
+            # drawn here, the initializers of the cached layers belong to the CNN that compiled the graph
+            if isinstance(layer, Conv2D) and self.with_gabor:
+                weights.append(self._gabor_bank(shape))
+            elif isinstance(layer, Conv2D):
+                # keras 'random_normal'
+                weights.append(np.random.normal(0., 0.05, shape))
+            else:
+                # keras 'glorot_uniform', the Dense default
+                limit = math.sqrt(6. / (shape[0] + shape[1]))
+                weights.append(np.random.uniform(-limit, limit, shape))
+            weights.append(np.zeros(K.get_value(bias).shape))
+        self.model.set_weights([w.astype(K.floatx()) for w in weights])
+        for layer in self.model.layers:
+            if isinstance(layer, VariableDropout):
+                layer.set_rate(self.dropout)
+        reset_optimizer(self.model)
+        if getattr(self.model, 'frozen_head', None) is not None:
+            reset_optimizer(self.model.frozen_head)
+
+    def release_model(self):
+        '''
+        Give the compiled model back to the graph cache for the next trial, the CNN has no model after it
+        '''
+        if self.model is not None and self._graph_key is not None:
+            graph_cache.release(self._graph_key, self.model)
+        self.model = None
+        self.hist = None
+
     def _get_avg_score_list(self):
         avg_scores = [];
         for i in xrange(len(self.con_mat_val)):
@@ -189,10 +355,10 @@ class CNN(object):
         return avg_scores
 
     def get_activations(self, frame_path):
-        frame = np.array(Image.open(frame_path)).transpose(2, 0, 1)
-        y = [1]
-        y.extend(frame.shape)
-        frame = frame.reshape(tuple(y))
+        '''
+        The outputs of the layers on a frame of the adaptation data set
+        '''
+        frame = self._preprocess([frame_path], prepared=True)
         inp = self.model.input  # input placeholder
         outputs = [_layer.output for _layer in self.model.layers]  # all layer outputs
         functor = K.function([inp] + [K.learning_phase()], outputs)  # evaluation function
@@ -215,33 +381,142 @@ class CNN(object):
                 imgs[lay].append("data:image/png;base64,%s" % (base64.b64encode(img_bytes),))
         return imgs
 
-    def _save_only_best(self, epoch=None, logs=None):
+    def _is_final_size(self, i):
+        '''
+        Whether epoch i trained at the size of the model (not at a resize_schedule stage size)
+        '''
+        stats = self.epoch_stats[i] if i < len(self.epoch_stats) else None
+        if not stats or 'img_rows' not in stats:
+            return True
+        return (stats['img_rows'], stats['img_cols']) == (self._target_size or (self.img_rows, self.img_cols))
+
+    def _save_only_best(self, epoch=None, logs=None, write_log=True):
         avg_scores = self._get_avg_score_list()
-        last_biggest = True
+        # a resize stage is scored on another data set, its weights are not the best of the model
+        last_biggest = self._is_final_size(len(avg_scores) - 1)
         for i in xrange(len(avg_scores)-1):
-            if avg_scores[i] > avg_scores[-1]:
+            if self._is_final_size(i) and avg_scores[i] > avg_scores[-1]:
                 last_biggest = False
                 break
         if last_biggest:
             self.index_best = len(avg_scores)-1
             print '\nfind best model and save it. avg_scores = %s' % (avg_scores[-1],)
-            self.save()
+            self.save_weights()
         else:
-            print '\nsave json only'
-            self.save(only_json=True)
+            print '\nsave metrics only'
+        if write_log:
+            self._write_metrics_log()
+
+    def add_epoch_callback(self, callback):
+        '''
+        callback(cnn, stats) is called at the end of every epoch with the stats of that epoch
+        '''
+        self.epoch_callbacks.append(callback)
+
+    def _end_epoch(self, evaluate, data_time, fit_time, nb_samples):
+        start = time.time()
+        evaluate()
+        eval_time = time.time() - start
+        stats = {
+            'epoch': len(self.con_mat_val) - 1,
+            'time': datetime.now().strftime(FORMAT),
+            'data_time': data_time,
+            'fit_time': fit_time,
+            'eval_time': eval_time,
+            'checkpoint_time': None,
+            'samples_per_sec': nb_samples / fit_time if fit_time else 0,
+            'img_rows': self.img_rows,
+            'img_cols': self.img_cols,
+            'peak_rss_mb': _peak_rss_mb()
+        }
+        self.epoch_stats.append(stats)
+        start = time.time()
+        self._save_only_best(write_log=False)
+        stats['checkpoint_time'] = time.time() - start
+        self._write_metrics_log()
+        for callback in self.epoch_callbacks:
+            try:
+                callback(self, stats)
+            except Exception as e:
+                print traceback.format_exc()
 
-    def train_model(self, n_epoch=None):
-        if self.split_cases:
-            X_train, X_test, y_train, y_test = data_set_manager.get_data_set_split_cases(self.img_rows, self.img_cols, self.train_ratio)
+    def train_model(self, n_epoch=None, profile=False):
+        '''
+        Train n_epoch epochs, with profile=True the run is profiled (utils.profiling) even if profiling is off
+        '''
+        with profiling.profile(self.model_name, 'train', force=profile):
+            if self.resize_schedule and not self.con_mat_val:
+                self._train_schedule()
+            self._train_model(n_epoch)
+
+    def _train_schedule(self):
+        '''
+        The resize_schedule stages of a new model. A stage trains on the data set of its size and hands
+        its weights to the next one, the model is back at img_rows x img_cols at the end.
+        '''
+        self._target_size = (self.img_rows, self.img_cols)
+        try:
+            for rows, cols, epochs in self.resize_schedule:
+                self._resize_model(rows, cols)
+                self._train_model(epochs)
+        finally:
+            self._resize_model(*self._target_size)
+            self._target_size = None
+
+    def _resize_model(self, rows, cols):
+        '''
+        Move the weights to a model of another input size (global_pool models only)
+        '''
+        if (rows, cols) == (self.img_rows, self.img_cols):
+            return
+        weights = self.model.get_weights()
+        self.release_model()
+        self.img_rows, self.img_cols = rows, cols
+        self._build_model()
+        self.model.set_weights(weights)
+
+    def time_to_score(self, target):
+        '''
+        (seconds, epoch) of training (data, fit, evaluation and checkpoints) until the avg score first
+        reached target at img_rows x img_cols, (None, None) when it never did
+        '''
+        elapsed = 0.
+        for i, score in enumerate(self._get_avg_score_list()):
+            stats = (self.epoch_stats[i] if i < len(self.epoch_stats) else None) or {}
+            elapsed += sum(stats.get(key) or 0 for key in EPOCH_TIMES)
+            if score >= target and self._is_final_size(i):
+                return elapsed, i
+        return None, None
+
+    def _train_model(self, n_epoch=None):
+        start = time.time()
+        if self.freeze_gabor:
+            # X_train/X_test are rows of the cached layer 1 features
+            head, features, labels, X_train, X_test = self._frozen_training_data()
+            y_train = np_utils.to_categorical(labels[X_train], len(self.category))
+            y_test = np_utils.to_categorical(labels[X_test], len(self.category))
+
+            def _predict_classes(X):
+                return predict_feature_classes(head, features, X, self.batch_size)
         else:
-            X_train, X_test, y_train, y_test = data_set_manager.get_data_set_split_frames(self.img_rows, self.img_cols, self.train_ratio)
+            if self.split_cases:
+                X_train, X_test, y_train, y_test = data_set_manager.get_data_set_split_cases(self.img_rows, self.img_cols, self.train_ratio,
+                                                                                            **self.data_set_options)
+            else:
+                X_train, X_test, y_train, y_test = data_set_manager.get_data_set_split_frames(self.img_rows, self.img_cols, self.train_ratio,
+                                                                                             **self.data_set_options)
+
+            def _predict_classes(X):
+                return self.model.predict_classes(X)
+        # the data preparation time is reported with the first epoch of this run
+        timer = {'data_time': time.time() - start, 'epoch_start': None}
 
         def _calculate_confusion_matrix(epoch=None, logs=None):
             try:
                 # For test set
                 if len(self.times_start_test) < 3:
                     self.times_start_test.append(datetime.now().strftime(FORMAT))
-                y_pred = self.model.predict_classes(X_test)
+                y_pred = _predict_classes(X_test)
                 tn, fp, fn, tp = confusion_matrix(np.argmax(y_test, axis=1), y_pred).ravel()
                 print "\nval: tn:%s, fp:%s, fn:%s, tp:%s" % (tn, fp, fn, tp)
                 self.con_mat_val.append([tn, fp, fn, tp])
@@ -249,7 +524,7 @@ class CNN(object):
                 # For train set
                 if len(self.times_start_train) < 3:
                     self.times_start_train.append(datetime.now().strftime(FORMAT))
-                y_pred = self.model.predict_classes(X_train)
+                y_pred = _predict_classes(X_train)
                 tn, fp, fn, tp = confusion_matrix(np.argmax(y_train, axis=1), y_pred).ravel()
                 print "\ntrain: tn:%s, fp:%s, fn:%s, tp:%s" % (tn, fp, fn, tp)
                 self.con_mat_train.append([tn, fp, fn, tp])
@@ -263,47 +538,222 @@ class CNN(object):
         # Initialize params for progress bar
         self.done_train_epoch = 0
         self.total_train_epoch = n_epoch
+        self._touch()
 
-        # Evaluate the created model at the first time only
-        if not self.con_mat_val:
-            _calculate_confusion_matrix()
-            self._save_only_best()
+        def _on_epoch_begin(epoch=None, logs=None):
+            timer['epoch_start'] = time.time()
+            self._weights_version = None
 
-        # Start train the model
-        conf_matrix = LambdaCallback(on_epoch_end=lambda epoch, logs: _calculate_confusion_matrix(epoch, logs))
-        save_only_best = LambdaCallback(on_epoch_end=lambda epoch, logs: self._save_only_best(epoch, logs))
+        def _on_epoch_end(epoch=None, logs=None):
+            fit_time = time.time() - timer['epoch_start']
+            self._end_epoch(_calculate_confusion_matrix, timer['data_time'], fit_time, len(X_train))
+            timer['data_time'] = 0
 
+        # Evaluate the created model at the first time only
+        if not self.con_mat_val:
+            self._end_epoch(_calculate_confusion_matrix, timer['data_time'], 0, len(X_train))
+            timer['data_time'] = 0
+
+        # Start train the model, evaluate and save only the best model at the end of every epoch
+        epoch_end = LambdaCallback(on_epoch_begin=_on_epoch_begin, on_epoch_end=_on_epoch_end)
+
+        if self.freeze_gabor:
+            self.hist = head.fit_generator(iterate_feature_batches(features, labels, X_train, self.batch_size,
+                                                                   len(self.category)),
+                                           steps_per_epoch=int(math.ceil(len(X_train) / float(self.batch_size))),
+                                           epochs=n_epoch,
+                                           verbose=1,
+                                           callbacks=[epoch_end])
+            return
         self.hist = self.model.fit(X_train,
                                    y_train,
                                    batch_size=self.batch_size,
                                    epochs=n_epoch,
                                    verbose=1,
                                    validation_data=(X_test, y_test),
-                                   callbacks=[conf_matrix, save_only_best])
+                                   callbacks=[epoch_end])
+
+    def _frozen_training_data(self):
+        '''
+        The head model, the cached layer 1 features of the data set, the labels and the split rows
+        '''
+        data_set = data_set_manager.get_data_set(self.img_rows, self.img_cols, **self.data_set_options)
+        train_idx, test_idx = data_set.get_split_indices(self.train_ratio, self.split_cases)
+        kernel, bias = self.model.layers[0].get_weights()
+        features = block1_features(data_set, kernel, bias, _pair(self.pool_size), K.backend())
+        return self._frozen_head(), features, data_set.labels, train_idx, test_idx
+
+    def _frozen_head(self):
+        '''
+        Model of the layers after the first conv block, on the output of that block. The layers (and their
+        weights) are shared with self.model, the head is kept on the compiled model so a cached graph
+        (GraphCache) brings its head along.
+        '''
+        head = getattr(self.model, 'frozen_head', None)
+        if head is None:
+            inputs = Input(shape=self.model.layers[FROZEN_LAYERS - 1].output_shape[1:])
+            x = inputs
+            for layer in self.model.layers[FROZEN_LAYERS:]:
+                x = layer(x)
+            head = Model(inputs, x)
+            head.compile(loss='binary_crossentropy', optimizer='adam', metrics=['accuracy'])
+            self.model.frozen_head = head
+        return head
 
     def save(self, only_json=False):
         if not only_json:
-            self.model.save_weights(self.model_path + '.h5(weights)')
-        save_dict = self.get_info()
+            self.save_weights()
+        else:
+            self.save_config()
+        self._write_metrics_log()
+
+    def save_weights(self):
+        '''
+        Put the weights in the weight store and point <model>.json to them
+        '''
+        old_weights = self.weights or []
+        self.weights = weight_store.save_weights(self.model)
+        self._weights_version = self._manifest_version(self.weights)
+        prediction_cache.invalidate(self.model_name)
+        self.save_config()
+        # the blobs of the previous weights, unless another model shares them
+        weight_store.discard(set(old_weights) - set(self.weights))
+        for ext in LEGACY_WEIGHTS_EXTENSIONS:
+            if os.path.exists(self.model_path + ext):
+                os.remove(self.model_path + ext)
+
+    @staticmethod
+    def _manifest_version(weights):
+        return hashlib.sha1(json.dumps(weights, sort_keys=True)).hexdigest()
+
+    @property
+    def weights_version(self):
+        '''
+        Id of the weights self.model holds, None when they are not saved (a new model or in the middle of
+        training). Predictions are cached under it.
+        '''
+        return self._weights_version
+
+    @property
+    def metrics_log_path(self):
+        return self.model_path + METRICS_LOG_EXTENSION
+
+    def get_config(self):
+        '''
+        The static part of get_info, what is kept in <model>.json
+        '''
+        info = self.get_info()
+        for key in EPOCH_FIELDS + RUNTIME_FIELDS:
+            del info[key]
+        if self._target_size is not None:
+            # in the middle of a resize stage, the model is reloaded at its own size
+            info['img_rows'], info['img_cols'] = self._target_size
+        info['weights'] = self.weights
+        return info
+
+    def save_config(self):
         with open(self.model_path+'.json', 'wb') as output:
-            output.write(json.dumps(save_dict, sort_keys=True, indent=4, separators=(',', ': ')))
+            output.write(json.dumps(self.get_config(), sort_keys=True, indent=4, separators=(',', ': ')))
+        self._touch()
+
+    def _touch(self):
+        # a new version for every change the model listing shows (CNNManager.get_summaries)
+        self.version = next(_versions)
+
+    def _epoch_entry(self, i):
+        def _at(values):
+            return values[i] if i < len(values) else None
+        return {
+            'index': i,
+            'con_mat_train': _at(self.con_mat_train),
+            'con_mat_val': _at(self.con_mat_val),
+            'stats': _at(self.epoch_stats),
+            'time_start_test': _at(self.times_start_test),
+            'time_start_train': _at(self.times_start_train),
+            'time_finish': _at(self.times_finish),
+            'best': i == self.index_best
+        }
+
+    def _write_metrics_log(self):
+        '''
+        Append the epochs that are not in <model>.metrics.jsonl yet, one json line per epoch.
+        A model that was not loaded from disk starts a new log (and a new <model>.json).
+        '''
+        mode = 'ab'
+        if self._logged_epochs is None or not os.path.exists(self.metrics_log_path):
+            mode, self._logged_epochs = 'wb', 0
+        with open(self.metrics_log_path, mode) as output:
+            for i in xrange(self._logged_epochs, len(self.con_mat_val)):
+                output.write(json.dumps(self._epoch_entry(i), sort_keys=True) + '\n')
+        self._logged_epochs = len(self.con_mat_val)
+        if mode == 'wb' or not os.path.exists(self.model_path + '.json'):
+            self.save_config()
+        self._touch()
+
+    def _read_metrics_log(self):
+        entries, good_bytes = [], 0
+        with open(self.metrics_log_path, 'rb') as _input:
+            for line in _input:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # a line cut by a crash in the middle of a write
+                    break
+                good_bytes += len(line)
+        if good_bytes != os.path.getsize(self.metrics_log_path):
+            with open(self.metrics_log_path, 'r+b') as output:
+                output.truncate(good_bytes)
+
+        # the lists stay aligned with the epochs, an epoch without stats keeps a None in its place
+        self.con_mat_train = [e['con_mat_train'] for e in entries]
+        self.con_mat_val = [e['con_mat_val'] for e in entries]
+        self.epoch_stats = [e.get('stats') for e in entries]
+        # the times are kept for the first 3 epochs only
+        self.times_start_test = [e.get('time_start_test') for e in entries[:3]]
+        self.times_start_train = [e.get('time_start_train') for e in entries[:3]]
+        self.times_finish = [e.get('time_finish') for e in entries[:3]]
+        best = [e['index'] for e in entries if e.get('best')]
+        if best:
+            self.index_best = best[-1]
+        self._logged_epochs = len(entries)
+
+    def export_numpy(self, path=None):
+        '''
+        Export the weights for the NumPy inference engine (core.numpy_engine.NumpyCNN)
+        '''
+        return export_model(self, path, backend=K.backend())
 
     def _find_index_best(self):
         avg_scores = self._get_avg_score_list()
         return avg_scores.index(min(avg_scores))
 
     def _load(self):
+        start = time.time()
         with open(self.model_path+'.json', 'rb') as _input:
             tmp = json.loads(_input.read())
         self.__dict__.update(tmp)
         self.total_train_epoch = 0
         self.done_train_epoch = 0
+        if os.path.exists(self.metrics_log_path):
+            self._read_metrics_log()
+        else:
+            # a model saved before the metrics log, its epochs are moved to the log on the next save
+            self._logged_epochs = 0
         if not hasattr(self, 'times_start_test'):
             self.times_start_test = []
         if not hasattr(self, 'times_start_train'):
             self.times_start_train = []
         if not hasattr(self, 'times_finish'):
             self.times_finish = []
+        if not hasattr(self, 'epoch_stats'):
+            self.epoch_stats = []
+        # a model saved before the stats (or the times) has fewer of them than epochs, the next epochs are
+        # appended at their own index
+        n_epochs = len(self.con_mat_val)
+        self.epoch_stats += [None] * (n_epochs - len(self.epoch_stats))
+        for name in ('times_start_test', 'times_start_train', 'times_finish'):
+            values = getattr(self, name)
+            values += [None] * (min(n_epochs, 3) - len(values))
         if not hasattr(self, 'train_ratio'):
             self.train_ratio = 0.5
         if not hasattr(self, 'sigma'):
@@ -316,28 +766,112 @@ class CNN(object):
             self.gamma = 0.3
         if not hasattr(self, 'psi'):
             self.psi = 1.57
+        if not hasattr(self, 'dedup_threshold'):
+            self.dedup_threshold = None
+        if not hasattr(self, 'freeze_gabor'):
+            self.freeze_gabor = False
+        if not hasattr(self, 'roi'):
+            self.roi = False
+        if not hasattr(self, 'global_pool'):
+            self.global_pool = False
+        if not hasattr(self, 'resize_schedule'):
+            self.resize_schedule = []
         if not hasattr(self, 'index_best'):
-            self.index_best = self._find_index_best()
+            self.index_best = self._find_index_best() if self.con_mat_val else 0
 
-        if hasattr(self, 'with_gabor') and self.with_gabor:
+        self._weights_version = None
+        if self.weights:
+            self._build_model()
+            weight_store.load_weights(self.model, self.weights)
+            self._weights_version = self._manifest_version(self.weights)
+        elif hasattr(self, 'with_gabor') and self.with_gabor:
             self._build_model()
             if os.path.exists(self.model_path + '.h5(weights)'):
                 self.model.load_weights(self.model_path + '.h5(weights)')
+                self._weights_version = self._legacy_version(self.model_path + '.h5(weights)')
         elif os.path.exists(self.model_path + '.h5(best)'):
             self.model = load_model(self.model_path + '.h5(best)')
+            self._weights_version = self._legacy_version(self.model_path + '.h5(best)')
         elif os.path.exists(self.model_path + '.h5'):
             self.model = load_model(self.model_path + '.h5')
+            self._weights_version = self._legacy_version(self.model_path + '.h5')
         else:
             self._build_model()
-
-    def predict(self, frame):
-        img = Image.open(frame)
-        if img.size != (self.img_cols, self.img_rows):
-            raise Exception('Image Size Don\'t Matching.')
-        frame = np.array(np.array(img).flatten())
-        frame = frame.reshape(1, self.nb_channel, self.img_rows, self.img_cols)
-        pred = self.model.predict(frame, batch_size=1)
-        return self.category[0] if pred[0][0] > pred[0][1] else self.category[1]
+        model_load_time.set(time.time() - start, model=self.model_name)
+
+    @staticmethod
+    def _legacy_version(path):
+        return 'h5:%s:%s' % (os.path.basename(path), os.path.getmtime(path))
+
+    def _preprocess(self, frames, source=None, prepared=False):
+        '''
+        prepared frames come from the adaptation data set, they are cut already and are not cropped again
+        '''
+        if prepared:
+            crop_box = None
+        else:
+            crop_box = ROI_AUTO if self.roi else DEFAULT_CROP_BOX
+        return normalize(preprocess_batch(frames, self.img_rows, self.img_cols, self.nb_channel, crop_box,
+                                          source=source))
+
+    def predict(self, frame, prepared=False):
+        return self.predict_batch([frame], prepared=prepared)[0]
+
+    def predict_batch(self, frames, source=None, prepared=False):
+        '''
+        Predict a list of frames of any size (paths, uploaded files or decoded arrays),
+        they go through the same crop and resize the adaptation data set is built with.
+        source names the video the frames come from, its detected region is cached (roi models).
+        prepared frames come from the adaptation data set and are only resized.
+        Frames already predicted by the same weights come from the prediction cache.
+        '''
+        return self.to_labels(self.predict_batch_proba(frames, source, prepared))
+
+    def predict_batch_proba(self, frames, source=None, prepared=False):
+        version = self.weights_version
+        # an roi frame without a source is cropped by a region detected on its own batch
+        if version is None or not frames or (self.roi and source is None and not prepared):
+            return self.predict_proba(self._preprocess(frames, source, prepared))
+        variant = source if self.roi and not prepared else ''
+        keys = [PredictionCache.key(self.model_name, version, frame_digest(frame), variant) for frame in frames]
+        cached = prediction_cache.get_many(keys)
+        missing = [i for i, key in enumerate(keys) if key not in cached]
+        if missing:
+            pred = self.predict_proba(self._preprocess([frames[i] for i in missing], source, prepared))
+            computed = [(keys[i], p) for i, p in zip(missing, pred)]
+            prediction_cache.put_many(self.model_name, computed)
+            cached.update(computed)
+        return np.array([cached[key] for key in keys])
+
+    def predict_proba(self, x):
+        '''
+        x is an already preprocessed and normalized batch
+        '''
+        inference_batch_size.observe(len(x), model=self.model_name)
+        with inference_latency.time(model=self.model_name):
+            return self.model.predict(x, batch_size=self.batch_size)
+
+    def to_labels(self, pred):
+        return [self.category[0] if p[0] > p[1] else self.category[1] for p in pred]
+
+    def get_summary(self):
+        '''
+        The short description of the model the models listing shows
+        '''
+        params = self.get_config()
+        del params['model_name']
+        del params['category']
+        avg_scores = self._get_avg_score_list()
+        return {
+            "model_name": self.model_name,
+            "params": params,
+            "epochs": len(self.con_mat_val),
+            "best_epoch": self.index_best,
+            "best_score": avg_scores[self.index_best] if self.index_best < len(avg_scores) else None,
+            "last_score": avg_scores[-1] if avg_scores else None,
+            "total_train_epoch": self.total_train_epoch,
+            "done_train_epoch": self.done_train_epoch
+        }
 
     def get_info(self):
         return {
@@ -360,34 +894,29 @@ class CNN(object):
             "total_train_epoch": self.total_train_epoch,
             "done_train_epoch": self.done_train_epoch,
             "with_gabor": self.with_gabor,
+            "freeze_gabor": self.freeze_gabor,
+            "roi": self.roi,
+            "global_pool": self.global_pool,
+            "resize_schedule": self.resize_schedule,
             "sigma": self.sigma,
             "theta": self.theta,
             "lambd": self.lambd,
             "gamma": self.gamma,
             "psi": self.psi,
+            "dedup_threshold": self.dedup_threshold,
             "times_start_test": self.times_start_test,
             "times_start_train": self.times_start_train,
             "times_finish": self.times_finish,
+            "epoch_stats": self.epoch_stats,
             "index_best": self.index_best
         }
 
     def get_random_frame(self):
-        # if not hasattr(self, 'adaptation_dataset'):
-        #     self.load_datasets()
-        categories = data_set_manager.get_categories(self.img_rows, self.img_cols)
-        adaptation_dataset = data_set_manager.get_adaptation_dataset(self.img_rows, self.img_cols)
-        category = randint(0, len(categories)-1)
-        category_path = os.path.join(adaptation_dataset, categories[category])
-        cases = os.listdir(category_path)
-        case_index = randint(0, len(cases)-1)
-        frames = os.listdir(os.path.join(category_path, cases[case_index]))
-        frame_index = randint(0, len(frames)-1)
-        random_frame = os.path.join(category_path, cases[case_index], frames[frame_index])
-        return random_frame, categories[category]
+        return data_set_manager.get_random_frame(self.img_rows, self.img_cols, **self.data_set_options)
 
     def get_random_prediction(self):
         random_frame, real = self.get_random_frame()
-        prediction = self.predict(random_frame)
+        prediction = self.predict(random_frame, prepared=True)
         img = open(random_frame, "rb").read()
         img = base64.b64encode(img)
         L_Out = self.get_activations(random_frame)
@@ -1,45 +1,247 @@
+'''
+The served models. Keras / Theano are imported by the first model load, not by importing this module:
+with warmup=True the models are loaded and compiled by a background thread while the server already
+answers, a model that is not loaded yet raises ModelLoading (get_model) instead of blocking.
+'''
 import os
-import shutil
+import json
+import time
+import uuid
+import hashlib
+import threading
+import traceback
+import numpy as np
 
-from core.cnn import CNN
+from core.prediction_cache import prediction_cache
+from core.preprocessing import load_image
+from core.quantization import QUANTIZED_EXTENSION
 from manage import ROOT_DIR
 from utils.singleton import singleton
 
+# the NumPy engine exports of a model
+EXPORT_EXTENSIONS = ('.npz', QUANTIZED_EXTENSION)
+# the model versions count from 1 in every process, the ETags of two processes never match
+BOOT_ID = uuid.uuid4().hex
+# seconds a listing of cnn_models is reused by the ETags, the changes of other processes show after it
+FILES_MTIMES_TTL = 2.
+
+WARMUP_IDLE = 'idle'
+WARMUP_IMPORTING = 'importing'  # Keras / Theano
+WARMUP_LOADING = 'loading'
+WARMUP_READY = 'ready'
+WARMUP_FAILED = 'failed'  # Keras / Theano could not be imported
+
+
+class ModelLoading(Exception):
+    '''
+    The model exists but the warm-up did not load it yet
+    '''
+    def __init__(self, model_name):
+        super(ModelLoading, self).__init__('Model %s is loading, try again later' % (model_name,))
+        self.model_name = model_name
+
 
 @singleton
 class CNNManager(object):
-    def __init__(self):
+    def __init__(self, warmup=False):
         self.models = {}
-        self.load_models()
+        self._summaries = {}  # model name -> (model version, summary)
+        self._pending = set()  # models the warm-up did not load yet
+        self._mtimes = (None, [])  # (listing time, _files_mtimes())
+        self._warmup_thread = None
+        self.warmup_status = {'state': WARMUP_IDLE, 'total': 0, 'loaded': 0, 'current': None, 'failed': {},
+                              'started': None, 'finished': None}
+        if warmup:
+            self.start_warmup()
+        else:
+            self.load_models()
+
+    def _models_names(self):
+        return sorted(set(_file.split('.')[0] for _file in os.listdir(os.path.join(ROOT_DIR, 'cnn_models'))))
+
+    def start_warmup(self):
+        '''
+        Load the models in a background thread, see warmup_status for the progress
+        '''
+        if self._warmup_thread is None:
+            # the models are known as loading before the thread starts
+            self._pending.update(self._models_names())
+            self._warmup_thread = threading.Thread(target=self.load_models, name='cnn-warmup')
+            self._warmup_thread.daemon = True
+            self._warmup_thread.start()
+        return self._warmup_thread
 
     def load_models(self):
-        models_names = set()
-        file_list = os.listdir(os.path.join(ROOT_DIR, 'cnn_models'))
-        for _file in file_list:
-            model_name = _file.split('.')[0]
-            models_names.add(model_name)
-        for i in models_names:
-            print 'load model %s' % i
-            cnn = CNN({'model_name': i}, True)
-            self.models[i] = cnn
+        '''
+        Load and compile every saved model, a model that can not be loaded is reported in
+        warmup_status['failed'] and the others are loaded anyway
+        '''
+        status = self.warmup_status
+        names = self._models_names()
+        self._pending.update(names)
+        status.update({'total': len(names), 'loaded': 0, 'started': time.time(), 'finished': None,
+                       'state': WARMUP_IMPORTING})
+        try:
+            from core.cnn import CNN
+        except Exception as e:
+            status.update({'state': WARMUP_FAILED, 'error': e.message or repr(e), 'finished': time.time()})
+            self._pending.clear()
+            raise
+
+        status['state'] = WARMUP_LOADING
+        for name in names:
+            status['current'] = name
+            print 'load model %s' % name
+            try:
+                self.models[name] = CNN({'model_name': name}, True)
+            except Exception as e:
+                print traceback.format_exc()
+                status['failed'][name] = e.message or repr(e)
+            self._pending.discard(name)
+            status['loaded'] += 1
+        status.update({'state': WARMUP_READY, 'current': None, 'finished': time.time()})
+
+    @property
+    def ready(self):
+        return self.warmup_status['state'] == WARMUP_READY
+
+    def get_warmup_status(self):
+        status = dict(self.warmup_status, failed=dict(self.warmup_status['failed']), ready=self.ready)
+        end = status['finished'] or time.time()
+        status['seconds'] = end - status['started'] if status['started'] else 0.
+        return status
+
+    def is_loading(self, model_name):
+        return model_name in self._pending
+
+    def get_model(self, model_name):
+        cnn = self.models.get(model_name)
+        if cnn is None:
+            if self.is_loading(model_name):
+                raise ModelLoading(model_name)
+            raise Exception('Model %s not found' % (model_name,))
+        return cnn
 
     def add_model(self, cnn):
-        if cnn.model_name in self.models.keys():
+        if cnn.model_name in self.models.keys() or cnn.model_name in self._pending:
             return False, 'Model name already exist'
         cnn.save()
         self.models[cnn.model_name] = cnn
         return True, 'ok'
 
     def remove_model(self, model_name):
+        from core.cnn import LEGACY_WEIGHTS_EXTENSIONS, weight_store
+
         cnn_model = self.models[model_name]
         del self.models[model_name]
-        os.remove(cnn_model.model_path+'.h5')
-        os.remove(cnn_model.model_path + '.json')
-        shutil.rmtree(cnn_model.adaptation_dtatset)
+        for path in [cnn_model.model_path + '.json', cnn_model.metrics_log_path] + \
+                [cnn_model.model_path + ext for ext in LEGACY_WEIGHTS_EXTENSIONS + EXPORT_EXTENSIONS]:
+            if os.path.exists(path):
+                os.remove(path)
+        # the weights of the model are removed unless another model shares them
+        weight_store.collect_garbage()
+        prediction_cache.invalidate(model_name)
 
     def get_models(self):
         return {k: self.models[k].get_info() for k in self.models.keys()}
 
+    def _files_mtimes(self, model_name=None):
+        '''
+        [(file, mtime)] of the files in cnn_models (of one model), they change when another process
+        (a trial_queue collect, another server worker) writes a model. The listing is reused for
+        FILES_MTIMES_TTL seconds, the changes of this process show at once in the model versions.
+        '''
+        listed, mtimes = self._mtimes
+        now = time.time()
+        if listed is None or now - listed > FILES_MTIMES_TTL:
+            models_dir = os.path.join(ROOT_DIR, 'cnn_models')
+            mtimes = []
+            for _file in sorted(os.listdir(models_dir)):
+                try:
+                    mtimes.append((_file, repr(os.path.getmtime(os.path.join(models_dir, _file)))))
+                except OSError:
+                    # removed since the listing
+                    continue
+            self._mtimes = (now, mtimes)
+        if model_name is None:
+            return mtimes
+        return [(_file, mtime) for _file, mtime in mtimes if _file.split('.')[0] == model_name]
+
+    def get_models_etag(self):
+        '''
+        Changes whenever a model is added, removed, saved or trained, by this process or another one
+        '''
+        versions = sorted((name, cnn.version) for name, cnn in self.models.items())
+        return hashlib.sha1(json.dumps([BOOT_ID, versions, self._files_mtimes()])).hexdigest()
+
+    def get_model_etag(self, model_name):
+        '''
+        get_models_etag of one model, None when the model is not loaded
+        '''
+        cnn = self.models.get(model_name)
+        if cnn is None:
+            return None
+        return hashlib.sha1(json.dumps([BOOT_ID, model_name, cnn.version,
+                                        self._files_mtimes(model_name)])).hexdigest()
+
+    def get_summaries(self):
+        '''
+        Summary of every model, only models that changed since the last call are summarized again
+        '''
+        summaries = {}
+        for name, cnn in self.models.items():
+            cached = self._summaries.get(name)
+            if cached is None or cached[0] != cnn.version:
+                cached = (cnn.version, cnn.get_summary())
+            summaries[name] = cached
+        self._summaries = summaries
+        return [summary for version, summary in summaries.values()]
+
     def get_random_frame(self, model_name):
-        cnn_model = self.models[model_name]
-        return cnn_model.get_random_prediction()
\ No newline at end of file
+        cnn_model = self.get_model(model_name)
+        return cnn_model.get_random_prediction()
+
+    def predict_ensemble(self, model_names, frames, mode='average', source=None):
+        '''
+        Score the same frames with several models.
+        frames is a dict of name -> frame (path, uploaded file or array), every frame is decoded once,
+        and preprocessed once for each distinct model input shape.
+        mode: 'average' - average the models probabilities, 'vote' - majority of the models labels
+        '''
+        if mode not in ('average', 'vote'):
+            raise Exception('Unknown ensemble mode %s' % (mode,))
+        # every model once, in the given order
+        model_names = [name for i, name in enumerate(model_names) if name and name not in model_names[:i]]
+        if not model_names:
+            raise Exception('No model_names were given')
+        if not frames:
+            raise Exception('No frames were given')
+        names = frames.keys()
+        decoded = [load_image(frames[name]) for name in names]
+        tensors = {}
+        per_model, probabilities = {}, []
+        for model_name in model_names:
+            cnn = self.get_model(model_name)
+            key = (cnn.img_rows, cnn.img_cols, cnn.nb_channel, cnn.roi)
+            if key not in tensors:
+                tensors[key] = cnn._preprocess(decoded, source)
+            pred = cnn.predict_proba(tensors[key])
+            probabilities.append(pred)
+            per_model[model_name] = dict(zip(names, cnn.to_labels(pred)))
+
+        # the labels of the ensemble follow the rule of the models labels (CNN.to_labels)
+        first = self.get_model(model_names[0])
+        avg = np.mean(probabilities, axis=0)
+        averaged = first.to_labels(avg)
+        if mode == 'average':
+            ensemble = averaged
+        else:
+            votes = [sum(1 for labels in per_model.values() if labels[name] == first.category[1]) for name in names]
+            # a tie is broken by the averaged probabilities
+            ensemble = [first.category[1] if 2 * v > len(model_names) else
+                        first.category[0] if 2 * v < len(model_names) else
+                        label for v, label in zip(votes, averaged)]
+        return {'models': per_model,
+                'ensemble': dict(zip(names, ensemble)),
+                'probabilities': dict(zip(names, avg.tolist())),
+                'shared_inputs': len(tensors)}
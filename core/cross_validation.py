@@ -0,0 +1,111 @@
+'''
+k fold cross validation grouped by case.
+
+All the folds train on the single frame store of the DataSet, a fold is only a pair of index arrays,
+the batches are cut from the store and normalized on the fly. With n_jobs > 1 the folds run in fresh
+worker processes (core.worker_pool, the server that loaded Keras is not forked), the store is written
+once and memory mapped by all of them, the frames are not decoded again.
+'''
+import math
+import numpy as np
+from sklearn.metrics import confusion_matrix
+
+from core.preprocessing import normalize
+from core.worker_pool import SharedDataSet, run_tasks
+
+
+def _one_hot(labels, nb_classes):
+    return np.eye(nb_classes, dtype='float32')[labels]
+
+
+def iterate_batches(data_set, idx, batch_size, shuffle=True, seed=7):
+    '''
+    Endless (x, y) batches of data_set frames idx, for fit_generator
+    '''
+    rng = np.random.RandomState(seed)
+    nb_classes = len(data_set.categories)
+    while True:
+        order = rng.permutation(idx) if shuffle else idx
+        for start in xrange(0, len(order), batch_size):
+            batch = np.sort(order[start:start + batch_size])
+            yield normalize(data_set.frames[batch]), _one_hot(data_set.labels[batch], nb_classes)
+
+
+def evaluate(model, data_set, idx, batch_size):
+    '''
+    [tn, fp, fn, tp] of the model on data_set frames idx
+    '''
+    pred = []
+    for start in xrange(0, len(idx), batch_size):
+        pred.append(model.predict_classes(normalize(data_set.frames[idx[start:start + batch_size]]), verbose=0))
+    y_pred = np.concatenate(pred) if pred else np.array([], dtype=np.int64)
+    return [int(v) for v in confusion_matrix(data_set.labels[idx], y_pred, labels=[0, 1]).ravel()]
+
+
+def run_fold(params, fold, train_idx, test_idx, n_epoch, data_set):
+    from core.cnn import CNN, calculate_score
+
+    params = dict(params)
+    params['model_name'] = '%s_fold%s' % (params.get('model_name', 'cv'), fold)
+    cnn = CNN(params)
+    steps = int(math.ceil(len(train_idx) / float(cnn.batch_size)))
+    cnn.model.fit_generator(iterate_batches(data_set, train_idx, cnn.batch_size, seed=fold),
+                            steps_per_epoch=steps,
+                            epochs=n_epoch,
+                            verbose=0)
+    con_mat_train = evaluate(cnn.model, data_set, train_idx, cnn.batch_size)
+    con_mat_val = evaluate(cnn.model, data_set, test_idx, cnn.batch_size)
+    cnn.release_model()
+    train_score = calculate_score(con_mat_train)
+    val_score = calculate_score(con_mat_val)
+    print 'fold %s: train score %s, val score %s' % (fold, train_score, val_score)
+    return {
+        'fold': fold,
+        'train_frames': len(train_idx),
+        'test_frames': len(test_idx),
+        'con_mat_train': con_mat_train,
+        'con_mat_val': con_mat_val,
+        'train_score': train_score,
+        'val_score': val_score,
+        'avg_score': (train_score + val_score) / 2
+    }
+
+
+def _run_fold_worker(shared, task):
+    fold, train_idx, test_idx = task
+    arrays, config = shared['arrays'], shared['config']
+    data_set = SharedDataSet(arrays['frames'], arrays['labels'], config['categories'])
+    return run_fold(config['params'], fold, np.array(train_idx, dtype=np.int64), np.array(test_idx, dtype=np.int64),
+                    config['n_epoch'], data_set)
+
+
+def cross_validate(params, data_set, k=5, n_epoch=1, n_jobs=1, seed=7):
+    '''
+    Train and evaluate the params configuration on k case grouped folds of data_set,
+    report every fold and the mean and variance of the avg (train, val) F1 score.
+    '''
+    folds = data_set.get_case_folds(k, seed)
+    tasks = [(i, train_idx, test_idx) for i, (train_idx, test_idx) in enumerate(folds)]
+    if n_jobs > 1:
+        results = run_tasks('core.cross_validation:_run_fold_worker',
+                            [(i, train_idx.tolist(), test_idx.tolist()) for i, train_idx, test_idx in tasks],
+                            {'frames': data_set.frames, 'labels': data_set.labels},
+                            {'params': params, 'n_epoch': n_epoch, 'categories': data_set.categories},
+                            n_jobs=min(n_jobs, k))
+        for i, result in enumerate(results):
+            if 'error' in result:
+                raise Exception('Fold %s failed: %s' % (i, result['error']))
+    else:
+        results = [run_fold(params, i, train_idx, test_idx, n_epoch, data_set) for i, train_idx, test_idx in tasks]
+
+    avg_scores = [r['avg_score'] for r in results]
+    val_scores = [r['val_score'] for r in results]
+    return {
+        'k': k,
+        'n_epoch': n_epoch,
+        'folds': results,
+        'mean_avg_score': float(np.mean(avg_scores)),
+        'var_avg_score': float(np.var(avg_scores)),
+        'mean_val_score': float(np.mean(val_scores)),
+        'var_val_score': float(np.var(val_scores))
+    }
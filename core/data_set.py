@@ -1,22 +1,27 @@
 import os
 import gc
+import json
+import random
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import cv2
 import numpy as np
-from PIL import Image
 from sklearn.utils import shuffle
 from sklearn.model_selection import train_test_split
 from keras.utils import np_utils
 
+from core.preprocessing import normalize
 from manage import ROOT_DIR
+from utils import profiling
 from utils.prepare_dataset import reshape_images
 
+LOAD_THREADS = multiprocessing.cpu_count()
+LOAD_CHUNK = 64  # frames per decode task
 
-def _normalized_data_set(X_train, X_test, y_train, y_test, category):
-    X_train = X_train.astype('float32')
-    X_test = X_test.astype('float32')
 
-    # help for faster convert
-    X_train /= 255
-    X_test /= 255
+def _normalized_data_set(X_train, X_test, y_train, y_test, category):
+    X_train = normalize(X_train)
+    X_test = normalize(X_test)
 
     # convert class vector to binary class matrices
     y_train = np_utils.to_categorical(y_train, len(category))
@@ -26,75 +31,267 @@ def _normalized_data_set(X_train, X_test, y_train, y_test, category):
 
 
 class DataSet(object):
-    def __init__(self, img_rows, img_cols):
+    def __init__(self, img_rows, img_cols, root_dir=ROOT_DIR, dedup_threshold=None, nb_channel=3, roi=False):
         self.img_rows = img_rows
         self.img_cols = img_cols
+        self.root_dir = root_dir  # holds the original 'dataset' folder and the adaptation data sets
+        self.dedup_threshold = dedup_threshold  # near duplicate frames are dropped at build time when set
+        self.nb_channel = nb_channel  # 1 - grayscale frames, converted once at build time
+        self.roi = roi  # crop the frames to the detected active region (core.roi) instead of the fixed box
         # create adaption data set if not exist
         if not os.path.exists(self.adaptation_dataset):
+            # an index persisted for a previous build of this data set is stale now
+            if os.path.exists(self.frame_index_path):
+                os.remove(self.frame_index_path)
             print '\nStart create adaptation data set %sX%s' % (self.img_rows, self.img_cols)
-            input_dataset_path = os.path.join(ROOT_DIR, 'dataset')
-            reshape_images(input_dataset_path, self.adaptation_dataset, self.img_rows, self.img_cols)
+            input_dataset_path = os.path.join(self.root_dir, 'dataset')
+            with profiling.profile(self.name, 'reshape_images'):
+                reshape_images(input_dataset_path, self.adaptation_dataset, self.img_rows, self.img_cols,
+                               dedup_threshold=self.dedup_threshold, nb_channel=self.nb_channel, roi=self.roi)
             print '\nFinish create adaptation data set %sX%s' % (self.img_rows, self.img_cols)
         self.categories = os.listdir(self.adaptation_dataset)
-        self.data = None
+        self.data = None  # category -> case -> {'frames', 'labels'}, views into self.frames/self.labels
+        self.frames = None
+        self.labels = None
+        self.cases = None
+        self.case_slices = None
+        self.frame_index = None  # [(frame path, category, case)]
+        self._frames_by_category = None  # category -> [frame index]
+        self._frames_by_case = None  # category -> [[frame index] per case]
+        self.load_progress = (0, 0)  # (frames read, total frames) of the running load
 
-    def _load(self):
+    def _load(self, progress=None):
         if self.data is None:
-            print '\nStart load'
-            self.data = {}
-            for idx, category in enumerate(self.categories):
-                self.data[category] = {}
-                category_path = os.path.join(self.adaptation_dataset, category)
-                case_folder = os.listdir(category_path)
-                for sub_folder in case_folder:
-                    self.data[category][sub_folder] = {'frames': [], 'labels': None}
-                    labels, frames = [], []
-                    case_folder_path = os.path.join(self.adaptation_dataset, category, sub_folder)
-                    images = os.listdir(case_folder_path)
-                    for im in images:
-                        im_path = os.path.join(case_folder_path, im)
-                        frames.append(np.array(Image.open(im_path)).transpose(2, 0, 1))
-                        labels.append(idx)
-                    self.data[category][sub_folder]['frames'] = np.array(frames)
-                    self.data[category][sub_folder]['labels'] = np.array(labels)
-            print '\nFinish load'
-
-            # Clear Memory
-            gc.collect()
+            with profiling.profile(self.name, 'load'):
+                self._read_frames(progress)
+
+    def _decode_frames(self, start, stop):
+        # cv2 releases the GIL while decoding, the BGR frame is copied once, straight into the store as RGB
+        flags = cv2.IMREAD_GRAYSCALE if self.nb_channel == 1 else cv2.IMREAD_COLOR
+        for i in xrange(start, stop):
+            img = cv2.imread(self.frame_index[i][0], flags)
+            if img is None:
+                raise Exception('Can not read frame %s' % (self.frame_index[i][0],))
+            if img.ndim == 2:
+                np.copyto(self.frames[i, 0], img)
+            else:
+                np.copyto(self.frames[i], img.transpose(2, 0, 1)[::-1])
+        return stop - start
+
+    def _read_frames(self, progress=None, n_threads=None):
+        '''
+        Read every frame once into one channels first uint8 store (self.frames), the per case
+        entries of self.data and the folds of get_case_folds are views/indices into it.
+        The frames are decoded by a thread pool, progress(done, total) is called as the chunks finish.
+        '''
+        print '\nStart load'
+        index = self.build_frame_index()
+        first = cv2.imread(index[0][0], cv2.IMREAD_UNCHANGED)
+        self.frames = np.empty((len(index), self.nb_channel) + first.shape[:2], dtype=np.uint8)
+        category_index = {category: i for i, category in enumerate(self.categories)}
+        self.labels = np.array([category_index[category] for im_path, category, case in index], dtype=np.int64)
+
+        chunks = [(start, min(start + LOAD_CHUNK, len(index))) for start in xrange(0, len(index), LOAD_CHUNK)]
+        pool = ThreadPool(n_threads or LOAD_THREADS)
+        try:
+            done = 0
+            for count in pool.imap_unordered(lambda chunk: self._decode_frames(*chunk), chunks):
+                done += count
+                self.load_progress = (done, len(index))
+                if progress is not None:
+                    progress(done, len(index))
+        finally:
+            pool.close()
+            pool.join()
+        self._index_cases()
+        print '\nFinish load'
+
+        # Clear Memory
+        gc.collect()
+
+    def _index_cases(self):
+        # the frame index is ordered by category and case, so every case is a contiguous slice
+        self.cases = []  # [(category, case)]
+        self.case_slices = {}  # (category, case) -> slice of self.frames
+        for i, (im_path, category, case) in enumerate(self.frame_index):
+            if (category, case) not in self.case_slices:
+                self.cases.append((category, case))
+                self.case_slices[(category, case)] = [i, i + 1]
+            else:
+                self.case_slices[(category, case)][1] = i + 1
+        self.data = {category: {} for category in self.categories}
+        for (category, case), (start, stop) in self.case_slices.items():
+            self.case_slices[(category, case)] = slice(start, stop)
+            self.data[category][case] = {'frames': self.frames[start:stop], 'labels': self.labels[start:stop]}
+
+    def case_indices(self, cases):
+        '''
+        Frame indices (into self.frames) of a list of (category, case)
+        '''
+        if not cases:
+            return np.array([], dtype=np.int64)
+        return np.concatenate([np.arange(self.case_slices[c].start, self.case_slices[c].stop) for c in cases])
+
+    def get_case_folds(self, k, seed=7):
+        '''
+        k folds grouped by case: every case is in the test set of exactly one fold, and the cases of
+        every category are spread evenly between the folds. Return [(train indices, test indices)].
+        '''
+        self._load()
+        if k < 2:
+            raise Exception('k fold needs k >= 2')
+        rng = np.random.RandomState(seed)
+        fold_cases = [[] for _ in xrange(k)]
+        for category in self.categories:
+            cases = sorted(c for c in self.cases if c[0] == category)
+            if len(cases) < k:
+                print 'Warning: category %s has %s cases for %s folds' % (category, len(cases), k)
+            for i, j in enumerate(rng.permutation(len(cases))):
+                fold_cases[i % k].append(cases[j])
+        folds = []
+        for f in xrange(k):
+            train_cases = [c for i in xrange(k) if i != f for c in fold_cases[i]]
+            folds.append((self.case_indices(train_cases), self.case_indices(fold_cases[f])))
+        return folds
+
+    @property
+    def variant(self):
+        '''
+        Suffix of the build options, every variant has its own adaptation data set
+        '''
+        variant = ''
+        if self.dedup_threshold is not None:
+            # 0.01 -> 0p01, no dot in the directory name
+            variant += '_dedup%s' % (str(self.dedup_threshold).replace('.', 'p'),)
+        if self.nb_channel == 1:
+            variant += '_gray'
+        if self.roi:
+            variant += '_roi'
+        return variant
+
+    @property
+    def name(self):
+        return 'dataset_%sX%s%s' % (self.img_rows, self.img_cols, self.variant)
+
+    def memory_usage(self):
+        if self.data is None:
+            return 0
+        return self.frames.nbytes + self.labels.nbytes
 
     @property
     def adaptation_dataset(self):
-        return os.path.join(ROOT_DIR, 'dataset_' + str(self.img_rows) + 'X' + str(self.img_cols) + '_adaptation')
+        return os.path.join(self.root_dir, self.name + '_adaptation')
 
-    def get_data_set_split_frames(self, train_ratio):
-        self._load()
-        all_frames, labels = [], []
-        for c in self.categories:
-            for k in self.data[c].keys():
-                all_frames.extend(self.data[c][k]['frames'])
-                labels.extend(self.data[c][k]['labels'])
-        img_matrix, label = np.array(all_frames), np.array(labels)
-        # random_state for psudo random
-        data, label = shuffle(img_matrix, label, random_state=7)
+    @property
+    def dedup_stats_path(self):
+        return self.adaptation_dataset + '_dedup.json'
 
-        # the data set load, shuffled and split between train and validation sets
-        X_train, X_test, y_train, y_test = train_test_split(data, label, test_size=1-train_ratio, random_state=7)
+    def get_dedup_stats(self):
+        '''
+        Per case frames/kept/removed/augmented counts of the dedup build, None without dedup
+        '''
+        if not os.path.exists(self.dedup_stats_path):
+            return None
+        with open(self.dedup_stats_path, 'rb') as _input:
+            return json.loads(_input.read())
 
-        return _normalized_data_set(X_train, X_test, y_train, y_test, self.categories)
+    @property
+    def frame_index_path(self):
+        return self.adaptation_dataset + '_index.json'
 
-    def get_data_set_split_cases(self, train_ratio):
+    def build_frame_index(self, persist=True, rebuild=False):
+        '''
+        Build the flat (frame path, category, case) index of the adaptation data set once,
+        with persist=True it is kept next to the data set and reused by the next process.
+        '''
+        rows = None
+        if not rebuild and os.path.exists(self.frame_index_path):
+            with open(self.frame_index_path, 'rb') as _input:
+                rows = json.loads(_input.read())
+        if rows is None:
+            rows = []
+            for category in self.categories:
+                category_path = os.path.join(self.adaptation_dataset, category)
+                for case in sorted(os.listdir(category_path)):
+                    for frame in sorted(os.listdir(os.path.join(category_path, case))):
+                        rows.append((category, case, frame))
+            if persist:
+                with open(self.frame_index_path, 'wb') as output:
+                    output.write(json.dumps(rows))
+
+        self.frame_index = []
+        self._frames_by_category = {}
+        self._frames_by_case = {}
+        cases = {}
+        for category, case, frame in rows:
+            idx = len(self.frame_index)
+            self.frame_index.append((os.path.join(self.adaptation_dataset, category, case, frame), category, case))
+            self._frames_by_category.setdefault(category, []).append(idx)
+            if (category, case) not in cases:
+                cases[(category, case)] = []
+                self._frames_by_case.setdefault(category, []).append(cases[(category, case)])
+            cases[(category, case)].append(idx)
+        return self.frame_index
+
+    def get_random_frame(self, stratify=None):
+        '''
+        O(1) random frame from the frame index, return (frame path, category).
+        stratify: None    - uniform over all frames
+                  'category' - uniform category, then uniform frame
+                  'case'  - uniform category, then uniform case, then uniform frame
+        '''
+        if self.frame_index is None:
+            self.build_frame_index()
+        if stratify is None:
+            idx = random.randrange(len(self.frame_index))
+        elif stratify == 'category':
+            category = random.choice(self._frames_by_category.keys())
+            idx = random.choice(self._frames_by_category[category])
+        elif stratify == 'case':
+            category = random.choice(self._frames_by_case.keys())
+            idx = random.choice(random.choice(self._frames_by_case[category]))
+        else:
+            raise Exception('Unknown stratify option %s' % (stratify,))
+        path, category, case = self.frame_index[idx]
+        return path, category
+
+    def split_frames_indices(self, train_ratio):
+        '''
+        (train indices, test indices) into self.frames of a random split of the frames
+        '''
         self._load()
-        train_img_matrix, train_label, test_img_matrix, test_label = [], [], [], []
+        idx = self.case_indices([(c, k) for c in self.categories for k in self.data[c].keys()])
+        # random_state for psudo random
+        idx = shuffle(idx, random_state=7)
+        train_idx, test_idx = train_test_split(idx, test_size=1-train_ratio, random_state=7)
+        return train_idx, test_idx
+
+    def split_cases_indices(self, train_ratio):
+        '''
+        (train indices, test indices) into self.frames of a split by case, train_ratio of the cases of
+        every category are in the train set
+        '''
+        self._load()
+        train_cases, test_cases = [], []
         for c in self.categories:
             case_folder = self.data[c].keys()
-            for k in case_folder[0:int(len(case_folder) * train_ratio)]:
-                train_img_matrix.extend(self.data[c][k]['frames'])
-                train_label.extend(self.data[c][k]['labels'])
-            for k in case_folder[int(len(case_folder)*train_ratio):]:
-                test_img_matrix.extend(self.data[c][k]['frames'])
-                test_label.extend(self.data[c][k]['labels'])
-        train_img_matrix, train_label = shuffle(train_img_matrix, train_label, random_state=7)
-        train_img_matrix, train_label = np.array(train_img_matrix), np.array(train_label)
-        test_img_matrix, test_label = shuffle(test_img_matrix, test_label, random_state=7)
-        test_img_matrix, test_label = np.array(test_img_matrix), np.array(test_label)
-        return _normalized_data_set(train_img_matrix, test_img_matrix, train_label, test_label, self.categories)
+            train_cases.extend((c, k) for k in case_folder[0:int(len(case_folder) * train_ratio)])
+            test_cases.extend((c, k) for k in case_folder[int(len(case_folder)*train_ratio):])
+        train_idx = shuffle(self.case_indices(train_cases), random_state=7)
+        test_idx = shuffle(self.case_indices(test_cases), random_state=7)
+        return train_idx, test_idx
+
+    def get_split_indices(self, train_ratio, split_cases=True):
+        if split_cases:
+            return self.split_cases_indices(train_ratio)
+        return self.split_frames_indices(train_ratio)
+
+    def _split(self, train_idx, test_idx):
+        return _normalized_data_set(self.frames[train_idx], self.frames[test_idx],
+                                    self.labels[train_idx], self.labels[test_idx], self.categories)
+
+    def get_data_set_split_frames(self, train_ratio):
+        return self._split(*self.split_frames_indices(train_ratio))
+
+    def get_data_set_split_cases(self, train_ratio):
+        return self._split(*self.split_cases_indices(train_ratio))
@@ -1,32 +1,76 @@
 from core.data_set import DataSet
+from utils.metrics import registry
 from utils.singleton import singleton
 
 
+def _as_bool(value):
+    if isinstance(value, basestring):
+        return value.lower() not in ('false', '0', '')
+    return bool(value)
+
+
 @singleton
 class DataSetManager(object):
     def __init__(self):
         self.data_sets = []
 
-    def _get_or_create_data_set(self, img_rows, img_cols):
+    def _get_or_create_data_set(self, img_rows, img_cols, dedup_threshold=None, nb_channel=3, roi=False):
         for _set in self.data_sets:
-            if _set.img_rows == img_rows and _set.img_cols == img_cols:
+            if _set.img_rows == img_rows and _set.img_cols == img_cols and \
+                    _set.dedup_threshold == dedup_threshold and _set.nb_channel == nb_channel and _set.roi == roi:
                 return _set
-        _data_set = DataSet(img_rows, img_cols)
+        _data_set = DataSet(img_rows, img_cols, dedup_threshold=dedup_threshold, nb_channel=nb_channel, roi=roi)
         self.data_sets.append(_data_set)
         return _data_set
 
-    def get_data_set_split_frames(self, img_rows, img_cols, train_ratio):
-        _set = self._get_or_create_data_set(img_rows, img_cols)
+    def get_data_set(self, img_rows, img_cols, dedup_threshold=None, nb_channel=3, roi=False):
+        return self._get_or_create_data_set(img_rows, img_cols, dedup_threshold, nb_channel, roi)
+
+    def get_case_folds(self, img_rows, img_cols, k, seed=7, dedup_threshold=None, nb_channel=3, roi=False):
+        _set = self._get_or_create_data_set(img_rows, img_cols, dedup_threshold, nb_channel, roi)
+        return _set.get_case_folds(k, seed)
+
+    def cross_validate(self, params, k=5, n_epoch=1, n_jobs=1, seed=7):
+        '''
+        k fold cross validation (grouped by case) of a model configuration on the loaded data set
+        '''
+        from core.cross_validation import cross_validate
+        _set = self._get_or_create_data_set(int(params.get('img_rows', 200)), int(params.get('img_cols', 200)),
+                                            params.get('dedup_threshold'), int(params.get('nb_channel', 3)),
+                                            _as_bool(params.get('roi', False)))
+        _set._load()
+        return cross_validate(params, _set, k, n_epoch, n_jobs, seed)
+
+    def get_data_set_split_frames(self, img_rows, img_cols, train_ratio, dedup_threshold=None, nb_channel=3, roi=False):
+        _set = self._get_or_create_data_set(img_rows, img_cols, dedup_threshold, nb_channel, roi)
         return _set.get_data_set_split_frames(train_ratio)
 
-    def get_data_set_split_cases(self, img_rows, img_cols, train_ratio):
-        _set = self._get_or_create_data_set(img_rows, img_cols)
+    def get_data_set_split_cases(self, img_rows, img_cols, train_ratio, dedup_threshold=None, nb_channel=3, roi=False):
+        _set = self._get_or_create_data_set(img_rows, img_cols, dedup_threshold, nb_channel, roi)
         return _set.get_data_set_split_cases(train_ratio)
 
-    def get_categories(self, img_rows, img_cols):
-        _set = self._get_or_create_data_set(img_rows, img_cols)
+    def get_categories(self, img_rows, img_cols, dedup_threshold=None, nb_channel=3, roi=False):
+        _set = self._get_or_create_data_set(img_rows, img_cols, dedup_threshold, nb_channel, roi)
         return _set.categories
 
-    def get_adaptation_dataset(self, img_rows, img_cols):
-        _set = self._get_or_create_data_set(img_rows, img_cols)
-        return _set.adaptation_dataset
\ No newline at end of file
+    def get_adaptation_dataset(self, img_rows, img_cols, dedup_threshold=None, nb_channel=3, roi=False):
+        _set = self._get_or_create_data_set(img_rows, img_cols, dedup_threshold, nb_channel, roi)
+        return _set.adaptation_dataset
+
+    def get_random_frame(self, img_rows, img_cols, stratify='case', dedup_threshold=None, nb_channel=3, roi=False):
+        _set = self._get_or_create_data_set(img_rows, img_cols, dedup_threshold, nb_channel, roi)
+        return _set.get_random_frame(stratify)
+
+    def memory_usage(self):
+        '''
+        Bytes of frames held in memory for every loaded data set
+        '''
+        usage = {}
+        for _set in self.data_sets:
+            key = '%sX%s%s' % (_set.img_rows, _set.img_cols, _set.variant)
+            usage[key] = _set.memory_usage()
+        return usage
+
+
+registry.gauge('dataset_memory_bytes', 'Bytes of frames loaded in memory by data set',
+               fn=lambda: DataSetManager().memory_usage(), label='data_set')
@@ -0,0 +1,106 @@
+'''
+Cached output of the first conv + ReLU + max pool block, for training with a frozen Gabor layer.
+
+The block is computed once per (data set, layer 1 weights, pool size) with the NumPy engine and kept as a
+float16 .npy in feature_cache/, training reads it memory mapped batch by batch. The key hashes the
+layer 1 weights themselves, so any change of the Gabor params gets its own features. The directory is bounded
+in bytes (REFLUX_FEATURE_CACHE_MB): after a write the least recently used files are removed, a process that
+still has one of them memory mapped keeps reading it.
+'''
+import os
+import json
+import hashlib
+import numpy as np
+
+from core.numpy_engine import conv2d_same, relu, max_pool
+from core.preprocessing import normalize
+from manage import ROOT_DIR
+
+FEATURE_CACHE_DIR = os.path.join(ROOT_DIR, 'feature_cache')
+FEATURE_DTYPE = np.float16
+BLOCK_BATCH_SIZE = 64
+FEATURE_CACHE_MAX_BYTES = int(os.environ.get('REFLUX_FEATURE_CACHE_MB', '4096')) * 1024 * 1024
+
+
+def feature_key(data_set, kernel, bias, pool_size, backend):
+    digest = hashlib.sha1(json.dumps([data_set.name, [path for path, category, case in data_set.frame_index],
+                                      list(pool_size), backend]))
+    digest.update(np.ascontiguousarray(kernel, dtype=np.float32).data)
+    digest.update(np.ascontiguousarray(bias, dtype=np.float32).data)
+    return digest.hexdigest()
+
+
+def block1_features(data_set, kernel, bias, pool_size, backend='theano', cache_dir=FEATURE_CACHE_DIR,
+                    max_bytes=FEATURE_CACHE_MAX_BYTES):
+    '''
+    Read only memmap (n, filters, rows / pool, cols / pool) of the first block on every frame of data_set,
+    row i belongs to data_set.frames[i]
+    '''
+    data_set._load()
+    path = os.path.join(cache_dir, feature_key(data_set, kernel, bias, pool_size, backend) + '.npy')
+    if not os.path.exists(path):
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        n, c, h, w = data_set.frames.shape
+        shape = (n, kernel.shape[3], h // pool_size[0], w // pool_size[1])
+        print '\nStart compute layer 1 features %s' % (shape,)
+        tmp_path = path + '.tmp'
+        features = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=FEATURE_DTYPE, shape=shape)
+        for start in xrange(0, n, BLOCK_BATCH_SIZE):
+            x = conv2d_same(normalize(data_set.frames[start:start + BLOCK_BATCH_SIZE]), kernel, bias, backend)
+            features[start:start + BLOCK_BATCH_SIZE] = max_pool(relu(x), pool_size)
+        features.flush()
+        del features
+        os.rename(tmp_path, path)
+        print '\nFinish compute layer 1 features'
+        evict(cache_dir, max_bytes, keep=path)
+    else:
+        # the mtime is the last use, atime is not updated on every mount
+        os.utime(path, None)
+    return np.load(path, mmap_mode='r')
+
+
+def evict(cache_dir, max_bytes, keep=None):
+    '''
+    Remove the least recently used feature files until cache_dir holds at most max_bytes, never keep
+    '''
+    entries = []
+    for _file in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, _file)
+        if not _file.endswith('.npy') or path == keep:
+            continue
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries) + (os.path.getsize(keep) if keep else 0)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass  # removed by another process
+        total -= size
+
+
+def iterate_feature_batches(features, labels, idx, batch_size, nb_classes, seed=7):
+    '''
+    Endless shuffled (x, y) batches of the features rows idx, for fit_generator
+    '''
+    rng = np.random.RandomState(seed)
+    while True:
+        order = rng.permutation(idx)
+        for start in xrange(0, len(order), batch_size):
+            # sorted rows read the memmap forward
+            batch = np.sort(order[start:start + batch_size])
+            yield features[batch].astype(np.float32), np.eye(nb_classes, dtype='float32')[labels[batch]]
+
+
+def predict_feature_classes(model, features, idx, batch_size):
+    pred = []
+    for start in xrange(0, len(idx), batch_size):
+        x = features[idx[start:start + batch_size]].astype(np.float32)
+        pred.append(np.argmax(model.predict(x, verbose=0), axis=1))
+    return np.concatenate(pred) if pred else np.array([], dtype=np.int64)
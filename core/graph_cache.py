@@ -0,0 +1,105 @@
+'''
+Cache of compiled models between trials with the same layer shapes.
+
+Building and compiling the Theano graph of a trial can take longer than a one epoch screening run,
+while most trials of a plan differ only in the Gabor params, the dropout rate or the batch size.
+A CNN takes a compiled model of its shapes from the cache (CNN._build_model), re-initializes the weights
+and the optimizer state and sets its own dropout rate, and gives it back with CNN.release_model.
+A cached model is used by one CNN at a time.
+'''
+import threading
+import numpy as np
+from collections import OrderedDict
+import keras.backend as K
+from keras.layers.core import Dropout
+
+from utils.metrics import registry
+from utils.singleton import singleton
+
+MAX_CACHED_GRAPHS = 8
+
+graph_cache_requests = registry.counter('cnn_graph_cache_requests_total', 'Compiled graph cache lookups by result')
+
+
+class VariableDropout(Dropout):
+    '''
+    Dropout with the rate in a shared variable, a compiled graph takes a new rate by set_rate
+    '''
+    def __init__(self, rate, **kwargs):
+        super(VariableDropout, self).__init__(rate, **kwargs)
+        self.rate_variable = K.variable(rate)
+        self.dropout_seed = np.random.randint(1, 10e6)
+
+    def set_rate(self, rate):
+        self.rate = rate
+        K.set_value(self.rate_variable, rate)
+
+    def call(self, inputs, training=None):
+        retain = 1. - self.rate_variable
+
+        def dropped_inputs():
+            return inputs * K.random_binomial(K.shape(inputs), p=retain, seed=self.dropout_seed) / retain
+        return K.in_train_phase(dropped_inputs, inputs, training=training)
+
+
+def reset_optimizer(model):
+    '''
+    Zero the optimizer state (iterations and moments) so the next trial starts like a new model
+    '''
+    K.batch_set_value([(w, np.zeros_like(K.get_value(w))) for w in model.optimizer.weights])
+
+
+@singleton
+class GraphCache(object):
+    def __init__(self, max_graphs=MAX_CACHED_GRAPHS):
+        self.max_graphs = max_graphs
+        self._free = OrderedDict()  # key -> [model], least recently released first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def acquire(self, key):
+        '''
+        A free compiled model of key, None when there is none
+        '''
+        with self._lock:
+            models = self._free.get(key)
+            if models:
+                model = models.pop()
+                if not models:
+                    del self._free[key]
+                self.hits += 1
+                graph_cache_requests.inc(result='hit')
+                return model
+            self.misses += 1
+            graph_cache_requests.inc(result='miss')
+            return None
+
+    def release(self, key, model):
+        with self._lock:
+            self._free.setdefault(key, []).append(model)
+            # release moves the key to the end, evict the least recently used graphs
+            self._free[key] = self._free.pop(key)
+            while sum(len(m) for m in self._free.values()) > self.max_graphs:
+                oldest = next(iter(self._free))
+                self._free[oldest].pop(0)
+                if not self._free[oldest]:
+                    del self._free[oldest]
+
+    def clear(self):
+        with self._lock:
+            self._free.clear()
+
+    def get_stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / requests if requests else 0.,
+                'cached_graphs': sum(len(m) for m in self._free.values())
+            }
+
+
+registry.gauge('cnn_graph_cache_hit_rate', 'Share of the models that reused a compiled graph',
+               fn=lambda: GraphCache().get_stats()['hit_rate'])
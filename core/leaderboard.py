@@ -0,0 +1,194 @@
+'''
+Leaderboard of the saved models on a common holdout.
+
+    python -m core.leaderboard --jobs 4 --output leaderboard.json
+
+The con_mat_val of the models come from different splits, here every model is evaluated on the same
+frames: the validation cases of a split by case with HOLDOUT_TRAIN_RATIO, one holdout for every data set
+(resolution and build options). The holdouts are loaded once in the parent, with --jobs the models run
+in fresh worker processes (core.worker_pool) that memory map them. A worker loads a model, predicts the
+holdout in batches, and releases the model before the next one. The table is ranked by F1 on the holdout.
+
+A model trained on a split by frames, or by case with a larger train ratio, saw some of its holdout
+cases, 'clean' is False for it.
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import traceback
+import numpy as np
+from sklearn.metrics import confusion_matrix
+
+from core.data_set_manager import _as_bool
+from core.preprocessing import normalize
+from core.worker_pool import SharedDataSet, run_tasks
+from manage import ROOT_DIR
+
+MODELS_DIR = os.path.join(ROOT_DIR, 'cnn_models')
+HOLDOUT_TRAIN_RATIO = 0.5
+BATCH_SIZE = 64
+TASKS_PER_WORKER = 10  # models a worker process evaluates before it exits, the memory it held is freed
+
+
+def read_model_config(model_name, models_dir=MODELS_DIR):
+    with open(os.path.join(models_dir, model_name + '.json'), 'rb') as _input:
+        return json.loads(_input.read())
+
+
+def data_set_key(config):
+    '''
+    (img_rows, img_cols, dedup_threshold, nb_channel, roi), the data set of a model config
+    '''
+    return (int(config.get('img_rows', 200)), int(config.get('img_cols', 200)), config.get('dedup_threshold'),
+            int(config.get('nb_channel', 3)), _as_bool(config.get('roi', False)))
+
+
+def holdout_clean(config):
+    '''
+    True when the model of config was trained on a split by case with at most HOLDOUT_TRAIN_RATIO, it never
+    saw the holdout cases
+    '''
+    return _as_bool(config.get('split_cases', True)) and float(config.get('train_ratio', 0.5)) <= HOLDOUT_TRAIN_RATIO
+
+
+def load_holdout(key):
+    '''
+    (data set, sorted holdout frame indices) of a data set key
+    '''
+    from core.cnn import data_set_manager
+
+    img_rows, img_cols, dedup_threshold, nb_channel, roi = key
+    data_set = data_set_manager.get_data_set(img_rows, img_cols, dedup_threshold=dedup_threshold,
+                                             nb_channel=nb_channel, roi=roi)
+    train_idx, test_idx = data_set.split_cases_indices(HOLDOUT_TRAIN_RATIO)
+    return data_set, np.sort(test_idx)
+
+
+def evaluate_model(model_name, data_set, idx, batch_size=BATCH_SIZE):
+    from core.cnn import CNN, calculate_score
+
+    start = time.time()
+    cnn = CNN({'model_name': model_name}, True)
+    load_time = time.time() - start
+    try:
+        pred = []
+        start = time.time()
+        for i in xrange(0, len(idx), batch_size):
+            pred.append(np.argmax(cnn.predict_proba(normalize(data_set.frames[idx[i:i + batch_size]])), axis=1))
+        predict_time = time.time() - start
+    finally:
+        cnn.release_model()
+    y_pred = np.concatenate(pred) if pred else np.array([], dtype=np.int64)
+    con_mat = [int(v) for v in confusion_matrix(data_set.labels[idx], y_pred, labels=[0, 1]).ravel()]
+    return {
+        'model_name': model_name,
+        'data_set': data_set.name,
+        'frames': len(idx),
+        'con_mat': con_mat,
+        'f1': calculate_score(con_mat),
+        'frames_per_sec': len(idx) / predict_time if predict_time else 0.,
+        'load_time': load_time
+    }
+
+
+def _evaluate(model_name, data_set, idx, batch_size):
+    try:
+        return evaluate_model(model_name, data_set, idx, batch_size)
+    except Exception as e:
+        print traceback.format_exc()
+        return {'model_name': model_name, 'error': e.message or repr(e)}
+
+
+def _evaluate_worker(shared, task):
+    '''
+    core.worker_pool task, the holdout j is the arrays frames_j and labels_j
+    '''
+    model_name, j = task
+    arrays, config = shared['arrays'], shared['config']
+    data_set = SharedDataSet(arrays['frames_%s' % (j,)], arrays['labels_%s' % (j,)], name=config['names'][j])
+    return _evaluate(model_name, data_set, np.arange(len(data_set.labels)), config['batch_size'])
+
+
+def build_leaderboard(model_names=None, models_dir=MODELS_DIR, n_jobs=1, batch_size=BATCH_SIZE,
+                      tasks_per_worker=TASKS_PER_WORKER):
+    '''
+    (ranked results, failed results) of the models (all the saved models by default)
+    '''
+    if model_names is None:
+        model_names = sorted(f[:-len('.json')] for f in os.listdir(models_dir) if f.endswith('.json'))
+    tasks, failed, clean = [], [], {}
+    for name in model_names:
+        try:
+            config = read_model_config(name, models_dir)
+            tasks.append((name, data_set_key(config)))
+            clean[name] = holdout_clean(config)
+        except Exception as e:
+            failed.append({'model_name': name, 'error': e.message or repr(e)})
+    holdouts = {}
+    for key in set(key for name, key in tasks):
+        try:
+            holdouts[key] = load_holdout(key)
+        except Exception as e:
+            print traceback.format_exc()
+            failed.extend({'model_name': name, 'error': 'holdout: %s' % (e.message or repr(e),)}
+                          for name, _key in tasks if _key == key)
+    # a data set at a time, the holdout of a resolution is read once for all its models
+    tasks = sorted((task for task in tasks if task[1] in holdouts), key=lambda task: (task[1], task[0]))
+    if n_jobs > 1:
+        keys = sorted(holdouts)
+        arrays = {}
+        for j, key in enumerate(keys):
+            data_set, idx = holdouts[key]
+            arrays['frames_%s' % (j,)], arrays['labels_%s' % (j,)] = data_set.frames[idx], data_set.labels[idx]
+        results = run_tasks('core.leaderboard:_evaluate_worker', [(name, keys.index(key)) for name, key in tasks],
+                            arrays, {'names': [holdouts[key][0].name for key in keys], 'batch_size': batch_size},
+                            n_jobs=n_jobs, tasks_per_worker=tasks_per_worker)
+        # a worker that crashed did not name its models
+        for (name, key), result in zip(tasks, results):
+            result.setdefault('model_name', name)
+    else:
+        results = [_evaluate(name, holdouts[key][0], holdouts[key][1], batch_size) for name, key in tasks]
+    failed.extend(r for r in results if 'error' in r)
+    ranked = sorted((r for r in results if 'error' not in r), key=lambda r: (-r['f1'], r['model_name']))
+    for rank, result in enumerate(ranked, 1):
+        result['rank'] = rank
+        result['clean'] = clean[result['model_name']]
+    return ranked, failed
+
+
+def format_table(ranked):
+    lines = ['%4s  %-32s %-24s %7s  %-24s %10s  %s' % ('rank', 'model', 'data set', 'f1', 'tn, fp, fn, tp',
+                                                       'frames/s', 'clean')]
+    for r in ranked:
+        lines.append('%4s  %-32s %-24s %7.4f  %-24s %10.1f  %s' % (
+            r['rank'], r['model_name'], r['data_set'], r['f1'], ', '.join(str(v) for v in r['con_mat']),
+            r['frames_per_sec'], 'yes' if r['clean'] else 'no'))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='rank the saved models on a common holdout')
+    parser.add_argument('--models', help='comma separated model names, all the saved models by default')
+    parser.add_argument('--jobs', type=int, default=1, help='worker processes')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--tasks-per-worker', type=int, default=TASKS_PER_WORKER)
+    parser.add_argument('--output', help='write the leaderboard as json')
+    args = parser.parse_args(argv)
+
+    model_names = args.models.split(',') if args.models else None
+    ranked, failed = build_leaderboard(model_names, n_jobs=args.jobs, batch_size=args.batch_size,
+                                       tasks_per_worker=args.tasks_per_worker)
+    print format_table(ranked)
+    for result in failed:
+        print 'failed %s: %s' % (result['model_name'], result['error'])
+    if args.output:
+        with open(args.output, 'wb') as output:
+            output.write(json.dumps({'holdout_train_ratio': HOLDOUT_TRAIN_RATIO, 'models': ranked, 'failed': failed},
+                                    sort_keys=True, indent=4, separators=(',', ': ')))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,157 @@
+'''
+Forward pass of the CNN._build_model architecture with NumPy only.
+
+Serving a model through this module does not import Keras/Theano and does not compile a graph,
+the weights are exported once with export_model (or CNN.export_numpy) into a small .npz file.
+'''
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from core.preprocessing import DEFAULT_CROP_BOX, ROI_AUTO, normalize, preprocess_batch
+
+# upper bound for the im2col buffer of a single convolution call
+MAX_IM2COL_BYTES = 64 * 1024 * 1024
+
+_CONV_LAYERS = ('conv1', 'conv2')
+_DENSE_LAYERS = ('dense1', 'dense2')
+
+
+def export_model(cnn, path=None, backend='theano'):
+    '''
+    Write the weights and the shape params of a CNN into a .npz file, return the file path
+    '''
+    path = path or cnn.model_path + '.npz'
+    conv = [l for l in cnn.model.layers if l.__class__.__name__ == 'Conv2D']
+    dense = [l for l in cnn.model.layers if l.__class__.__name__ == 'Dense']
+    if len(conv) != len(_CONV_LAYERS) or len(dense) != len(_DENSE_LAYERS):
+        raise Exception('Model %s does not match the exported architecture.' % (cnn.model_name,))
+    arrays = {}
+    for name, layer in zip(_CONV_LAYERS + _DENSE_LAYERS, conv + dense):
+        kernel, bias = layer.get_weights()
+        arrays[name + '_kernel'] = kernel.astype(np.float32)
+        arrays[name + '_bias'] = bias.astype(np.float32)
+    with open(path, 'wb') as output:
+        np.savez(output,
+                 img_rows=cnn.img_rows,
+                 img_cols=cnn.img_cols,
+                 nb_channel=cnn.nb_channel,
+                 pool_size=np.array(cnn.pool_size),
+                 activation_function=cnn.activation_function,
+                 category=np.array(cnn.category),
+                 roi=cnn.roi,
+                 global_pool=cnn.global_pool,
+                 backend=backend,
+                 **arrays)
+    return path
+
+
+def conv2d_same(x, kernel, bias, backend='theano'):
+    '''
+    Keras Conv2D(padding='same') on channels first input.
+    kernel has the keras layout (rows, cols, input_depth, filters).
+    Theano runs a real convolution (flipped kernel) and pads even kernels one more pixel on the top/left,
+    tensorflow runs a correlation and pads one more on the bottom/right.
+    '''
+    n, c, h, w = x.shape
+    kh, kw, _, filters = kernel.shape
+    if backend == 'theano':
+        kernel = kernel[::-1, ::-1]
+        top, left = kh // 2, kw // 2
+    else:
+        top, left = (kh - 1) // 2, (kw - 1) // 2
+    xp = np.pad(x, ((0, 0), (0, 0), (top, kh - 1 - top), (left, kw - 1 - left)), 'constant')
+    # (c, kh, kw, filters) matches the order of the im2col columns
+    weights = np.ascontiguousarray(kernel.transpose(2, 0, 1, 3)).reshape(c * kh * kw, filters)
+
+    out = np.empty((n, filters, h, w), dtype=np.float32)
+    chunk = max(1, MAX_IM2COL_BYTES // (h * w * c * kh * kw * xp.itemsize))
+    for start in xrange(0, n, chunk):
+        part = xp[start:start + chunk]
+        s = part.strides
+        patches = as_strided(part,
+                             shape=(part.shape[0], h, w, c, kh, kw),
+                             strides=(s[0], s[2], s[3], s[1], s[2], s[3]))
+        cols = patches.reshape(part.shape[0] * h * w, c * kh * kw)
+        res = cols.dot(weights) + bias
+        out[start:start + chunk] = res.reshape(part.shape[0], h, w, filters).transpose(0, 3, 1, 2)
+    return out
+
+
+def relu(x):
+    return np.maximum(x, 0, out=x)
+
+
+def max_pool(x, pool_size):
+    '''
+    MaxPooling2D with padding='valid' and strides equal to the pool size
+    '''
+    ph, pw = pool_size
+    n, c, h, w = x.shape
+    h2, w2 = h // ph, w // pw
+    return x[:, :, :h2 * ph, :w2 * pw].reshape(n, c, h2, ph, w2, pw).max(axis=5).max(axis=3)
+
+
+def activation(x, name):
+    if name == 'softmax':
+        e = np.exp(x - x.max(axis=1, keepdims=True))
+        return e / e.sum(axis=1, keepdims=True)
+    if name == 'sigmoid':
+        return 1. / (1. + np.exp(-x))
+    if name == 'relu':
+        return relu(x)
+    raise Exception('Unknown activation %s' % (name,))
+
+
+class NumpyCNN(object):
+    def __init__(self, path):
+        data = np.load(path)
+        self.img_rows = int(data['img_rows'])
+        self.img_cols = int(data['img_cols'])
+        self.nb_channel = int(data['nb_channel'])
+        self.pool_size = tuple(int(p) for p in data['pool_size'])
+        self.activation_function = str(data['activation_function'])
+        self.category = [str(c) for c in data['category']]
+        self.backend = str(data['backend'])
+        self.roi = bool(data['roi']) if 'roi' in data.files else False
+        self.global_pool = bool(data['global_pool']) if 'global_pool' in data.files else False
+        self.weights = {k: data[k] for k in data.files if k.endswith('_kernel') or k.endswith('_bias')}
+
+    def conv(self, x, name):
+        return conv2d_same(x, self.weights[name + '_kernel'], self.weights[name + '_bias'], self.backend)
+
+    def dense(self, x, name):
+        return x.dot(self.weights[name + '_kernel']) + self.weights[name + '_bias']
+
+    def block(self, x, name):
+        '''
+        Conv2D + ReLU + MaxPooling2D
+        '''
+        return max_pool(relu(self.conv(x, name)), self.pool_size)
+
+    def predict_proba(self, x):
+        '''
+        x is a (n, nb_channel, img_rows, img_cols) batch, uint8 batches are normalized like the training set
+        '''
+        if x.dtype == np.uint8:
+            x = normalize(x)
+        for name in _CONV_LAYERS:
+            x = self.block(x, name)
+        if self.global_pool:
+            x = x.mean(axis=(2, 3))
+        else:
+            x = x.reshape(x.shape[0], -1)
+        x = relu(self.dense(x, 'dense1'))
+        x = self.dense(x, 'dense2')
+        return activation(x, self.activation_function)
+
+    def predict_batch(self, frames, source=None, prepared=False):
+        if prepared:
+            crop_box = None
+        else:
+            crop_box = ROI_AUTO if self.roi else DEFAULT_CROP_BOX
+        pred = self.predict_proba(preprocess_batch(frames, self.img_rows, self.img_cols, self.nb_channel, crop_box,
+                                                   source=source))
+        return [self.category[0] if p[0] > p[1] else self.category[1] for p in pred]
+
+    def predict(self, frame, prepared=False):
+        return self.predict_batch([frame], prepared=prepared)[0]
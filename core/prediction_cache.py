@@ -0,0 +1,174 @@
+'''
+LRU cache of frame predictions.
+
+An entry is keyed on the hash of the frame bytes, the model name and the version of the model weights
+(CNN.weights_version), so new best weights never see the entries of the old ones. The memory part is
+bounded in bytes, with a path the entries are also kept in a SQLite file and survive a restart.
+'''
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from utils.metrics import registry
+
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+MAX_DISK_ENTRIES = 1000000
+ENTRY_OVERHEAD = 256  # bytes of a key, the dict slot and the array header
+
+prediction_cache_requests = registry.counter('cnn_prediction_cache_requests_total',
+                                             'Prediction cache lookups by result')
+
+
+def frame_digest(frame):
+    '''
+    Hash of a frame as it was given: the uploaded / file bytes, or the array data
+    '''
+    digest = hashlib.sha1()
+    if isinstance(frame, np.ndarray):
+        digest.update('%s%s' % (frame.dtype.str, frame.shape))
+        digest.update(np.ascontiguousarray(frame).data)
+    elif isinstance(frame, basestring) and os.path.isfile(frame):
+        with open(frame, 'rb') as _input:
+            digest.update(_input.read())
+    else:
+        if hasattr(frame, 'read'):
+            if hasattr(frame, 'seek'):
+                frame.seek(0)
+            data = frame.read()
+            if hasattr(frame, 'seek'):
+                frame.seek(0)
+        else:
+            data = frame
+        digest.update(data)
+    return digest.hexdigest()
+
+
+class PredictionCache(object):
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, path=None):
+        self.max_bytes = max_bytes
+        self.path = path
+        self._entries = OrderedDict()  # key -> probabilities, least recently used first
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if path is not None:
+            with self._connect() as conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS predictions (key TEXT PRIMARY KEY, model TEXT, value TEXT)')
+                conn.execute('CREATE INDEX IF NOT EXISTS predictions_model ON predictions (model)')
+
+    def configure(self, max_bytes=None, path=None):
+        self.__init__(max_bytes if max_bytes is not None else self.max_bytes, path)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    @staticmethod
+    def key(model_name, weights_version, digest, variant=''):
+        return '%s|%s|%s|%s' % (model_name, weights_version, variant, digest)
+
+    def _remember(self, key, value):
+        # the caller holds the lock
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key).nbytes + ENTRY_OVERHEAD
+        self._entries[key] = value
+        self._bytes += value.nbytes + ENTRY_OVERHEAD
+        while self._bytes > self.max_bytes and self._entries:
+            _, old = self._entries.popitem(last=False)
+            self._bytes -= old.nbytes + ENTRY_OVERHEAD
+
+    def get_many(self, keys):
+        '''
+        {key: probabilities} of the cached keys
+        '''
+        found = {}
+        with self._lock:
+            for key in keys:
+                value = self._entries.pop(key, None)
+                if value is not None:
+                    # back to the most recently used end
+                    self._entries[key] = value
+                    found[key] = value
+        missing = [k for k in keys if k not in found]
+        if missing and self.path is not None:
+            with self._connect() as conn:
+                for start in xrange(0, len(missing), 500):
+                    chunk = missing[start:start + 500]
+                    rows = conn.execute('SELECT key, value FROM predictions WHERE key IN (%s)' %
+                                        ','.join('?' * len(chunk)), chunk).fetchall()
+                    for key, value in rows:
+                        found[key] = np.array(json.loads(value), dtype=np.float32)
+            with self._lock:
+                for key in missing:
+                    if key in found:
+                        self._remember(key, found[key])
+        hits = len([k for k in keys if k in found])
+        with self._lock:
+            self.hits += hits
+            self.misses += len(keys) - hits
+        if hits:
+            prediction_cache_requests.inc(hits, result='hit')
+        if len(keys) - hits:
+            prediction_cache_requests.inc(len(keys) - hits, result='miss')
+        return found
+
+    def put_many(self, model_name, items):
+        '''
+        items is [(key, probabilities)]
+        '''
+        with self._lock:
+            for key, value in items:
+                self._remember(key, np.asarray(value, dtype=np.float32))
+        if self.path is not None and items:
+            with self._connect() as conn:
+                conn.executemany('INSERT OR REPLACE INTO predictions (key, model, value) VALUES (?, ?, ?)',
+                                 [(key, model_name, json.dumps(np.asarray(value).tolist())) for key, value in items])
+                count = conn.execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+                if count > MAX_DISK_ENTRIES:
+                    conn.execute('DELETE FROM predictions WHERE rowid IN '
+                                 '(SELECT rowid FROM predictions ORDER BY rowid LIMIT ?)', (count - MAX_DISK_ENTRIES,))
+
+    def invalidate(self, model_name):
+        '''
+        Drop the entries of a model, called when the model gets new weights
+        '''
+        prefix = model_name + '|'
+        with self._lock:
+            for key in [k for k in self._entries if k.startswith(prefix)]:
+                self._bytes -= self._entries.pop(key).nbytes + ENTRY_OVERHEAD
+        if self.path is not None:
+            with self._connect() as conn:
+                conn.execute('DELETE FROM predictions WHERE model = ?', (model_name,))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        if self.path is not None:
+            with self._connect() as conn:
+                conn.execute('DELETE FROM predictions')
+
+    def get_stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / requests if requests else 0.,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes
+            }
+
+
+prediction_cache = PredictionCache()
+
+registry.gauge('cnn_prediction_cache_bytes', 'Memory held by the prediction cache',
+               fn=lambda: prediction_cache.get_stats()['bytes'])
+registry.gauge('cnn_prediction_cache_hit_rate', 'Share of the predicted frames served from the cache',
+               fn=lambda: prediction_cache.get_stats()['hit_rate'])
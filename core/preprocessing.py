@@ -0,0 +1,137 @@
+import os
+import cv2
+import numpy as np
+from PIL import Image
+from PIL.Image import LANCZOS
+
+from core.roi import roi_cache, sample_indices
+
+# The box cut_image takes out of the raw ultrasound video frames
+DEFAULT_CROP_BOX = (560, 140, 1360, 940)
+# crop_box of preprocess_batch: the box detected on the frames (core.roi), cached per source
+ROI_AUTO = 'auto'
+
+RESIZE_LANCZOS = 'lanczos'  # PIL LANCZOS, what every existing adaptation data set was built with
+RESIZE_CV2 = 'cv2'  # cv2 INTER_AREA, much faster on big frames
+RESIZE_METHOD = RESIZE_LANCZOS
+
+
+def load_image(src):
+    '''
+    Decode an image into an RGB uint8 array of shape (rows, cols, 3).
+    src can be a path, a file like object (e.g. django UploadedFile), raw bytes or an array.
+    '''
+    if isinstance(src, np.ndarray):
+        img = src
+    else:
+        if isinstance(src, basestring) and os.path.isfile(src):
+            img = cv2.imread(src, cv2.IMREAD_UNCHANGED)
+        else:
+            if hasattr(src, 'read'):
+                if hasattr(src, 'seek'):
+                    src.seek(0)
+                src = src.read()
+            img = cv2.imdecode(np.frombuffer(src, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        if img is None:
+            raise Exception('Can not decode image.')
+        if img.ndim == 3 and img.shape[2] == 4:
+            img = cv2.cvtColor(img, cv2.COLOR_BGRA2RGB)
+        elif img.ndim == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    if img.ndim == 2:
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
+    elif img.shape[2] == 4:
+        img = img[:, :, :3]
+    return img
+
+
+def crop_frame(img, crop_box=DEFAULT_CROP_BOX):
+    '''
+    Crop a (rows, cols, channels) array with a PIL style (left, upper, right, lower) box.
+    Frames that do not contain the box (already cut frames) are returned as is.
+    '''
+    left, upper, right, lower = crop_box
+    if img.shape[0] < lower or img.shape[1] < right:
+        return img
+    return img[upper:lower, left:right]
+
+
+def resize_frame(img, img_rows, img_cols, method=None):
+    method = method or RESIZE_METHOD
+    if img.shape[0] == img_rows and img.shape[1] == img_cols:
+        return img
+    if method == RESIZE_CV2:
+        return cv2.resize(img, (img_cols, img_rows), interpolation=cv2.INTER_AREA)
+    if method == RESIZE_LANCZOS:
+        return np.array(Image.fromarray(img).resize((img_cols, img_rows), resample=LANCZOS))
+    raise Exception('Unknown resize method %s' % (method,))
+
+
+def to_grayscale(img):
+    if img.ndim == 2:
+        return img
+    return cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+
+
+def to_channels_first(img, nb_channel=3):
+    '''
+    (rows, cols, channels) or (rows, cols) grayscale -> (nb_channel, rows, cols) uint8
+    '''
+    if nb_channel == 1:
+        return np.ascontiguousarray(to_grayscale(img)[np.newaxis], dtype=np.uint8)
+    return np.ascontiguousarray(img[:, :, :nb_channel].transpose(2, 0, 1), dtype=np.uint8)
+
+
+def normalize(x):
+    '''
+    uint8 frames -> float32 in [0, 1], the way the training sets are normalized
+    '''
+    x = x.astype('float32')
+    x /= 255
+    return x
+
+
+def prepare_frame(img, img_rows, img_cols, crop_box=DEFAULT_CROP_BOX, method=None, nb_channel=3):
+    '''
+    Crop and resize a decoded frame, this is the step the adaptation data set is built with.
+    With nb_channel=1 the frame is converted to grayscale before the resize and is (rows, cols).
+    '''
+    if crop_box is not None:
+        img = crop_frame(img, crop_box)
+    if nb_channel == 1:
+        img = to_grayscale(img)
+    return resize_frame(img, img_rows, img_cols, method)
+
+
+def preprocess_frame(src, img_rows, img_cols, nb_channel=3, crop_box=DEFAULT_CROP_BOX, method=None):
+    '''
+    Any frame -> channels first uint8 array of shape (nb_channel, img_rows, img_cols)
+    '''
+    img = prepare_frame(load_image(src), img_rows, img_cols, crop_box, method, nb_channel)
+    return to_channels_first(img, nb_channel)
+
+
+def roi_crop_box(imgs, source=None):
+    '''
+    Crop box of the active region of decoded frames, detected on a sample of the frames of the most
+    common size. With a source the box is cached, the next batches of the source are not analyzed.
+    '''
+    shapes = [img.shape[:2] for img in imgs]
+    shape = max(set(shapes), key=shapes.count)
+    same_size = [img for img in imgs if img.shape[:2] == shape]
+    box = roi_cache.get_or_detect(source, lambda: [same_size[i] for i in sample_indices(len(same_size))])
+    return box if box is not None else DEFAULT_CROP_BOX
+
+
+def preprocess_batch(frames, img_rows, img_cols, nb_channel=3, crop_box=DEFAULT_CROP_BOX, method=None, source=None):
+    '''
+    List of frames -> uint8 tensor of shape (len(frames), nb_channel, img_rows, img_cols).
+    crop_box=ROI_AUTO crops the region detected on the frames (cached for source).
+    '''
+    if crop_box == ROI_AUTO:
+        frames = [load_image(frame) for frame in frames]
+        crop_box = roi_crop_box(frames, source) if frames else DEFAULT_CROP_BOX
+    batch = np.empty((len(frames), nb_channel, img_rows, img_cols), dtype=np.uint8)
+    for i, frame in enumerate(frames):
+        batch[i] = preprocess_frame(frame, img_rows, img_cols, nb_channel, crop_box, method)
+    return batch
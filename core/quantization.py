@@ -0,0 +1,208 @@
+'''
+Post-training int8 quantization of a saved model for CPU inference with the NumPy engine.
+
+    python -m core.quantization <model_name> --calibration 256 --output report.json
+
+The conv and dense kernels are stored as int8 with one scale per output channel, the biases stay float32.
+Every layer input is non negative (pixels, ReLU and max pool outputs) and is quantized to uint8 with a
+scale calibrated on frames of the train split of the model's adaptation data set. The first layer gets
+the frames themselves, so it sees no input error. The report compares the float and int8 engines on the
+validation split: confusion matrix, F1 (calculate_score), latency and weight memory.
+
+The gain is weight memory (the dense kernel is most of the model), not latency: NumPy has no int8 GEMM,
+the products are float32 like the float engine and the dense kernel tiles are converted on every call.
+'''
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+from core.numpy_engine import _CONV_LAYERS, _DENSE_LAYERS, NumpyCNN, conv2d_same
+
+QUANTIZED_EXTENSION = '.int8.npz'
+CALIBRATION_SIZE = 256
+CALIBRATION_PERCENTILE = 99.99  # larger activations are clipped, outliers would waste the uint8 range
+DENSE_TILE_ROWS = 4096  # kernel rows converted to float32 at a time
+
+
+def quantize_per_channel(kernel):
+    '''
+    (int8 kernel, float32 scale per output channel) of a keras kernel, the output channels are the last axis
+    '''
+    axes = tuple(xrange(kernel.ndim - 1))
+    scale = (np.abs(kernel).max(axis=axes) / 127.).astype(np.float32)
+    scale[scale == 0] = 1.
+    q = np.clip(np.round(kernel / scale), -127, 127).astype(np.int8)
+    return q, scale
+
+
+def quantize_input(x, scale):
+    return np.clip(np.round(x / scale), 0, 255).astype(np.uint8)
+
+
+class _RangeObserver(NumpyCNN):
+    '''
+    The float engine, recording the calibration range of every layer input
+    '''
+    def __init__(self, path):
+        super(_RangeObserver, self).__init__(path)
+        self.ranges = {}
+
+    def _observe(self, x, name):
+        value = float(np.percentile(x, CALIBRATION_PERCENTILE))
+        self.ranges[name] = max(self.ranges.get(name, 0.), value)
+
+    def conv(self, x, name):
+        self._observe(x, name)
+        return super(_RangeObserver, self).conv(x, name)
+
+    def dense(self, x, name):
+        self._observe(x, name)
+        return super(_RangeObserver, self).dense(x, name)
+
+
+def quantize(float_path, calibration, path=None, batch_size=32):
+    '''
+    Write the int8 model of an exported float model (numpy_engine.export_model), calibrated on
+    calibration, a uint8 (n, nb_channel, img_rows, img_cols) batch. Return the file path.
+    '''
+    path = path or float_path[:-len('.npz')] + QUANTIZED_EXTENSION
+    observer = _RangeObserver(float_path)
+    for start in xrange(0, len(calibration), batch_size):
+        observer.predict_proba(calibration[start:start + batch_size])
+    data = np.load(float_path)
+    arrays = {k: data[k] for k in data.files if not k.endswith('_kernel')}
+    for name in _CONV_LAYERS + _DENSE_LAYERS:
+        arrays[name + '_kernel_q'], arrays[name + '_kernel_scale'] = quantize_per_channel(data[name + '_kernel'])
+        arrays[name + '_input_scale'] = np.float32(max(observer.ranges.get(name, 0.), 1e-6) / 255.)
+    # the frames are uint8 already
+    arrays[_CONV_LAYERS[0] + '_input_scale'] = np.float32(1. / 255)
+    with open(path, 'wb') as output:
+        np.savez(output, **arrays)
+    return path
+
+
+class QuantizedCNN(NumpyCNN):
+    '''
+    NumpyCNN on int8 kernels and uint8 layer inputs. The products are accumulated in float32 and
+    rescaled per output channel. The small conv kernels are kept as float32 integer values, the dense
+    kernels are converted DENSE_TILE_ROWS rows at a time so the float32 copy of the big dense kernel
+    never exists.
+    '''
+    def __init__(self, path):
+        super(QuantizedCNN, self).__init__(path)
+        data = np.load(path)
+        self.quantized = {k: data[k] for k in data.files if k.endswith('_q') or k.endswith('_scale')}
+        for name in _CONV_LAYERS:
+            self.quantized[name + '_kernel_q'] = self.quantized[name + '_kernel_q'].astype(np.float32)
+
+    def _scales(self, name):
+        return self.quantized[name + '_input_scale'] * self.quantized[name + '_kernel_scale']
+
+    def conv(self, x, name):
+        q = quantize_input(x, self.quantized[name + '_input_scale']).astype(np.float32)
+        kernel = self.quantized[name + '_kernel_q']
+        x = conv2d_same(q, kernel, np.zeros(kernel.shape[3], dtype=np.float32), self.backend)
+        x *= self._scales(name)[np.newaxis, :, np.newaxis, np.newaxis]
+        x += self.weights[name + '_bias'][np.newaxis, :, np.newaxis, np.newaxis]
+        return x
+
+    def dense(self, x, name):
+        q = quantize_input(x, self.quantized[name + '_input_scale'])
+        kernel = self.quantized[name + '_kernel_q']
+        out = np.zeros((len(q), kernel.shape[1]), dtype=np.float32)
+        for start in xrange(0, kernel.shape[0], DENSE_TILE_ROWS):
+            out += q[:, start:start + DENSE_TILE_ROWS].astype(np.float32).dot(
+                kernel[start:start + DENSE_TILE_ROWS].astype(np.float32))
+        return out * self._scales(name) + self.weights[name + '_bias']
+
+
+def weights_bytes(engine):
+    arrays = engine.weights.values() + getattr(engine, 'quantized', {}).values()
+    return sum(a.nbytes for a in arrays)
+
+
+def evaluate(engine, frames, labels, batch_size=32):
+    '''
+    Confusion matrix [tn, fp, fn, tp], F1 and latency of an engine on uint8 frames
+    '''
+    from sklearn.metrics import confusion_matrix
+    from core.cnn import calculate_score
+
+    pred = []
+    start = time.time()
+    for i in xrange(0, len(frames), batch_size):
+        pred.append(np.argmax(engine.predict_proba(frames[i:i + batch_size]), axis=1))
+    seconds = time.time() - start
+    con_mat = [int(v) for v in confusion_matrix(labels, np.concatenate(pred), labels=[0, 1]).ravel()]
+    return {
+        'con_mat': con_mat,
+        'f1': calculate_score(con_mat),
+        'ms_per_frame': 1000. * seconds / len(frames) if len(frames) else 0.,
+        'weights_bytes': weights_bytes(engine)
+    }
+
+
+def quantize_model(model_name, nb_calibration=CALIBRATION_SIZE, nb_eval=None, batch_size=32, seed=7):
+    '''
+    Quantize a saved model into <model>.int8.npz and compare it with the float model on the
+    validation split of its data set. Return the report.
+    '''
+    from core.cnn import CNN, data_set_manager
+
+    cnn = CNN({'model_name': model_name}, _reload=True)
+    float_path = cnn.export_numpy()
+    cnn.release_model()
+    data_set = data_set_manager.get_data_set(cnn.img_rows, cnn.img_cols, **cnn.data_set_options)
+    train_idx, test_idx = data_set.get_split_indices(cnn.train_ratio, cnn.split_cases)
+    rng = np.random.RandomState(seed)
+    calibration_idx = np.sort(rng.choice(train_idx, min(nb_calibration, len(train_idx)), replace=False))
+    path = quantize(float_path, data_set.frames[calibration_idx], cnn.model_path + QUANTIZED_EXTENSION,
+                    batch_size)
+
+    if nb_eval is not None and nb_eval < len(test_idx):
+        test_idx = rng.choice(test_idx, nb_eval, replace=False)
+    test_idx = np.sort(test_idx)
+    frames, labels = data_set.frames[test_idx], data_set.labels[test_idx]
+    report = {
+        'model_name': model_name,
+        'path': path,
+        'calibration_frames': len(calibration_idx),
+        'eval_frames': len(test_idx),
+        'float': evaluate(NumpyCNN(float_path), frames, labels, batch_size),
+        'int8': evaluate(QuantizedCNN(path), frames, labels, batch_size)
+    }
+    report['f1_delta'] = report['int8']['f1'] - report['float']['f1']
+    report['speedup'] = report['float']['ms_per_frame'] / report['int8']['ms_per_frame'] \
+        if report['int8']['ms_per_frame'] else None
+    report['memory_ratio'] = float(report['float']['weights_bytes']) / report['int8']['weights_bytes']
+    report['note'] = 'int8 saves weight memory, the products are float32 and not faster than the float engine'
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='int8 quantization of a saved model')
+    parser.add_argument('model_name')
+    parser.add_argument('--calibration', type=int, default=CALIBRATION_SIZE, help='train frames to calibrate on')
+    parser.add_argument('--eval', type=int, help='validation frames to compare on, all by default')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--output', help='write the report as json')
+    args = parser.parse_args(argv)
+
+    report = quantize_model(args.model_name, args.calibration, args.eval, args.batch_size)
+    for name in ('float', 'int8'):
+        result = report[name]
+        print '%-6s con_mat %s  f1 %.4f  %.3f ms/frame  weights %.2f MB' % (
+            name, result['con_mat'], result['f1'], result['ms_per_frame'], result['weights_bytes'] / 1024. / 1024)
+    print report['note']
+    print 'f1 delta %+.4f  memory x%.2f  speedup x%.2f' % (report['f1_delta'], report['memory_ratio'],
+                                                            report['speedup'] or 0)
+    if args.output:
+        with open(args.output, 'wb') as output:
+            output.write(json.dumps(report, sort_keys=True, indent=4, separators=(',', ': ')))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
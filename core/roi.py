@@ -0,0 +1,110 @@
+'''
+Detection of the active ultrasound region of a video / case.
+
+The region is found on a sample of frames of the source at once: pixels that are bright on average and
+change between frames are active, the box is the longest run of rows and of columns with enough active
+pixels (black borders, and static text or scale bars beside the fan are left out). Boxes are cached per
+source in roi_cache.json, so a source is analyzed once.
+'''
+import os
+import json
+import threading
+import cv2
+import numpy as np
+
+from manage import ROOT_DIR
+
+ROI_CACHE_PATH = os.path.join(ROOT_DIR, 'roi_cache.json')
+ROI_SAMPLE = 32  # frames of a source the region is detected on
+INTENSITY_THRESHOLD = 12  # mean gray level of an active pixel
+VARIANCE_THRESHOLD = 2.  # std of an active pixel over the sample, when the sample is not a still image
+MIN_FRACTION = 0.05  # active pixels a row / column needs to be in the box
+MARGIN = 2  # pixels added around the detected box
+
+
+def sample_indices(n, size=ROI_SAMPLE):
+    if n <= size:
+        return range(n)
+    return [int(i) for i in np.linspace(0, n - 1, size)]
+
+
+def _longest_run(mask):
+    '''
+    (start, stop) of the longest run of True in a 1d mask, None when there is none
+    '''
+    padded = np.concatenate(([False], mask, [False])).astype(np.int8)
+    edges = np.flatnonzero(np.diff(padded))
+    if not len(edges):
+        return None
+    starts, stops = edges[0::2], edges[1::2]
+    best = np.argmax(stops - starts)
+    return int(starts[best]), int(stops[best])
+
+
+def detect_roi(frames, intensity_threshold=INTENSITY_THRESHOLD, variance_threshold=VARIANCE_THRESHOLD,
+               min_fraction=MIN_FRACTION, margin=MARGIN):
+    '''
+    PIL style (left, upper, right, lower) box of the active region of same size frames
+    ((rows, cols) or (rows, cols, channels) uint8 arrays), None when no region is found
+    '''
+    stack = np.stack([f if f.ndim == 2 else cv2.cvtColor(f[:, :, :3], cv2.COLOR_RGB2GRAY) for f in frames])
+    stack = stack.astype(np.float32)
+    active = stack.mean(axis=0) > intensity_threshold
+    if len(stack) > 1:
+        moving = stack.std(axis=0) > variance_threshold
+        # a still sample (a single repeated frame) has no moving pixels, the intensity decides alone
+        if moving.any():
+            active &= moving
+    rows = _longest_run(active.mean(axis=1) >= min_fraction)
+    cols = _longest_run(active.mean(axis=0) >= min_fraction)
+    if rows is None or cols is None:
+        return None
+    height, width = active.shape
+    return (max(0, cols[0] - margin), max(0, rows[0] - margin),
+            min(width, cols[1] + margin), min(height, rows[1] + margin))
+
+
+class RoiCache(object):
+    '''
+    source (a video, a case folder or a client given id) -> crop box, kept in a json file
+    '''
+    def __init__(self, path=ROI_CACHE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._boxes = None
+
+    def _read(self):
+        if self._boxes is None:
+            self._boxes = {}
+            if os.path.exists(self.path):
+                with open(self.path, 'rb') as _input:
+                    self._boxes = json.loads(_input.read())
+        return self._boxes
+
+    def get(self, source):
+        with self._lock:
+            box = self._read().get(source)
+            return tuple(box) if box is not None else None
+
+    def set(self, source, box):
+        with self._lock:
+            self._read()[source] = list(box)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'wb') as output:
+                output.write(json.dumps(self._boxes, sort_keys=True, indent=4, separators=(',', ': ')))
+            os.rename(tmp_path, self.path)
+
+    def get_or_detect(self, source, load_sample):
+        '''
+        The cached box of source, or detect_roi on load_sample() (a list of frames) and cache it.
+        None when no region is found, that is not cached.
+        '''
+        box = self.get(source) if source is not None else None
+        if box is None:
+            box = detect_roi(load_sample())
+            if box is not None and source is not None:
+                self.set(source, box)
+        return box
+
+
+roi_cache = RoiCache()
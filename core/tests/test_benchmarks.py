@@ -0,0 +1,12 @@
+from unittest import TestCase
+
+from core.benchmarks.suite import compare
+
+
+class TestBenchmarkCompare(TestCase):
+    def test_compare(self):
+        baseline = {'results': {'data_set_load': {'median': 1.0}, 'split_cases': {'median': 0.5}}}
+        current = {'results': {'data_set_load': {'median': 1.5}, 'split_cases': {'median': 0.55},
+                               'train_epoch': {'median': 3.0}}}
+        regressions = compare(current, baseline, tolerance=0.2)
+        self.assertEqual([r[0] for r in regressions], ['data_set_load'])
@@ -0,0 +1,35 @@
+from unittest import TestCase
+
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from core.benchmarks.synthetic import make_synthetic_dataset
+from core.data_set import DataSet
+from utils.prepare_dataset import reshape_images
+
+
+class TestCaseFolds(TestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        input_dataset_path = make_synthetic_dataset(self.root_dir, nb_cases=5, nb_frames=4, size=60)
+        reshape_images(input_dataset_path, os.path.join(self.root_dir, 'dataset_30X30_adaptation'), 30, 30, 4)
+        self.data_set = DataSet(30, 30, root_dir=self.root_dir)
+
+    def test_folds_grouped_by_case(self):
+        folds = self.data_set.get_case_folds(5)
+        self.assertEqual(self.data_set.frames.shape, (40, 3, 30, 30))
+        all_test = np.concatenate([test_idx for train_idx, test_idx in folds])
+        self.assertEqual(sorted(all_test), range(40))
+        for train_idx, test_idx in folds:
+            self.assertEqual(len(np.intersect1d(train_idx, test_idx)), 0)
+            self.assertEqual(len(train_idx) + len(test_idx), 40)
+            test_cases = set(self.data_set.frame_index[i][1:] for i in test_idx)
+            train_cases = set(self.data_set.frame_index[i][1:] for i in train_idx)
+            self.assertFalse(test_cases & train_cases)
+            # one case of every category in every test fold
+            self.assertEqual(sorted(c[0] for c in test_cases), ['negative', 'positive'])
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
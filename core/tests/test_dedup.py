@@ -0,0 +1,46 @@
+from unittest import TestCase
+
+import os
+import json
+import shutil
+import tempfile
+import numpy as np
+
+from core.benchmarks.synthetic import make_synthetic_dataset
+from core.data_set import DataSet
+from utils.prepare_dataset import reshape_images, select_distinct_frames
+
+
+class TestDedup(TestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        self.input_dataset_path = make_synthetic_dataset(self.root_dir, nb_cases=2, nb_frames=4, size=60)
+        # every frame of the first negative case is repeated 3 more times
+        case_path = os.path.join(self.input_dataset_path, 'negative', '000')
+        for i in xrange(4):
+            for j in xrange(3):
+                shutil.copy(os.path.join(case_path, 'frame%d.png' % (i,)),
+                            os.path.join(case_path, 'frame%d_%d.png' % (i, j)))
+
+    def test_select_distinct_frames(self):
+        signatures = np.array([[0.], [0.01], [0.02], [0.5], [0.5], [0.2]], dtype=np.float32)
+        self.assertEqual(select_distinct_frames(signatures, 0.05), [0, 3, 5])
+        self.assertEqual(select_distinct_frames(signatures, 0.05, window=2), [0, 3, 5])
+        self.assertEqual(select_distinct_frames(signatures[:0], 0.05), [])
+
+    def test_duplicates_removed(self):
+        adaptation = os.path.join(self.root_dir, 'dataset_30X30_dedup0p01_adaptation')
+        stats = reshape_images(self.input_dataset_path, adaptation, 30, 30, 2000, dedup_threshold=0.01)
+        self.assertEqual(stats['negative/000'], {'frames': 16, 'kept': 4, 'removed': 12, 'augmented': 0})
+        self.assertEqual(stats['positive/001']['removed'], 0)
+        for category in ('negative', 'positive'):
+            for case in ('000', '001'):
+                self.assertEqual(len(os.listdir(os.path.join(adaptation, category, case))), 4)
+        with open(adaptation + '_dedup.json', 'rb') as _input:
+            self.assertEqual(json.loads(_input.read()), stats)
+        data_set = DataSet(30, 30, root_dir=self.root_dir, dedup_threshold=0.01)
+        self.assertEqual(data_set.adaptation_dataset, adaptation)
+        self.assertEqual(data_set.get_dedup_stats(), stats)
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
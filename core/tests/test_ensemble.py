@@ -0,0 +1,65 @@
+from unittest import TestCase
+
+import numpy as np
+
+from core.cnn_manager import CNNManager
+
+
+class _FixedModel(object):
+    '''
+    A model that predicts fixed probabilities
+    '''
+    category = ['negative', 'positive']
+    img_rows, img_cols, nb_channel, roi = 4, 4, 3, False
+
+    def __init__(self, pred):
+        self.pred = np.array(pred)
+
+    def _preprocess(self, frames, source=None):
+        return np.zeros((len(frames), self.nb_channel, self.img_rows, self.img_cols), dtype=np.float32)
+
+    def predict_proba(self, x):
+        return self.pred
+
+    def to_labels(self, pred):
+        return [self.category[0] if p[0] > p[1] else self.category[1] for p in pred]
+
+
+class TestEnsemble(TestCase):
+    def setUp(self):
+        self.manager = CNNManager()
+        self.fixed = {
+            '_ensemble_a': _FixedModel([[0.9, 0.1], [0.4, 0.6]]),
+            '_ensemble_b': _FixedModel([[0.2, 0.8], [0.5, 0.5]]),
+            '_ensemble_c': _FixedModel([[0.3, 0.7], [0.6, 0.4]])
+        }
+        self.manager.models.update(self.fixed)
+        self.frames = {'f1': np.zeros((8, 8, 3), dtype=np.uint8), 'f2': np.ones((8, 8, 3), dtype=np.uint8)}
+
+    def tearDown(self):
+        for name in self.fixed:
+            self.manager.models.pop(name, None)
+
+    def test_average(self):
+        result = self.manager.predict_ensemble(['_ensemble_a', '_ensemble_b', '_ensemble_c'], self.frames)
+        # f2 averages to [0.5, 0.5], a tie is positive like the labels of a single model
+        self.assertEqual(result['ensemble'], {'f1': 'positive', 'f2': 'positive'})
+        self.assertEqual(result['models']['_ensemble_b'], {'f1': 'positive', 'f2': 'positive'})
+        np.testing.assert_allclose(result['probabilities']['f2'], [0.5, 0.5])
+        self.assertEqual(result['shared_inputs'], 1)
+
+    def test_vote(self):
+        result = self.manager.predict_ensemble(['_ensemble_a', '_ensemble_b', '_ensemble_c'], self.frames, 'vote')
+        self.assertEqual(result['ensemble'], {'f1': 'positive', 'f2': 'positive'})
+        # one vote each, the averaged probabilities decide
+        result = self.manager.predict_ensemble(['_ensemble_a', '_ensemble_c'], self.frames, 'vote')
+        self.assertEqual(result['ensemble'], {'f1': 'negative', 'f2': 'positive'})
+
+    def test_invalid_input(self):
+        with self.assertRaises(Exception) as context:
+            self.manager.predict_ensemble([''], self.frames)
+        self.assertEqual(context.exception.message, 'No model_names were given')
+        with self.assertRaises(Exception):
+            self.manager.predict_ensemble(['_ensemble_a'], {})
+        with self.assertRaises(Exception):
+            self.manager.predict_ensemble(['_ensemble_a'], self.frames, 'median')
@@ -0,0 +1,69 @@
+from unittest import TestCase
+
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from core.benchmarks.synthetic import make_synthetic_dataset
+from core.data_set import DataSet
+from core.feature_cache import block1_features, iterate_feature_batches
+from core.numpy_engine import conv2d_same, relu, max_pool
+from core.preprocessing import normalize
+from utils.prepare_dataset import reshape_images
+
+
+class TestFeatureCache(TestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.root_dir, 'feature_cache')
+        input_dataset_path = make_synthetic_dataset(self.root_dir, nb_cases=2, nb_frames=3, size=60)
+        reshape_images(input_dataset_path, os.path.join(self.root_dir, 'dataset_20X20_adaptation'), 20, 20, 3)
+        self.data_set = DataSet(20, 20, root_dir=self.root_dir)
+        rng = np.random.RandomState(7)
+        self.kernel = rng.randn(3, 3, 3, 4).astype(np.float32)
+        self.bias = np.zeros(4, dtype=np.float32)
+
+    def test_features_computed_once(self):
+        features = block1_features(self.data_set, self.kernel, self.bias, (2, 2), cache_dir=self.cache_dir)
+        self.assertEqual(features.shape, (12, 4, 10, 10))
+        self.assertEqual(features.dtype, np.float16)
+        expected = max_pool(relu(conv2d_same(normalize(self.data_set.frames), self.kernel, self.bias)), (2, 2))
+        np.testing.assert_allclose(features, expected, rtol=1e-2, atol=1e-2)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+        # same layer 1 reads the cache, other Gabor params get other features
+        block1_features(self.data_set, self.kernel, self.bias, (2, 2), cache_dir=self.cache_dir)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        block1_features(self.data_set, self.kernel * 2, self.bias, (2, 2), cache_dir=self.cache_dir)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+    def test_least_recently_used_evicted(self):
+        first = block1_features(self.data_set, self.kernel, self.bias, (2, 2), cache_dir=self.cache_dir)
+        max_bytes = first.nbytes * 2 + 1024
+        first_path = os.path.join(self.cache_dir, os.listdir(self.cache_dir)[0])
+        block1_features(self.data_set, self.kernel * 2, self.bias, (2, 2), cache_dir=self.cache_dir,
+                        max_bytes=max_bytes)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+        for _file in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, _file)
+            os.utime(path, (0, 0) if path == first_path else (100, 100))
+
+        # a read makes the first the most recently used, the second goes
+        block1_features(self.data_set, self.kernel, self.bias, (2, 2), cache_dir=self.cache_dir)
+        block1_features(self.data_set, self.kernel * 3, self.bias, (2, 2), cache_dir=self.cache_dir,
+                        max_bytes=max_bytes)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+        self.assertTrue(os.path.exists(first_path))
+        np.testing.assert_array_equal(first, np.load(first_path))
+
+    def test_batches(self):
+        features = block1_features(self.data_set, self.kernel, self.bias, (2, 2), cache_dir=self.cache_dir)
+        idx = np.array([0, 5, 7, 11])
+        x, y = next(iterate_feature_batches(features, self.data_set.labels, idx, 8, 2))
+        self.assertEqual(x.shape, (4, 4, 10, 10))
+        self.assertEqual(x.dtype, np.float32)
+        np.testing.assert_array_equal(y.argmax(axis=1), self.data_set.labels[idx])
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
@@ -0,0 +1,77 @@
+from unittest import TestCase
+
+import os
+import random
+import shutil
+import tempfile
+
+from core.data_set import DataSet
+
+# category -> case -> frames, the cases of a category are of very different sizes
+LAYOUT = {'negative': {'000': 1, '001': 9}, 'positive': {'000': 30}}
+SAMPLES = 4000
+
+
+class TestFrameIndex(TestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        self.adaptation = os.path.join(self.root_dir, 'dataset_30X30_adaptation')
+        for category, cases in LAYOUT.items():
+            for case, nb_frames in cases.items():
+                os.makedirs(os.path.join(self.adaptation, category, case))
+                for i in xrange(nb_frames):
+                    self._add_frame(category, case, 'frame%02d' % (i,))
+        random.seed(7)
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+
+    def _add_frame(self, category, case, name):
+        open(os.path.join(self.adaptation, category, case, name), 'wb').close()
+
+    def _share(self, data_set, stratify, condition):
+        hits = 0
+        for _ in xrange(SAMPLES):
+            path, category = data_set.get_random_frame(stratify)
+            self.assertEqual(path.split(os.sep)[-3], category)
+            hits += condition(path)
+        return float(hits) / SAMPLES
+
+    def test_persisted_index(self):
+        data_set = DataSet(30, 30, root_dir=self.root_dir)
+        self.assertEqual(data_set.frame_index_path, self.adaptation + '_index.json')
+        self.assertEqual(len(data_set.build_frame_index()), 40)
+        self.assertTrue(os.path.exists(data_set.frame_index_path))
+
+        # the next process reads the index instead of listing the folders
+        self._add_frame('positive', '000', 'frame99')
+        self.assertEqual(len(DataSet(30, 30, root_dir=self.root_dir).build_frame_index()), 40)
+        index = DataSet(30, 30, root_dir=self.root_dir).build_frame_index(rebuild=True)
+        self.assertEqual(len(index), 41)
+        self.assertIn((os.path.join(self.adaptation, 'positive', '000', 'frame99'), 'positive', '000'), index)
+        self.assertEqual(len(DataSet(30, 30, root_dir=self.root_dir).build_frame_index()), 41)
+
+    def test_not_persisted(self):
+        DataSet(30, 30, root_dir=self.root_dir).build_frame_index(persist=False)
+        self.assertFalse(os.path.exists(self.adaptation + '_index.json'))
+
+    def test_stratify(self):
+        data_set = DataSet(30, 30, root_dir=self.root_dir)
+
+        def _positive(path):
+            return path.split(os.sep)[-3] == 'positive'
+
+        def _small_case(path):
+            return path.split(os.sep)[-3:-1] == ['negative', '000']
+
+        # uniform over the frames
+        self.assertAlmostEqual(self._share(data_set, None, _positive), 30. / 40, delta=0.05)
+        self.assertAlmostEqual(self._share(data_set, None, _small_case), 1. / 40, delta=0.02)
+        # uniform over the categories
+        self.assertAlmostEqual(self._share(data_set, 'category', _positive), 0.5, delta=0.05)
+        self.assertAlmostEqual(self._share(data_set, 'category', _small_case), 0.5 / 10, delta=0.02)
+        # uniform over the categories, then over their cases
+        self.assertAlmostEqual(self._share(data_set, 'case', _positive), 0.5, delta=0.05)
+        self.assertAlmostEqual(self._share(data_set, 'case', _small_case), 0.25, delta=0.05)
+        with self.assertRaises(Exception):
+            data_set.get_random_frame('patient')
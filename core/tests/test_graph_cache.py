@@ -0,0 +1,49 @@
+from unittest import TestCase
+
+import numpy as np
+import keras.backend as K
+
+from core.cnn import CNN, graph_cache
+from core.graph_cache import VariableDropout
+
+
+class TestGraphCache(TestCase):
+    def setUp(self):
+        graph_cache.clear()
+
+    def test_same_shapes_share_the_graph(self):
+        params = {'model_name': 'graph_cache_a', 'img_rows': 50, 'img_cols': 50, 'dropout': 0.25, 'sigma': 1}
+        first = CNN(params)
+        model = first.model
+        first_weights = first.model.get_weights()
+        first.release_model()
+        self.assertIsNone(first.model)
+
+        stats = graph_cache.get_stats()
+        params.update({'model_name': 'graph_cache_b', 'dropout': 0.5, 'sigma': 2, 'batch_size': 64})
+        second = CNN(params)
+        self.assertIs(second.model, model)
+        self.assertEqual(graph_cache.get_stats()['hits'], stats['hits'] + 1)
+        rates = [K.get_value(l.rate_variable) for l in second.model.layers if isinstance(l, VariableDropout)]
+        np.testing.assert_allclose(rates, [0.5, 0.5])
+        # the gabor layers are initialized with the new params
+        self.assertFalse(np.allclose(first_weights[0], second.model.get_weights()[0]))
+
+        # other shapes never get the cached graph
+        second.release_model()
+        third = CNN({'model_name': 'graph_cache_c', 'img_rows': 50, 'img_cols': 50, 'nb_filters': 16})
+        self.assertIsNot(third.model, model)
+
+    def test_no_gabor_after_gabor(self):
+        params = {'model_name': 'graph_cache_gabor', 'img_rows': 50, 'img_cols': 50, 'with_gabor': True}
+        first = CNN(params)
+        model = first.model
+        first.release_model()
+
+        params.update({'model_name': 'graph_cache_no_gabor', 'with_gabor': False})
+        second = CNN(params)
+        self.assertIs(second.model, model)
+        kernels = [w for w in second.model.get_weights() if w.ndim == 4]
+        for kernel in kernels:
+            self.assertFalse(np.allclose(kernel, first._gabor_bank(kernel.shape)))
+            self.assertLess(abs(kernel.std() - 0.05), 0.02)
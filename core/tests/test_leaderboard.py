@@ -0,0 +1,71 @@
+from unittest import TestCase
+
+import os
+import json
+import shutil
+import tempfile
+import numpy as np
+
+from core import leaderboard
+from core.leaderboard import build_leaderboard, data_set_key, format_table
+from core.worker_pool import SharedDataSet
+
+
+class TestLeaderboard(TestCase):
+    def test_data_set_key(self):
+        self.assertEqual(data_set_key({'img_rows': 50, 'img_cols': 75, 'roi': 'false'}), (50, 75, None, 3, False))
+        # models saved before the build options share the plain data set
+        self.assertEqual(data_set_key({'img_rows': 50, 'img_cols': 50}),
+                         data_set_key({'img_rows': 50, 'img_cols': 50, 'nb_channel': 3, 'roi': False}))
+
+    def test_format_table(self):
+        ranked = [{'rank': 1, 'model_name': 'a', 'data_set': 'dataset_50X50', 'f1': 0.8, 'con_mat': [5, 1, 2, 6],
+                   'frames_per_sec': 120., 'clean': True},
+                  {'rank': 2, 'model_name': 'b', 'data_set': 'dataset_75X75', 'f1': 0.5, 'con_mat': [3, 3, 3, 3],
+                   'frames_per_sec': 80., 'clean': False}]
+        lines = format_table(ranked).splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertIn('5, 1, 2, 6', lines[1])
+        self.assertTrue(lines[2].strip().startswith('2'))
+
+    def test_build_leaderboard(self):
+        models_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, models_dir)
+        configs = {
+            'frames': {'img_rows': 50, 'img_cols': 50, 'split_cases': False, 'train_ratio': 0.5},
+            'cases': {'img_rows': 50, 'img_cols': 50, 'split_cases': True, 'train_ratio': 0.5},
+            'cases_large': {'img_rows': 50, 'img_cols': 50, 'split_cases': 'true', 'train_ratio': 0.8},
+            'broken': {'img_rows': 50, 'img_cols': 50},
+            'no_holdout': {'img_rows': 75, 'img_cols': 75}
+        }
+        for name, config in configs.items():
+            with open(os.path.join(models_dir, name + '.json'), 'wb') as output:
+                output.write(json.dumps(config))
+        with open(os.path.join(models_dir, 'unreadable.json'), 'wb') as output:
+            output.write('{"img_rows": ')
+        f1 = {'frames': 0.9, 'cases': 0.7, 'cases_large': 0.7}
+
+        def _load_holdout(key):
+            if key[0] == 75:
+                raise Exception('no data set')
+            return SharedDataSet(np.zeros((4, 3, 50, 50), dtype=np.uint8), np.array([0, 1, 0, 1]),
+                                 name='dataset_50X50'), np.arange(4)
+
+        def _evaluate_model(model_name, data_set, idx, batch_size):
+            if model_name == 'broken':
+                raise Exception('no weights')
+            return {'model_name': model_name, 'data_set': data_set.name, 'frames': len(idx), 'con_mat': [1, 1, 1, 1],
+                    'f1': f1[model_name], 'frames_per_sec': 10., 'load_time': 0.}
+
+        for name, stub in (('load_holdout', _load_holdout), ('evaluate_model', _evaluate_model)):
+            self.addCleanup(setattr, leaderboard, name, getattr(leaderboard, name))
+            setattr(leaderboard, name, stub)
+
+        ranked, failed = build_leaderboard(models_dir=models_dir, n_jobs=1)
+        self.assertEqual([(r['rank'], r['model_name']) for r in ranked],
+                         [(1, 'frames'), (2, 'cases'), (3, 'cases_large')])
+        self.assertEqual([r['clean'] for r in ranked], [False, True, False])
+        errors = dict((r['model_name'], r['error']) for r in failed)
+        self.assertEqual(sorted(errors), ['broken', 'no_holdout', 'unreadable'])
+        self.assertEqual(errors['broken'], 'no weights')
+        self.assertEqual(errors['no_holdout'], 'holdout: no data set')
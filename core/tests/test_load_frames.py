@@ -0,0 +1,43 @@
+from unittest import TestCase
+
+import os
+import shutil
+import tempfile
+import numpy as np
+from PIL import Image
+
+from core.benchmarks.synthetic import make_synthetic_dataset
+from core.data_set import DataSet
+from utils.prepare_dataset import reshape_images
+
+
+class TestLoadFrames(TestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        input_dataset_path = make_synthetic_dataset(self.root_dir, nb_cases=3, nb_frames=30, size=60)
+        reshape_images(input_dataset_path, os.path.join(self.root_dir, 'dataset_20X20_adaptation'), 20, 20, 30)
+        self.data_set = DataSet(20, 20, root_dir=self.root_dir)
+
+    def test_threaded_load(self):
+        calls = []
+        self.data_set._load(progress=lambda done, total: calls.append((done, total)))
+        self.assertEqual(self.data_set.frames.shape, (180, 3, 20, 20))
+        self.assertEqual(calls[-1], (180, 180))
+        self.assertEqual(sorted(calls), calls)
+        for i in (0, 77, 179):
+            path, category, case = self.data_set.frame_index[i]
+            np.testing.assert_array_equal(self.data_set.frames[i], np.array(Image.open(path)).transpose(2, 0, 1))
+            self.assertEqual(self.data_set.labels[i], self.data_set.categories.index(category))
+
+    def test_grayscale_data_set(self):
+        data_set = DataSet(20, 20, root_dir=self.root_dir, nb_channel=1)
+        self.assertTrue(data_set.adaptation_dataset.endswith('dataset_20X20_gray_adaptation'))
+        data_set._load()
+        self.assertEqual(data_set.frames.shape, (180, 1, 20, 20))
+        path, category, case = data_set.frame_index[5]
+        # converted once at build time, a single channel on disk
+        self.assertEqual(Image.open(path).mode, 'L')
+        np.testing.assert_array_equal(data_set.frames[5, 0], np.array(Image.open(path)))
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
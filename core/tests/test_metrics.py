@@ -0,0 +1,18 @@
+from unittest import TestCase
+
+from utils.metrics import MetricsRegistry
+
+
+class TestMetrics(TestCase):
+    def test_render(self):
+        registry = MetricsRegistry()
+        latency = registry.histogram('test_latency_seconds', 'test')
+        for i in xrange(100):
+            latency.observe(i / 100., view='predict_images')
+        registry.counter('test_requests_total', 'test').inc(view='predict_images', code=200)
+        self.assertAlmostEqual(latency.quantile(0.95, view='predict_images'), 0.95)
+        text = registry.render()
+        self.assertIn('test_latency_seconds_bucket{view="predict_images",le="+Inf"} 100', text)
+        self.assertIn('test_latency_seconds_quantile{view="predict_images",quantile="0.5"} 0.5', text)
+        self.assertIn('# HELP test_latency_seconds_quantile test, quantiles of the recent values', text)
+        self.assertIn('test_requests_total{code="200",view="predict_images"} 1.0', text)
@@ -0,0 +1,46 @@
+from unittest import TestCase
+
+import os
+import json
+
+from core.cnn import CNN, METRICS_LOG_EXTENSION, weight_store
+
+
+class TestMetricsLog(TestCase):
+    def setUp(self):
+        self.cnn = CNN({'model_name': 'test_metrics_log', 'img_rows': 50, 'img_cols': 50})
+
+    def test_append_only(self):
+        _con_mat = [[25, 25, 25, 25], [30, 20, 30, 20], [50, 0, 0, 50]]
+        self.cnn.con_mat_train = list(_con_mat)
+        self.cnn.con_mat_val = list(_con_mat)
+        self.cnn._save_only_best()
+        size = os.path.getsize(self.cnn.metrics_log_path)
+        self.cnn.con_mat_train.append([40, 10, 10, 40])
+        self.cnn.con_mat_val.append([40, 10, 10, 40])
+        self.cnn._save_only_best()
+        with open(self.cnn.metrics_log_path, 'rb') as _input:
+            lines = _input.readlines()
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(os.path.getsize(self.cnn.metrics_log_path) - size, len(lines[-1]))
+        with open(self.cnn.model_path + '.json', 'rb') as _input:
+            self.assertNotIn('con_mat_val', json.loads(_input.read()))
+
+        # a line cut in the middle of a write is dropped on load
+        with open(self.cnn.metrics_log_path, 'ab') as output:
+            output.write('{"index": 4, "con_m')
+        cnn = CNN({'model_name': 'test_metrics_log'}, True)
+        self.assertEqual(cnn.con_mat_val, _con_mat + [[40, 10, 10, 40]])
+        self.assertEqual(cnn.index_best, 2)
+        # the epochs saved without stats keep their place
+        self.assertEqual(cnn.epoch_stats, [None] * 4)
+        cnn.con_mat_train.append([45, 5, 5, 45])
+        cnn.con_mat_val.append([45, 5, 5, 45])
+        cnn.epoch_stats.append({'epoch': 4})
+        self.assertEqual(cnn._epoch_entry(4)['stats'], {'epoch': 4})
+
+    def tearDown(self):
+        for ext in ('.json', METRICS_LOG_EXTENSION):
+            if os.path.exists(self.cnn.model_path + ext):
+                os.remove(self.cnn.model_path + ext)
+        weight_store.discard(self.cnn.weights or [])
@@ -0,0 +1,30 @@
+from unittest import TestCase
+
+import os
+import numpy as np
+
+from core.cnn import CNN
+from core.numpy_engine import NumpyCNN
+
+
+class TestNumpyEngine(TestCase):
+    def _check(self, params):
+        cnn = CNN(params)
+        path = cnn.export_numpy()
+        try:
+            engine = NumpyCNN(path)
+            x = np.random.randint(0, 255, (5, cnn.nb_channel, cnn.img_rows, cnn.img_cols)).astype(np.uint8)
+            expected = cnn.model.predict(x.astype('float32') / 255, batch_size=5)
+            np.testing.assert_allclose(engine.predict_proba(x), expected, rtol=1e-3, atol=1e-5)
+        finally:
+            os.remove(path)
+
+    def test_odd_kernel(self):
+        self._check({'model_name': 'test_numpy_engine', 'img_rows': 50, 'img_cols': 50, 'kernel_size': 5})
+
+    def test_even_kernel(self):
+        self._check({'model_name': 'test_numpy_engine', 'img_rows': 50, 'img_cols': 50, 'kernel_size': 6,
+                     'pool_size': 4, 'activation_function': 'sigmoid', 'with_gabor': 'False'})
+
+    def test_global_pool(self):
+        self._check({'model_name': 'test_numpy_engine', 'img_rows': 40, 'img_cols': 60, 'global_pool': 'True'})
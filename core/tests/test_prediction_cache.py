@@ -0,0 +1,51 @@
+import os
+import shutil
+import tempfile
+import StringIO
+from unittest import TestCase
+
+import numpy as np
+
+from core.prediction_cache import ENTRY_OVERHEAD, PredictionCache, frame_digest
+
+
+class TestPredictionCache(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_digest(self):
+        upload = StringIO.StringIO('frame bytes')
+        upload.read(3)
+        self.assertEqual(frame_digest(upload), frame_digest(StringIO.StringIO('frame bytes')))
+        # the upload is left at the start for the decoding
+        self.assertEqual(upload.read(), 'frame bytes')
+        path = os.path.join(self.tmp_dir, 'frame.png')
+        with open(path, 'wb') as output:
+            output.write('frame bytes')
+        self.assertEqual(frame_digest(path), frame_digest(upload))
+        self.assertNotEqual(frame_digest(np.zeros((2, 3), np.uint8)), frame_digest(np.zeros((3, 2), np.uint8)))
+
+    def test_lru_bound(self):
+        entry = np.zeros(2, dtype=np.float32).nbytes + ENTRY_OVERHEAD
+        cache = PredictionCache(max_bytes=2 * entry)
+        cache.put_many('m', [('a', [0.1, 0.9]), ('b', [0.2, 0.8])])
+        self.assertEqual(sorted(cache.get_many(['a'])), ['a'])
+        # b is the least recently used
+        cache.put_many('m', [('c', [0.3, 0.7])])
+        self.assertEqual(sorted(cache.get_many(['a', 'b', 'c'])), ['a', 'c'])
+        stats = cache.get_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (3, 1, 2))
+        self.assertLessEqual(stats['bytes'], 2 * entry)
+
+    def test_disk_and_invalidate(self):
+        path = os.path.join(self.tmp_dir, 'predictions.db')
+        key = PredictionCache.key('m', 'v1', 'digest')
+        PredictionCache(path=path).put_many('m', [(key, [0.25, 0.75])])
+        cache = PredictionCache(path=path)
+        np.testing.assert_allclose(cache.get_many([key])[key], [0.25, 0.75])
+        cache.invalidate('m')
+        self.assertEqual(cache.get_many([key]), {})
+        self.assertEqual(PredictionCache(path=path).get_many([key]), {})
@@ -0,0 +1,33 @@
+from unittest import TestCase
+
+import io
+import numpy as np
+from PIL import Image
+
+from core.preprocessing import preprocess_frame, prepare_frame, load_image, DEFAULT_CROP_BOX
+
+
+class TestPreprocessing(TestCase):
+    def setUp(self):
+        self.raw = np.random.randint(0, 255, (1080, 1920, 3)).astype(np.uint8)
+        in_mem_file = io.BytesIO()
+        Image.fromarray(self.raw).save(in_mem_file, format="PNG")
+        self.png = in_mem_file.getvalue()
+
+    def test_any_size_is_accepted(self):
+        frame = preprocess_frame(io.BytesIO(self.png), 75, 75)
+        self.assertEqual(frame.shape, (3, 75, 75))
+        self.assertEqual(frame.dtype, np.uint8)
+
+    def test_same_as_training_preprocessing(self):
+        left, upper, right, lower = DEFAULT_CROP_BOX
+        # the data set frames are already cut, inference frames are raw
+        cut = load_image(self.png)[upper:lower, left:right]
+        expected = prepare_frame(cut, 50, 50).transpose(2, 0, 1)
+        np.testing.assert_array_equal(preprocess_frame(self.png, 50, 50), expected)
+
+    def test_grayscale(self):
+        frame = preprocess_frame(self.png, 50, 50, nb_channel=1)
+        self.assertEqual(frame.shape, (1, 50, 50))
+        # the same conversion the grayscale adaptation data set is built with
+        np.testing.assert_array_equal(frame[0], prepare_frame(load_image(self.png), 50, 50, nb_channel=1))
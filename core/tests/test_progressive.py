@@ -0,0 +1,45 @@
+from unittest import TestCase
+
+import numpy as np
+
+from core.cnn import CNN, parse_schedule
+
+
+class TestProgressive(TestCase):
+    def test_parse_schedule(self):
+        self.assertEqual(parse_schedule('50x50:2, 75X100:3'), [[50, 50, 2], [75, 100, 3]])
+        self.assertEqual(parse_schedule([['50', '50', '1']]), [[50, 50, 1]])
+        self.assertEqual(parse_schedule(None), [])
+        with self.assertRaises(Exception):
+            CNN({'model_name': 'test_progressive', 'img_rows': 50, 'img_cols': 50, 'resize_schedule': '30x30:1'})
+
+    def test_resize_keeps_weights(self):
+        cnn = CNN({'model_name': 'test_progressive', 'img_rows': 50, 'img_cols': 50, 'global_pool': 'True',
+                   'resize_schedule': '30x30:1'})
+        weights = cnn.model.get_weights()
+        cnn._resize_model(30, 30)
+        self.assertEqual(cnn.model.input_shape, (None, cnn.nb_channel, 30, 30))
+        for before, after in zip(weights, cnn.model.get_weights()):
+            np.testing.assert_array_equal(before, after)
+        x = np.random.rand(2, cnn.nb_channel, 30, 30).astype('float32')
+        self.assertEqual(cnn.model.predict(x).shape, (2, 2))
+        cnn.release_model()
+
+    def test_stage_epochs_not_best(self):
+        cnn = CNN({'model_name': 'test_progressive', 'img_rows': 50, 'img_cols': 50, 'global_pool': 'True',
+                   'resize_schedule': '30x30:1'})
+        cnn.con_mat_train = [[50, 0, 0, 50], [30, 20, 20, 30]]
+        cnn.con_mat_val = [[50, 0, 0, 50], [30, 20, 20, 30]]
+        cnn.epoch_stats = [{'img_rows': 30, 'img_cols': 30, 'fit_time': 1.},
+                           {'img_rows': 50, 'img_cols': 50, 'fit_time': 2.}]
+        # the perfect score of the 30x30 stage does not count at 50x50
+        self.assertEqual(cnn.time_to_score(0.9), (None, None))
+        self.assertEqual(cnn.time_to_score(0.5), (3., 1))
+        self.assertEqual([cnn._is_final_size(i) for i in xrange(2)], [False, True])
+
+        # a stage persists the size of the model
+        cnn._target_size = (50, 50)
+        cnn._resize_model(30, 30)
+        self.assertEqual((cnn.get_config()['img_rows'], cnn.get_config()['img_cols']), (50, 50))
+        self.assertEqual([cnn._is_final_size(i) for i in xrange(2)], [False, True])
+        cnn.release_model()
@@ -0,0 +1,33 @@
+from unittest import TestCase
+
+import os
+import numpy as np
+
+from core.cnn import CNN
+from core.numpy_engine import NumpyCNN
+from core.quantization import QuantizedCNN, quantize, quantize_per_channel, weights_bytes
+
+
+class TestQuantization(TestCase):
+    def test_per_channel(self):
+        kernel = np.random.randn(3, 3, 2, 4).astype(np.float32)
+        kernel[..., 1] *= 100
+        q, scale = quantize_per_channel(kernel)
+        self.assertEqual(q.dtype, np.int8)
+        self.assertEqual(scale.shape, (4,))
+        np.testing.assert_allclose(q * scale, kernel, atol=scale.max() / 2 + 1e-6)
+        # the small channels keep their precision next to the big one
+        np.testing.assert_allclose(q[..., 0] * scale[0], kernel[..., 0], atol=scale[0] / 2 + 1e-6)
+
+    def test_quantized_engine(self):
+        cnn = CNN({'model_name': 'test_quantization', 'img_rows': 50, 'img_cols': 50})
+        float_path = cnn.export_numpy()
+        x = np.random.randint(0, 255, (40, cnn.nb_channel, cnn.img_rows, cnn.img_cols)).astype(np.uint8)
+        path = quantize(float_path, x[:20])
+        try:
+            engine, quantized = NumpyCNN(float_path), QuantizedCNN(path)
+            np.testing.assert_allclose(quantized.predict_proba(x[20:]), engine.predict_proba(x[20:]), atol=0.05)
+            self.assertLess(weights_bytes(quantized), weights_bytes(engine) / 3)
+        finally:
+            os.remove(float_path)
+            os.remove(path)
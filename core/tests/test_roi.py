@@ -0,0 +1,42 @@
+from unittest import TestCase
+
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from core.roi import RoiCache, detect_roi
+
+
+class TestRoi(TestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(7)
+        self.frames = []
+        for _ in xrange(8):
+            frame = np.zeros((100, 120, 3), dtype=np.uint8)
+            frame[20:80, 30:100] = rng.randint(50, 200, (60, 70, 3))
+            # static overlay text, bright but never changes
+            frame[2:6, 5:50] = 255
+            self.frames.append(frame)
+
+    def test_detect_active_region(self):
+        self.assertEqual(detect_roi(self.frames), (28, 18, 102, 82))
+        self.assertEqual(detect_roi(self.frames, margin=0), (30, 20, 100, 80))
+        self.assertIsNone(detect_roi([np.zeros((50, 50), dtype=np.uint8)] * 3))
+
+    def test_box_cached_per_source(self):
+        cache = RoiCache(os.path.join(self.root_dir, 'roi_cache.json'))
+        calls = []
+
+        def _sample():
+            calls.append(1)
+            return self.frames
+        self.assertEqual(cache.get_or_detect('video1', _sample), (28, 18, 102, 82))
+        self.assertEqual(cache.get_or_detect('video1', _sample), (28, 18, 102, 82))
+        self.assertEqual(len(calls), 1)
+        # kept on disk for the next process
+        self.assertEqual(RoiCache(cache.path).get('video1'), (28, 18, 102, 82))
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
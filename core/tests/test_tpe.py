@@ -0,0 +1,41 @@
+import shutil
+import tempfile
+from unittest import TestCase
+
+from utils.tpe import SPACE, TPESampler, _space_value
+
+
+def _objective(params):
+    return 1. - abs(params['sigma'] - 2.) / 3. + (0.5 if params['img_rows'] == 75 else 0.)
+
+
+class TestTPE(TestCase):
+    def setUp(self):
+        self.models_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.models_dir)
+
+    def test_space_value(self):
+        params = {'img_rows': 75, 'img_cols': 75, 'kernel_size': [5, 5], 'split_cases': 'False', 'sigma': 180}
+        self.assertEqual(_space_value('img_size', params), (75, 75))
+        self.assertEqual(_space_value('kernel_size', params), 5)
+        self.assertEqual(_space_value('split_cases', params), False)
+        # clipped into the space
+        self.assertEqual(_space_value('sigma', params), 3.)
+        self.assertIsNone(_space_value('theta', params))
+
+    def test_parallel_proposals(self):
+        sampler = TPESampler(history=[], models_dir=self.models_dir, seed=1)
+        for _ in xrange(30):
+            for params in sampler.propose(3):
+                sampler.observe(params, _objective(params))
+        proposals = sampler.propose(4)
+        self.assertEqual(len(set(p['model_name'] for p in proposals)), 4)
+        for params in proposals:
+            for name, kind, domain in SPACE:
+                value = _space_value(name, params)
+                self.assertIsNotNone(value)
+        # the good region is found
+        late = [values for values, score in sampler.history[-30:]]
+        self.assertGreater(sum(1 for values in late if values['img_size'] == (75, 75)), 15)
@@ -0,0 +1,94 @@
+from unittest import TestCase
+
+import os
+import time
+import shutil
+import tempfile
+import numpy as np
+
+from core.trial_queue import TrialQueue, enqueue, run_trial, run_worker, tpe_sampler, DONE, FAILED, PENDING, RUNNING
+from manage import ROOT_DIR
+
+
+class TestTrialQueue(TestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        self.queue = TrialQueue(os.path.join(self.root_dir, 'trials.db'), max_attempts=2)
+        self.assertTrue(self.queue.put('t1', {'model_name': 't1', 'dropout': 0.25}, 1))
+        self.assertTrue(self.queue.put('t2', {'model_name': 't2', 'dropout': 0.5}, 1))
+        self.assertFalse(self.queue.put('t1', {'model_name': 't1'}, 1))
+
+    def test_lease_reassigned(self):
+        trial = self.queue.claim('w1', lease_seconds=0.05)
+        self.assertEqual((trial['name'], trial['attempt']), ('t1', 1))
+        self.assertEqual(self.queue.claim('w2', lease_seconds=60)['name'], 't2')
+        self.assertIsNone(self.queue.claim('w3'))
+
+        # w1 died, its lease ends and the trial goes to another worker
+        time.sleep(0.1)
+        self.assertEqual(self.queue.stats()['expired'], 1)
+        trial = self.queue.claim('w3', lease_seconds=60)
+        self.assertEqual((trial['name'], trial['attempt']), ('t1', 2))
+        self.assertFalse(self.queue.heartbeat(trial['id'], 'w1'))
+        self.assertTrue(self.queue.heartbeat(trial['id'], 'w3'))
+        with self.assertRaises(Exception):
+            self.queue.complete(trial['id'], 'w1', {})
+
+        weights = np.arange(6, dtype=np.float32)
+        self.queue.complete(trial['id'], 'w3', {'score': 0.5}, {'abc': weights})
+        self.assertEqual(self.queue.results(), [('t1', {'score': 0.5})])
+        np.testing.assert_array_equal(self.queue.get_blob('abc'), weights)
+
+    def test_enqueue_in_chunks(self):
+        plan = [{'model_name': 't%s' % (i,)} for i in xrange(1, 8)]
+        self.assertEqual(self.queue.put_many([(p['model_name'], p, 1) for p in plan], chunk_size=3), 5)
+        self.assertEqual(enqueue(self.queue, plan, 1), 0)
+        self.assertEqual([trial['name'] for trial in self.queue.trials()], ['t%s' % (i,) for i in xrange(1, 8)])
+        self.assertEqual(self.queue.stats()[PENDING], 7)
+
+    def test_failed_after_max_attempts(self):
+        for attempt in xrange(2):
+            trial = self.queue.claim('w1')
+            self.assertEqual(trial['name'], 't1')
+            self.queue.fail(trial['id'], 'w1', 'out of memory')
+        stats = self.queue.stats()
+        self.assertEqual((stats[FAILED], stats[PENDING], stats[RUNNING]), (1, 1, 0))
+
+    def test_run_worker(self):
+        def _run(trial):
+            return {'dropout': trial['params']['dropout']}, {}
+        self.assertEqual(run_worker(self.queue, 'w1', run=_run), 2)
+        self.assertEqual(self.queue.stats()[DONE], 2)
+        self.assertEqual(self.queue.results(), [('t1', {'dropout': 0.25}), ('t2', {'dropout': 0.5})])
+
+    def test_failed_trials_count(self):
+        def _run(trial):
+            raise Exception('out of memory')
+        self.assertEqual(run_worker(self.queue, 'w1', max_trials=3, run=_run), 3)
+        stats = self.queue.stats()
+        self.assertEqual((stats[FAILED], stats[PENDING]), (1, 1))
+
+    def test_local_model_not_trained_over(self):
+        model_path = os.path.join(ROOT_DIR, 'cnn_models', 'test_trial_queue_local')
+        with open(model_path + '.json', 'wb') as output:
+            output.write('{}')
+        try:
+            with self.assertRaises(Exception):
+                run_trial({'name': 'test_trial_queue_local', 'n_epoch': 1,
+                           'params': {'model_name': 'test_trial_queue_local'}})
+            with open(model_path + '.json', 'rb') as _input:
+                self.assertEqual(_input.read(), '{}')
+        finally:
+            os.remove(model_path + '.json')
+
+    def test_tpe_names_follow_the_queue(self):
+        models_dir = os.path.join(self.root_dir, 'cnn_models')
+        os.mkdir(models_dir)
+        # two batches enqueued before any collect
+        for _ in xrange(2):
+            self.assertEqual(enqueue(self.queue, tpe_sampler(self.queue, models_dir).propose(3), 1), 3)
+        self.assertEqual([trial['name'] for trial in self.queue.trials()][2:], ['tpe_%d' % i for i in xrange(6)])
+        self.assertEqual(len(tpe_sampler(self.queue, models_dir).pending), 8)
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
@@ -0,0 +1,27 @@
+import sys
+import subprocess
+from unittest import TestCase
+
+from core.cnn_manager import CNNManager, ModelLoading
+from manage import ROOT_DIR
+
+
+class TestWarmup(TestCase):
+    def test_no_keras_on_import(self):
+        output = subprocess.check_output([sys.executable, '-c', 'import sys, core.cnn_manager; '
+                                          'print "keras" in sys.modules or "theano" in sys.modules'], cwd=ROOT_DIR)
+        self.assertEqual(output.strip(), 'False')
+
+    def test_loading_model(self):
+        manager = CNNManager()
+        self.assertTrue(manager.ready)
+        self.assertEqual(manager.get_warmup_status()['loaded'], manager.get_warmup_status()['total'])
+        manager._pending.add('test_warmup')
+        try:
+            with self.assertRaises(ModelLoading):
+                manager.get_model('test_warmup')
+        finally:
+            manager._pending.discard('test_warmup')
+        with self.assertRaises(Exception) as context:
+            manager.get_model('test_warmup')
+        self.assertNotIsInstance(context.exception, ModelLoading)
@@ -0,0 +1,65 @@
+from unittest import TestCase
+
+import os
+import json
+import shutil
+import tempfile
+import numpy as np
+
+from core.weight_store import WeightStore
+
+
+class TestWeightStore(TestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        self.models_dir = os.path.join(self.root_dir, 'cnn_models')
+        os.makedirs(self.models_dir)
+        self.store = WeightStore(os.path.join(self.root_dir, 'weight_store'))
+
+    def _save_config(self, name, manifest):
+        with open(os.path.join(self.models_dir, name + '.json'), 'wb') as output:
+            output.write(json.dumps({'model_name': name, 'weights': manifest}))
+
+    def test_same_content_stored_once(self):
+        # the store directory is created by the first put
+        self.assertFalse(os.path.exists(self.store.root_dir))
+        self.assertEqual(self.store.collect_garbage(self.models_dir), (0, 0))
+        a = np.arange(12, dtype=np.float32).reshape(3, 4)
+        digest = self.store.put(a)
+        self.assertEqual(self.store.put(a.copy()), digest)
+        # same bytes in another shape or dtype is another array
+        self.assertNotEqual(self.store.put(a.reshape(4, 3)), digest)
+        self.assertNotEqual(self.store.put(a.view(np.int32)), digest)
+        self.assertEqual(len(os.listdir(self.store.blobs_dir)), 3)
+
+        loaded = self.store.get(digest)
+        self.assertIsInstance(loaded, np.memmap)
+        np.testing.assert_array_equal(loaded, a)
+
+    def test_collect_garbage(self):
+        shared = self.store.put(np.ones(5, dtype=np.float32))
+        only_a = self.store.put(np.zeros(5, dtype=np.float32))
+        only_b = self.store.put(np.arange(5, dtype=np.float32))
+        self._save_config('a', [shared, only_a])
+        self._save_config('b', [shared, only_b])
+
+        self.assertEqual(self.store.collect_garbage(self.models_dir, min_age=0)[0], 0)
+        os.remove(os.path.join(self.models_dir, 'b.json'))
+        # a blob that was just written is kept for a while
+        self.assertEqual(self.store.collect_garbage(self.models_dir)[0], 0)
+        self.assertEqual(self.store.collect_garbage(self.models_dir, min_age=0)[0], 1)
+        self.assertTrue(os.path.exists(self.store.blob_path(shared)))
+        self.assertTrue(os.path.exists(self.store.blob_path(only_a)))
+        self.assertFalse(os.path.exists(self.store.blob_path(only_b)))
+
+    def test_discard(self):
+        shared = self.store.put(np.ones(5, dtype=np.float32))
+        trial = self.store.put(np.zeros(5, dtype=np.float32))
+        self._save_config('a', [shared])
+        # only the blobs no model refers to are removed, whatever their age
+        self.store.discard([shared, trial], self.models_dir)
+        self.assertTrue(os.path.exists(self.store.blob_path(shared)))
+        self.assertFalse(os.path.exists(self.store.blob_path(trial)))
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
@@ -0,0 +1,30 @@
+from unittest import TestCase
+
+import os
+import numpy as np
+
+from core.worker_pool import run_tasks
+
+
+def _sum_worker(shared, task):
+    return {'sum': float(shared['arrays']['values'][task].sum()) * shared['config']['scale'], 'pid': os.getpid()}
+
+
+def _crash_worker(shared, task):
+    os._exit(3)
+
+
+class TestWorkerPool(TestCase):
+    def test_run_tasks(self):
+        results = run_tasks('core.tests.test_worker_pool:_sum_worker', [0, 1, 2],
+                            {'values': np.arange(6, dtype=np.float32).reshape(3, 2)}, {'scale': 2},
+                            n_jobs=2, tasks_per_worker=2)
+        self.assertEqual([r['sum'] for r in results], [2., 10., 18.])
+        # fresh processes, two tasks in the first one
+        self.assertNotIn(os.getpid(), [r['pid'] for r in results])
+        self.assertEqual(results[0]['pid'], results[1]['pid'])
+        self.assertNotEqual(results[1]['pid'], results[2]['pid'])
+
+    def test_crashed_worker(self):
+        self.assertEqual(run_tasks('core.tests.test_worker_pool:_crash_worker', [0, 1], tasks_per_worker=2),
+                         [{'error': 'worker exited with code 3'}] * 2)
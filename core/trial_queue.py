@@ -0,0 +1,407 @@
+'''
+Trial queue shared by the hyperparameter runners of several hosts.
+
+The coordinator puts the trials of a plan into a SQLite file on a shared disk, workers on any host claim a
+trial with a lease, train it and push the metrics and the weights back into the same file. A worker keeps
+its lease alive while it trains, the trials of a worker that died are claimed again when the lease ends.
+
+    python -m core.trial_queue enqueue --db /shared/trials.db --plan full --epochs 150
+    python -m core.trial_queue enqueue --db /shared/trials.db --plan tpe --trials 8 --epochs 10
+    python -m core.trial_queue worker --db /shared/trials.db
+    python -m core.trial_queue status --db /shared/trials.db
+    python -m core.trial_queue collect --db /shared/trials.db
+
+collect writes the finished trials (<model>.json, metrics log and weights) into this host cnn_models,
+where CNNManager loads them. A worker removes the files of a trial from its own host once the trial is
+in the queue.
+'''
+import os
+import sys
+import json
+import time
+import socket
+import sqlite3
+import argparse
+import itertools
+import threading
+import traceback
+from StringIO import StringIO
+from contextlib import contextmanager
+
+import numpy as np
+
+from manage import ROOT_DIR
+
+DEFAULT_DB_PATH = os.path.join(ROOT_DIR, 'trials.db')
+LEASE_SECONDS = 600
+MAX_ATTEMPTS = 3
+POLL_SECONDS = 10
+PUT_CHUNK_SIZE = 5000  # trials per transaction of put_many
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS trials (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT UNIQUE NOT NULL,
+    params TEXT NOT NULL,
+    n_epoch INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS trials_status ON trials (status, lease_until);
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY,
+    data BLOB NOT NULL
+);
+'''
+
+
+def worker_name():
+    return '%s:%s' % (socket.gethostname(), os.getpid())
+
+
+class TrialQueue(object):
+    def __init__(self, path=DEFAULT_DB_PATH, max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.max_attempts = max_attempts
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, two workers never claim the same trial
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+    def put(self, name, params, n_epoch):
+        '''
+        Add a trial, a name that is already queued is ignored. Return True when the trial was added.
+        '''
+        with self._transaction() as conn:
+            cursor = conn.execute('INSERT OR IGNORE INTO trials (name, params, n_epoch, status, updated) '
+                                  'VALUES (?, ?, ?, ?, ?)', (name, json.dumps(params), n_epoch, PENDING, time.time()))
+            return cursor.rowcount == 1
+
+    def put_many(self, trials, chunk_size=PUT_CHUNK_SIZE):
+        '''
+        Add the (name, params, n_epoch) of trials, chunk_size trials per transaction, names that are already
+        queued are ignored. Return the number of trials added.
+        '''
+        trials = iter(trials)
+        added = 0
+        while True:
+            now = time.time()
+            rows = [(name, json.dumps(params), n_epoch, PENDING, now)
+                    for name, params, n_epoch in itertools.islice(trials, chunk_size)]
+            if not rows:
+                return added
+            with self._transaction() as conn:
+                cursor = conn.executemany('INSERT OR IGNORE INTO trials (name, params, n_epoch, status, updated) '
+                                          'VALUES (?, ?, ?, ?, ?)', rows)
+                added += cursor.rowcount
+
+    def claim(self, worker, lease_seconds=LEASE_SECONDS):
+        '''
+        Lease the next pending trial, or a running trial whose lease ended. None when there is nothing to run.
+        '''
+        now = time.time()
+        with self._transaction() as conn:
+            # a trial whose every attempt ended with a lost lease is not tried again
+            conn.execute('UPDATE trials SET status = ?, error = ?, updated = ? '
+                         'WHERE status = ? AND lease_until < ? AND attempts >= ?',
+                         (FAILED, 'lease expired', now, RUNNING, now, self.max_attempts))
+            row = conn.execute('SELECT id, name, params, n_epoch, attempts FROM trials '
+                               'WHERE (status = ? OR (status = ? AND lease_until < ?)) AND attempts < ? '
+                               'ORDER BY id LIMIT 1', (PENDING, RUNNING, now, self.max_attempts)).fetchone()
+            if row is None:
+                return None
+            trial_id, name, params, n_epoch, attempts = row
+            conn.execute('UPDATE trials SET status = ?, worker = ?, lease_until = ?, attempts = ?, updated = ? '
+                         'WHERE id = ?', (RUNNING, worker, now + lease_seconds, attempts + 1, now, trial_id))
+        return {'id': trial_id, 'name': name, 'params': json.loads(params), 'n_epoch': n_epoch,
+                'attempt': attempts + 1}
+
+    def heartbeat(self, trial_id, worker, lease_seconds=LEASE_SECONDS):
+        '''
+        Extend the lease, False when the trial is no longer leased to worker
+        '''
+        now = time.time()
+        with self._transaction() as conn:
+            cursor = conn.execute('UPDATE trials SET lease_until = ?, updated = ? '
+                                  'WHERE id = ? AND worker = ? AND status = ?',
+                                  (now + lease_seconds, now, trial_id, worker, RUNNING))
+            return cursor.rowcount == 1
+
+    def complete(self, trial_id, worker, result, blobs=None):
+        '''
+        Store the result of a trial and its weight arrays (digest -> array), raise when the lease was lost
+        '''
+        with self._transaction() as conn:
+            for digest, array in (blobs or {}).items():
+                buf = StringIO()
+                np.save(buf, np.asarray(array))
+                conn.execute('INSERT OR IGNORE INTO blobs (digest, data) VALUES (?, ?)',
+                             (digest, sqlite3.Binary(buf.getvalue())))
+            cursor = conn.execute('UPDATE trials SET status = ?, result = ?, lease_until = NULL, updated = ? '
+                                  'WHERE id = ? AND worker = ? AND status = ?',
+                                  (DONE, json.dumps(result), time.time(), trial_id, worker, RUNNING))
+            if cursor.rowcount != 1:
+                # another worker took the trial over, its result is the one that counts
+                raise Exception('Trial %s is not leased to %s' % (trial_id, worker))
+        return True
+
+    def fail(self, trial_id, worker, error):
+        '''
+        Give the trial back, it is failed for good after max_attempts
+        '''
+        with self._transaction() as conn:
+            conn.execute('UPDATE trials SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, '
+                         'error = ?, lease_until = NULL, updated = ? WHERE id = ? AND worker = ? AND status = ?',
+                         (self.max_attempts, FAILED, PENDING, error, time.time(), trial_id, worker, RUNNING))
+
+    def get_blob(self, digest):
+        with self._connect() as conn:
+            row = conn.execute('SELECT data FROM blobs WHERE digest = ?', (digest,)).fetchone()
+        if row is None:
+            raise Exception('Weights %s are missing from the trial queue.' % (digest,))
+        return np.load(StringIO(str(row[0])))
+
+    def stats(self):
+        '''
+        Trials by status, running trials whose lease ended are counted as 'expired'
+        '''
+        now = time.time()
+        stats = {PENDING: 0, RUNNING: 0, DONE: 0, FAILED: 0, 'expired': 0}
+        with self._connect() as conn:
+            for _status, count in conn.execute('SELECT status, COUNT(*) FROM trials GROUP BY status'):
+                stats[_status] = count
+            stats['expired'] = conn.execute('SELECT COUNT(*) FROM trials WHERE status = ? AND lease_until < ?',
+                                            (RUNNING, now)).fetchone()[0]
+        return stats
+
+    def trials(self):
+        '''
+        [{'name', 'params', 'status', 'result'}] of every trial
+        '''
+        with self._connect() as conn:
+            rows = conn.execute('SELECT name, params, status, result FROM trials ORDER BY id').fetchall()
+        return [{'name': name, 'params': json.loads(params), 'status': status,
+                 'result': json.loads(result) if result else None} for name, params, status, result in rows]
+
+    def results(self):
+        '''
+        [(name, result)] of the finished trials
+        '''
+        with self._connect() as conn:
+            rows = conn.execute('SELECT name, result FROM trials WHERE status = ? ORDER BY id', (DONE,)).fetchall()
+        return [(name, json.loads(result)) for name, result in rows]
+
+
+class _LeaseKeeper(threading.Thread):
+    '''
+    Extend the lease of a running trial every lease_seconds / 3 until stopped
+    '''
+    def __init__(self, queue, trial_id, worker, lease_seconds):
+        super(_LeaseKeeper, self).__init__()
+        self.daemon = True
+        self.queue = queue
+        self.trial_id = trial_id
+        self.worker = worker
+        self.lease_seconds = lease_seconds
+        self.lost = False
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.lease_seconds / 3.):
+            try:
+                if not self.queue.heartbeat(self.trial_id, self.worker, self.lease_seconds):
+                    self.lost = True
+                    return
+            except sqlite3.Error:
+                # a busy database, the next beat tries again
+                print traceback.format_exc()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def run_trial(trial):
+    '''
+    Train one trial, return its result and its weight arrays (digest -> array). The files the training
+    wrote on this host (<model>.json, metrics log, weights) are removed, the trial lives in the queue. A
+    model of the same name on this host fails the trial, its files are never trained over nor removed.
+    '''
+    from core.cnn import CNN, LEGACY_WEIGHTS_EXTENSIONS, METRICS_LOG_EXTENSION, weight_store
+
+    extensions = ('.json', METRICS_LOG_EXTENSION)
+    model_path = os.path.join(ROOT_DIR, 'cnn_models', trial['params']['model_name'])
+    if any(os.path.exists(model_path + ext) for ext in extensions + LEGACY_WEIGHTS_EXTENSIONS):
+        raise Exception('Model %s already exists on %s.' % (trial['params']['model_name'], socket.gethostname()))
+    cnn = CNN(trial['params'])
+    try:
+        cnn.train_model(trial['n_epoch'])
+        result = {
+            'summary': cnn.get_summary(),
+            'config': cnn.get_config(),
+            'metrics_log': [cnn._epoch_entry(i) for i in xrange(len(cnn.con_mat_val))]
+        }
+        # read now, the blobs are removed below
+        blobs = {digest: np.array(weight_store.get(digest)) for digest in (cnn.weights or [])}
+        return result, blobs
+    finally:
+        cnn.release_model()
+        for ext in extensions:
+            if os.path.exists(cnn.model_path + ext):
+                os.remove(cnn.model_path + ext)
+        weight_store.discard(cnn.weights or [])
+        # the blobs of the earlier best epochs
+        weight_store.collect_garbage()
+
+
+def run_worker(queue, worker=None, lease_seconds=LEASE_SECONDS, max_trials=None, poll_seconds=POLL_SECONDS,
+               wait=False, run=run_trial):
+    '''
+    Claim and run trials until the queue is empty (or forever with wait=True), return the number of trials run.
+    Failed trials count toward max_trials.
+    '''
+    worker = worker or worker_name()
+    done = 0
+    while max_trials is None or done < max_trials:
+        trial = queue.claim(worker, lease_seconds)
+        if trial is None:
+            if not wait and queue.stats()[RUNNING] == 0:
+                break
+            # running trials of other workers may still come back when their lease ends
+            time.sleep(poll_seconds)
+            continue
+        print 'worker %s: trial %s attempt %s' % (worker, trial['name'], trial['attempt'])
+        keeper = _LeaseKeeper(queue, trial['id'], worker, lease_seconds)
+        keeper.start()
+        try:
+            result, blobs = run(trial)
+        except Exception as e:
+            keeper.stop()
+            print traceback.format_exc()
+            queue.fail(trial['id'], worker, str(e))
+            done += 1
+            continue
+        keeper.stop()
+        try:
+            queue.complete(trial['id'], worker, result, blobs)
+        except Exception as e:
+            print e.message
+        done += 1
+    return done
+
+
+def enqueue(queue, plan, n_epoch):
+    return queue.put_many((params['model_name'], params, n_epoch) for params in plan)
+
+
+def tpe_sampler(queue, models_dir=None):
+    '''
+    TPESampler on the collected models and the trials of the queue: the finished trials with their score,
+    the pending and running ones with the liar score. The names of the queued trials are not proposed again.
+    '''
+    from utils.tpe import MODELS_DIR, TPESampler, trial_score
+
+    models_dir = models_dir or MODELS_DIR
+    trials = queue.trials()
+    sampler = TPESampler(models_dir=models_dir, taken_names=[trial['name'] for trial in trials])
+    for trial in trials:
+        if trial['status'] == DONE:
+            if os.path.exists(os.path.join(models_dir, trial['name'] + '.json')):
+                # collected, in the history already
+                continue
+            entries = [e for e in trial['result']['metrics_log'] if e.get('con_mat_val') is not None]
+            sampler.observe(trial['params'], trial_score([e['con_mat_train'] for e in entries],
+                                                         [e['con_mat_val'] for e in entries]))
+        elif trial['status'] in (PENDING, RUNNING):
+            sampler.add_pending(trial['params'])
+    return sampler
+
+
+def collect(queue, models_dir=None):
+    '''
+    Write the finished trials that are missing from models_dir, with their weights, return their names
+    '''
+    from core.cnn import METRICS_LOG_EXTENSION, weight_store
+
+    models_dir = models_dir or os.path.join(ROOT_DIR, 'cnn_models')
+    names = []
+    for name, result in queue.results():
+        model_path = os.path.join(models_dir, name)
+        if os.path.exists(model_path + '.json'):
+            continue
+        for digest in result['config'].get('weights') or []:
+            if not os.path.exists(weight_store.blob_path(digest)):
+                weight_store.put(queue.get_blob(digest))
+        with open(model_path + METRICS_LOG_EXTENSION, 'wb') as output:
+            for entry in result['metrics_log']:
+                output.write(json.dumps(entry, sort_keys=True) + '\n')
+        with open(model_path + '.json', 'wb') as output:
+            output.write(json.dumps(result['config'], sort_keys=True, indent=4, separators=(',', ': ')))
+        names.append(name)
+    return names
+
+
+def main(argv=None):
+    from utils.configurations import get_random_conf, iter_full_plan
+
+    parser = argparse.ArgumentParser(description='reflux_analyze distributed trials')
+    parser.add_argument('command', choices=['enqueue', 'worker', 'status', 'collect'])
+    parser.add_argument('--db', default=DEFAULT_DB_PATH, help='the shared SQLite file')
+    parser.add_argument('--plan', choices=['full', 'random', 'tpe'], default='full')
+    parser.add_argument('--trials', type=int, default=100, help='trials of the random / tpe plan')
+    parser.add_argument('--epochs', type=int, default=1)
+    parser.add_argument('--lease', type=int, default=LEASE_SECONDS, help='lease seconds of a claimed trial')
+    parser.add_argument('--max-trials', type=int, help='stop the worker after this many trials')
+    parser.add_argument('--wait', action='store_true', help='keep the worker polling when the queue is empty')
+    args = parser.parse_args(argv)
+
+    queue = TrialQueue(args.db)
+    if args.command == 'enqueue':
+        if args.plan == 'full':
+            plan = iter_full_plan()
+        elif args.plan == 'tpe':
+            # proposed at once on the models and the queued trials so far, the workers train them in parallel
+            plan = tpe_sampler(queue).propose(args.trials)
+        else:
+            plan = (get_random_conf() for _ in xrange(args.trials))
+        print 'enqueued %s trials' % (enqueue(queue, plan, args.epochs),)
+    elif args.command == 'worker':
+        print 'ran %s trials' % (run_worker(queue, lease_seconds=args.lease, max_trials=args.max_trials,
+                                            wait=args.wait),)
+    elif args.command == 'status':
+        print json.dumps(queue.stats(), sort_keys=True)
+    else:
+        print 'collected %s' % (', '.join(collect(queue)) or 'nothing',)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+'''
+Content addressed store of the model weights.
+
+Every weight array is kept once in weight_store/blobs/<sha1>.npy, keyed by the hash of its content, and a
+model json refers to its arrays by the list of hashes (the 'weights' manifest). Trials that share arrays
+share the files. The arrays are read memory mapped, without h5py, but loading is not zero copy:
+model.set_weights copies every array into the backend (Theano shared) variables. Blobs no model json
+refers to are removed by collect_garbage.
+'''
+import os
+import json
+import time
+import hashlib
+import tempfile
+import numpy as np
+
+from manage import ROOT_DIR
+
+STORE_DIR = os.path.join(ROOT_DIR, 'weight_store')
+MODELS_DIR = os.path.join(ROOT_DIR, 'cnn_models')
+BLOB_EXTENSION = '.npy'
+# blobs younger than this are never collected, a model may be between writing its blobs and its json
+GC_MIN_AGE = 60
+
+
+def array_digest(array):
+    array = np.ascontiguousarray(array)
+    digest = hashlib.sha1('%s%s' % (array.dtype.str, array.shape))
+    digest.update(array.data)
+    return digest.hexdigest()
+
+
+class WeightStore(object):
+    def __init__(self, root_dir=STORE_DIR):
+        self.root_dir = root_dir
+        # created by the first put, importing core.cnn writes nothing
+        self.blobs_dir = os.path.join(root_dir, 'blobs')
+
+    def blob_path(self, digest):
+        return os.path.join(self.blobs_dir, digest + BLOB_EXTENSION)
+
+    def put(self, array):
+        '''
+        Store one array, return its digest. An array that is already stored is not written again.
+        '''
+        digest = array_digest(array)
+        path = self.blob_path(digest)
+        if not os.path.exists(self.blobs_dir):
+            try:
+                os.makedirs(self.blobs_dir)
+            except OSError:
+                # created by another process in the meantime
+                if not os.path.isdir(self.blobs_dir):
+                    raise
+        if not os.path.exists(path):
+            # write aside and rename, a reader never sees half a blob
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.blobs_dir)
+            with os.fdopen(fd, 'wb') as output:
+                np.save(output, np.ascontiguousarray(array))
+            os.rename(tmp_path, path)
+        else:
+            # a fresh mtime keeps a reused blob out of a running collect_garbage
+            os.utime(path, None)
+        return digest
+
+    def get(self, digest):
+        '''
+        Read only memory mapped array of a digest
+        '''
+        path = self.blob_path(digest)
+        if not os.path.exists(path):
+            raise Exception('Weights %s are missing from the weight store.' % (digest,))
+        return np.load(path, mmap_mode='r')
+
+    def save_weights(self, model):
+        '''
+        Store the weights of a keras model, return the manifest (the digests in model.get_weights() order)
+        '''
+        return [self.put(w) for w in model.get_weights()]
+
+    def load_weights(self, model, manifest):
+        # set_weights copies the mapped arrays into the model variables
+        model.set_weights([self.get(digest) for digest in manifest])
+
+    def discard(self, digests, models_dir=MODELS_DIR):
+        '''
+        Remove the blobs of digests that no model json in models_dir refers to
+        '''
+        referenced = self.referenced(models_dir)
+        for digest in set(digests) - referenced:
+            if os.path.exists(self.blob_path(digest)):
+                os.remove(self.blob_path(digest))
+
+    def referenced(self, models_dir=MODELS_DIR):
+        '''
+        Digests referred to by any model json in models_dir
+        '''
+        digests = set()
+        for _file in os.listdir(models_dir):
+            if not _file.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(models_dir, _file), 'rb') as _input:
+                    config = json.loads(_input.read())
+            except ValueError:
+                continue
+            if isinstance(config, dict):
+                digests.update(config.get('weights') or [])
+        return digests
+
+    def collect_garbage(self, models_dir=MODELS_DIR, min_age=GC_MIN_AGE):
+        '''
+        Remove the blobs that no model json refers to, return the number of removed blobs and bytes
+        '''
+        if not os.path.exists(self.blobs_dir):
+            return 0, 0
+        referenced = self.referenced(models_dir)
+        now = time.time()
+        removed, freed = 0, 0
+        for _file in os.listdir(self.blobs_dir):
+            path = os.path.join(self.blobs_dir, _file)
+            if _file.endswith(BLOB_EXTENSION) and _file[:-len(BLOB_EXTENSION)] in referenced:
+                continue
+            stat = os.stat(path)
+            if now - stat.st_mtime < min_age:
+                continue
+            os.remove(path)
+            removed += 1
+            freed += stat.st_size
+        return removed, freed
+
+    def disk_usage(self):
+        if not os.path.exists(self.blobs_dir):
+            return 0
+        return sum(os.path.getsize(os.path.join(self.blobs_dir, f)) for f in os.listdir(self.blobs_dir))
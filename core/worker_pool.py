@@ -0,0 +1,104 @@
+'''
+Worker processes that start from a fresh interpreter.
+
+A process that has Theano / Keras initialized, or runs threads (a Django server), is not forked: every
+worker is a new `python -m core.worker_pool` process that imports Keras itself. The arrays the tasks share
+are written once to a temporary directory and memory mapped by the workers, so they share the page cache
+instead of copies. The tasks, the config and the results go through json files.
+'''
+import os
+import sys
+import json
+import shutil
+import tempfile
+import importlib
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from manage import ROOT_DIR
+
+ARRAY_EXTENSION = '.npy'
+
+
+class SharedDataSet(object):
+    '''
+    The frames and labels a worker reads, in place of the DataSet they were taken from
+    '''
+    def __init__(self, frames, labels, categories=None, name=None):
+        self.frames = frames
+        self.labels = labels
+        self.categories = categories
+        self.name = name
+
+
+def run_tasks(function, tasks, arrays=None, config=None, n_jobs=1, tasks_per_worker=1):
+    '''
+    [function(shared, task) for task in tasks], run by n_jobs worker processes at a time, a worker process
+    runs tasks_per_worker tasks and exits. function is 'module:name', shared is {'arrays': name -> read
+    only memory mapped array, 'config': config}. The tasks of a worker that crashed get {'error': ...}.
+    '''
+    tmp_dir = tempfile.mkdtemp(prefix='worker_pool_')
+    try:
+        for name, array in (arrays or {}).items():
+            np.save(os.path.join(tmp_dir, name + ARRAY_EXTENSION), np.ascontiguousarray(array))
+        with open(os.path.join(tmp_dir, 'config.json'), 'wb') as output:
+            output.write(json.dumps(config or {}))
+        groups = [tasks[i:i + tasks_per_worker] for i in xrange(0, len(tasks), tasks_per_worker)]
+
+        def _run(job):
+            return _run_worker(function, tmp_dir, job, groups[job])
+
+        # the threads only wait for their worker process
+        pool = ThreadPool(max(1, min(n_jobs, len(groups))))
+        try:
+            results = pool.map(_run, range(len(groups)))
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shutil.rmtree(tmp_dir)
+    return [result for group in results for result in group]
+
+
+def _run_worker(function, tmp_dir, job, tasks):
+    results_path = os.path.join(tmp_dir, 'results_%s.json' % (job,))
+    with open(os.path.join(tmp_dir, 'tasks_%s.json' % (job,)), 'wb') as output:
+        output.write(json.dumps(tasks))
+    code = subprocess.call([sys.executable, '-m', 'core.worker_pool', function, tmp_dir, str(job)],
+                           cwd=ROOT_DIR, close_fds=True)
+    if code == 0 and os.path.exists(results_path):
+        with open(results_path, 'rb') as _input:
+            return json.loads(_input.read())
+    return [{'error': 'worker exited with code %s' % (code,)} for _ in tasks]
+
+
+def load_shared(tmp_dir):
+    arrays = {}
+    for _file in os.listdir(tmp_dir):
+        if _file.endswith(ARRAY_EXTENSION):
+            arrays[_file[:-len(ARRAY_EXTENSION)]] = np.load(os.path.join(tmp_dir, _file), mmap_mode='r')
+    with open(os.path.join(tmp_dir, 'config.json'), 'rb') as _input:
+        config = json.loads(_input.read())
+    return {'arrays': arrays, 'config': config}
+
+
+def main(argv=None):
+    function, tmp_dir, job = sys.argv[1:] if argv is None else argv
+    module_name, name = function.split(':')
+    worker = getattr(importlib.import_module(module_name), name)
+    shared = load_shared(tmp_dir)
+    with open(os.path.join(tmp_dir, 'tasks_%s.json' % (job,)), 'rb') as _input:
+        tasks = json.loads(_input.read())
+    results = [worker(shared, task) for task in tasks]
+    # write aside and rename, the parent never reads half the results
+    results_path = os.path.join(tmp_dir, 'results_%s.json' % (job,))
+    with open(results_path + '.tmp', 'wb') as output:
+        output.write(json.dumps(results))
+    os.rename(results_path + '.tmp', results_path)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -119,6 +119,17 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
+# cProfile the training runs, the data set loading and the views (see utils/profiling.py),
+# None follows the REFLUX_PROFILING environment variable, True / False overrides it
+PROFILING = None
+
+# Prediction cache (see core/prediction_cache.py): memory bound in MB, and a SQLite file to keep it on disk
+PREDICTION_CACHE_MB = int(os.environ.get('REFLUX_PREDICTION_CACHE_MB', '32'))
+PREDICTION_CACHE_PATH = os.environ.get('REFLUX_PREDICTION_CACHE_PATH') or None
+
+# Load and compile the models in a background thread after startup (see /readyz) instead of before serving
+BACKGROUND_WARMUP = os.environ.get('REFLUX_BACKGROUND_WARMUP', 'true').lower() in ('1', 'true', 'yes')
+
 STATICFILES_DIRS = [
     os.path.join(BASE_DIR, "static"),
     os.path.join(BASE_DIR, 'app_control', "static"),
@@ -1,6 +1,7 @@
 import os
 import json
 import random
+import itertools
 from manage import ROOT_DIR
 
 RANDOM_CONFIGURATION_PATH = os.path.join(ROOT_DIR, 'random_conf.json')
@@ -19,6 +20,45 @@ def save_configurations(conf):
         output.write(json.dumps(conf, sort_keys=True, indent=4, separators=(',', ': ')))
 
 
+def iter_full_plan():
+    '''
+    Every configuration of the full plan grid, named item1, item2, ... in grid order
+    '''
+    grid = itertools.product(['True', 'False'],  # split_cases
+                             [0.25, 0.5],  # dropout
+                             ['softmax', 'sigmoid'],  # activation_function
+                             [(75, 75), (50, 50)],  # img_size
+                             [32, 64],  # nb_filters
+                             [5, 6, 7, 8, 9, 10],  # kernel_size
+                             [2, 4, 6, 8],  # pool_size
+                             [32, 64, 128],  # batch_size
+                             [180, 90, 30],  # sigma
+                             [45, 90, 135],  # theta
+                             [45, 90, 135],  # lammbd
+                             [0.3, 0.5, 0.7, 0.9],  # gamma
+                             [0.2, 0.5, 0.8])  # psi
+    for item, values in enumerate(grid, 1):
+        (split_cases, dropout, activation_function, img_size, nb_filters, kernel_size, pool_size, batch_size,
+         sigma, theta, lammbd, gamma, psi) = values
+        yield {
+            'model_name': 'item%s' % item,
+            'split_cases': split_cases,
+            'img_rows': img_size[0],
+            'img_cols': img_size[1],
+            'batch_size': batch_size,
+            'nb_filters': nb_filters,
+            'dropout': dropout,
+            'activation_function': activation_function,
+            'pool_size': pool_size,
+            'kernel_size': kernel_size,
+            'sigma': sigma,
+            'theta': theta,
+            'lammbd': lammbd,
+            'gamma': gamma,
+            'psi': psi
+        }
+
+
 def get_random_conf():
     configurations = load_configurations()
     while True:
@@ -2,6 +2,9 @@ import cv2
 import os
 from PIL import Image
 
+from core.preprocessing import DEFAULT_CROP_BOX, crop_frame, load_image
+from core.roi import roi_cache, sample_indices
+
 
 def extract_frames(_video_path, frames_path):
     try:
@@ -19,12 +22,29 @@ def extract_frames(_video_path, frames_path):
         pass
 
 
-def cut_image(img_src, img_dest):
-    i = Image.open(img_src)
-    frame2 = i.crop(((560, 140, 1360, 940)))
+def cut_image(img_src, img_dest, crop_box=DEFAULT_CROP_BOX):
+    frame2 = Image.fromarray(crop_frame(load_image(img_src), crop_box))
     frame2.save(img_dest)
 
 
+def cut_images(frames_dir, dest_dir, roi=True):
+    '''
+    Cut every frame of a video folder, with roi to the active region detected on the video (cached)
+    instead of DEFAULT_CROP_BOX
+    '''
+    file_list = sorted(os.listdir(frames_dir))
+    crop_box = DEFAULT_CROP_BOX
+    if roi:
+        def _sample():
+            return [load_image(os.path.join(frames_dir, file_list[i])) for i in sample_indices(len(file_list))]
+        crop_box = roi_cache.get_or_detect(os.path.abspath(frames_dir), _sample) or DEFAULT_CROP_BOX
+    if not os.path.exists(dest_dir):
+        os.makedirs(dest_dir)
+    for f in file_list:
+        cut_image(os.path.join(frames_dir, f), os.path.join(dest_dir, f), crop_box)
+    return crop_box
+
+
 if __name__ == "__main__":
     video_dir = os.path.join('/home', 'naor', 'Desktop', 'workspace', 'reflux_analyze', 'video')
     img_dir = os.path.join('/home', 'naor', 'Desktop', 'workspace', 'reflux_analyze', 'images')
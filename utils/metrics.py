@@ -0,0 +1,211 @@
+'''
+Light in process metrics (counters, gauges and latency histograms) rendered in the prometheus text format.
+'''
+import time
+import bisect
+import threading
+from collections import deque
+from functools import wraps
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+QUANTILES = (0.5, 0.95, 0.99)
+QUANTILE_WINDOW = 1024  # the quantiles are computed on the last observations only
+
+
+def _format_labels(labels, extra=None):
+    items = sorted(labels)
+    if extra:
+        items.append(extra)
+    if not items:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in items)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def header(self):
+        return ['# HELP %s %s' % (self.name, self.description), '# TYPE %s %s' % (self.name, self.kind)]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append('%s%s %s' % (self.name, _format_labels(key), _format_value(value)))
+        return lines
+
+
+class Gauge(_Metric):
+    '''
+    fn, when given, is called at render time and returns a value or a dict of label value -> value
+    '''
+    kind = 'gauge'
+
+    def __init__(self, name, description, fn=None, label=None):
+        super(Gauge, self).__init__(name, description)
+        self.fn = fn
+        self.label = label
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            values = dict(self._values)
+        if self.fn is not None:
+            res = self.fn()
+            if isinstance(res, dict):
+                for k, v in res.items():
+                    values[((self.label, k),)] = v
+            else:
+                values[()] = res
+        for key, value in sorted(values.items()):
+            lines.append('%s%s %s' % (self.name, _format_labels(key), _format_value(value)))
+        return lines
+
+
+class _Series(object):
+    def __init__(self, buckets):
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+        self.window = deque(maxlen=QUANTILE_WINDOW)
+
+    def quantile(self, q):
+        values = sorted(self.window)
+        if not values:
+            return 0.
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, description)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = _Series(self.buckets)
+            series.counts[bisect.bisect_left(self.buckets, value)] += 1
+            series.sum += value
+            series.count += 1
+            series.window.append(value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def quantile(self, q, **labels):
+        with self._lock:
+            series = self._values.get(tuple(sorted(labels.items())))
+            return series.quantile(q) if series is not None else 0.
+
+    def render(self):
+        lines = self.header()
+        quantiles = ['# HELP %s_quantile %s, quantiles of the recent values' % (self.name, self.description),
+                     '# TYPE %s_quantile gauge' % (self.name,)]
+        with self._lock:
+            for key, series in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), series.counts):
+                    cumulative += count
+                    lines.append('%s_bucket%s %s' % (self.name, _format_labels(key, ('le', _format_value(bound))),
+                                                     cumulative))
+                lines.append('%s_sum%s %s' % (self.name, _format_labels(key), _format_value(series.sum)))
+                lines.append('%s_count%s %s' % (self.name, _format_labels(key), series.count))
+                for q in QUANTILES:
+                    quantiles.append('%s_quantile%s %s' % (self.name, _format_labels(key, ('quantile', q)),
+                                                           _format_value(series.quantile(q))))
+        return lines + quantiles
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, *args, **kwargs):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, *args, **kwargs)
+            return self._metrics[name]
+
+    def counter(self, name, description=''):
+        return self._get_or_create(Counter, name, description)
+
+    def gauge(self, name, description='', fn=None, label=None):
+        return self._get_or_create(Gauge, name, description, fn, label)
+
+    def histogram(self, name, description='', buckets=LATENCY_BUCKETS):
+        return self._get_or_create(Histogram, name, description, buckets)
+
+    def render(self):
+        lines = []
+        for name in sorted(self._metrics.keys()):
+            lines.extend(self._metrics[name].render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+request_count = registry.counter('http_requests_total', 'Requests by view and status code')
+request_latency = registry.histogram('http_request_duration_seconds', 'Request latency by view')
+inference_latency = registry.histogram('cnn_inference_duration_seconds', 'Model forward pass latency by model')
+inference_batch_size = registry.histogram('cnn_inference_batch_size', 'Frames per forward pass by model',
+                                          BATCH_BUCKETS)
+model_load_time = registry.gauge('cnn_model_load_seconds', 'Time to load the model from disk')
+model_compile_time = registry.gauge('cnn_model_compile_seconds', 'Time to build and compile the model graph')
+
+
+def track_view(view_name):
+    '''
+    Count the requests of a view and observe their latency
+    '''
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            start = time.time()
+            code = 500
+            try:
+                response = view(request, *args, **kwargs)
+                code = getattr(response, 'status_code', 200)
+                return response
+            finally:
+                request_latency.observe(time.time() - start, view=view_name)
+                request_count.inc(view=view_name, code=code)
+        return wrapper
+    return decorator
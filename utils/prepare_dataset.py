@@ -1,22 +1,82 @@
 import os
+import re
+import json
 import random
 from random import randint
 
 import cv2
 import math
+import numpy as np
 from PIL import Image
-from PIL.Image import LANCZOS
 from scipy.ndimage import rotate
+from core.preprocessing import DEFAULT_CROP_BOX, crop_frame, load_image, prepare_frame
+from core.roi import roi_cache, sample_indices
 from utils.image_augmentation import rotate_image, crop_around_center, largest_rotated_rect
 
 TOTAL_IMAGES_PER_CASE = 2000
 image_height = 800
 image_width = 800
+SIGNATURE_SIZE = 16  # side of the grayscale thumbnails the near duplicate frames are compared with
 
 
-def reshape_images(input_dataset_path, adaptation_dataset, img_rows, img_cols):
+def _natural_key(name):
+    return [int(t) if t.isdigit() else t for t in re.split(r'(\d+)', name)]
+
+
+def frame_signatures(paths, size=SIGNATURE_SIZE):
+    '''
+    (n, size*size) float32 downsampled grayscale signatures in [0, 1] of the frames
+    '''
+    signatures = np.empty((len(paths), size * size), dtype=np.float32)
+    for i, path in enumerate(paths):
+        img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        signatures[i] = cv2.resize(img, (size, size), interpolation=cv2.INTER_AREA).ravel()
+    signatures /= 255
+    return signatures
+
+
+def select_distinct_frames(signatures, threshold, window=256):
+    '''
+    Indices of the frames to keep: a frame is kept when its mean absolute signature difference from the
+    last kept frame is above threshold, so slow drifts are kept and runs of near identical frames are not.
+    Each step compares the anchor with a whole window of the following frames at once.
+    '''
+    if not len(signatures):
+        return []
+    keep = [0]
+    anchor, start = 0, 1
+    while start < len(signatures):
+        diff = np.abs(signatures[start:start + window] - signatures[anchor]).mean(axis=1)
+        distinct = np.flatnonzero(diff > threshold)
+        if len(distinct):
+            anchor = start + int(distinct[0])
+            keep.append(anchor)
+            start = anchor + 1
+        else:
+            start += window
+    return keep
+
+
+def case_crop_box(patient_path, file_list):
     '''
-    This method will create adaptation dataset from the original dataset
+    Crop box of the active region of a case, detected once on a sample of its frames and cached
+    '''
+    def _sample():
+        return [load_image(os.path.join(patient_path, file_list[i])) for i in sample_indices(len(file_list))]
+    box = roi_cache.get_or_detect(os.path.abspath(patient_path), _sample)
+    return box if box is not None else DEFAULT_CROP_BOX
+
+
+def reshape_images(input_dataset_path, adaptation_dataset, img_rows, img_cols,
+                   total_images_per_case=TOTAL_IMAGES_PER_CASE, dedup_threshold=None, nb_channel=3, roi=False):
+    '''
+    This method will create adaptation dataset from the original dataset.
+    With dedup_threshold the near duplicate consecutive frames of every case are dropped first
+    (see select_distinct_frames) and the cases are equalized to the largest distinct case instead of
+    total_images_per_case, the per case statistics are saved to <adaptation_dataset>_dedup.json.
+    With nb_channel=1 the frames are converted to grayscale here and saved as single channel PNGs.
+    With roi the frames of every case are cropped to the active region detected on the case (core.roi)
+    instead of DEFAULT_CROP_BOX.
     '''
 
     print 'making dataset'
@@ -27,14 +87,12 @@ def reshape_images(input_dataset_path, adaptation_dataset, img_rows, img_cols):
     # create output folder
     if not os.path.exists(adaptation_dataset):
         os.makedirs(adaptation_dataset)
+    cases = []
+    case_frames = {}
     for folder in folders:
-        print 'category %s:\n' % folder
         category_path = os.path.join(input_dataset_path, folder)
         sub_folders = os.listdir(category_path)
         for sub_folder in sub_folders:
-            case_folder = os.path.join(adaptation_dataset, folder, sub_folder)
-            if not os.path.exists(case_folder):
-                os.makedirs(case_folder)
             file_list = os.listdir(os.path.join(input_dataset_path, folder, sub_folder))
             # ======================================================================
             #  TODO: fix image augmentation at picture size 50X50
@@ -43,36 +101,75 @@ def reshape_images(input_dataset_path, adaptation_dataset, img_rows, img_cols):
                 if 'augmentation' in f:
                     os.remove(os.path.join(input_dataset_path, folder, sub_folder, f))
             # ======================================================================
-            file_list = os.listdir(os.path.join(input_dataset_path, folder, sub_folder))
-            # equalize between amount of frames a cross all patients
+            cases.append((folder, sub_folder))
+            case_frames[(folder, sub_folder)] = sorted(os.listdir(os.path.join(input_dataset_path, folder, sub_folder)),
+                                                       key=_natural_key)
+
+    dedup_stats = {}
+    if dedup_threshold is not None:
+        for folder, sub_folder in cases:
+            file_list = case_frames[(folder, sub_folder)]
             patient_path = os.path.join(input_dataset_path, folder, sub_folder)
-            number_of_augmentation = TOTAL_IMAGES_PER_CASE-len(file_list)
-            for j in xrange(number_of_augmentation):
-                img_index = randint(0, len(file_list)-1)
-                image_path_in = os.path.join(patient_path, file_list[img_index])
-                image = cv2.imread(image_path_in)
-                angel = random.uniform(0.1, 359.9)
-                image_rotated = rotate_image(image, angel)
-                image_height, image_width = image.shape[0:2]
-                image_rotated_cropped = crop_around_center(
-                    image_rotated, *largest_rotated_rect(image_width, image_height, math.radians(angel)))
-                # image_rotated_cropped = rotate(image, angel, reshape=False)
-                # image_rotated_cropped = image_rotated_cropped[high_diff:high_diff + img_rows, width_diff:width_diff + img_cols]
-
-                cv2.imwrite(os.path.join(patient_path, 'augmentation%s.png' % j), image_rotated_cropped)
-            file_list = os.listdir(os.path.join(input_dataset_path, folder, sub_folder))
-            print 'case %s: frames: %s' % (sub_folder, len(file_list))
-            for f in file_list:
-                image_path_in = os.path.join(input_dataset_path, folder, sub_folder, f)
-                image_path_out = os.path.join(adaptation_dataset, folder, sub_folder, f)
-                im = Image.open(image_path_in)
-                img = im.resize((img_rows, img_cols), resample=LANCZOS)
-                # img = img.convert('L')
-                # gray = img.convert('L')d
-                # gray.save(output_dtatset+'\\'+f,'JPEG')
-                path_without_extention = image_path_out.split('.')[0]
-                img.save(path_without_extention, 'PNG')
-                # train_set_size += 1
+            signatures = frame_signatures([os.path.join(patient_path, f) for f in file_list])
+            file_list = [file_list[i] for i in select_distinct_frames(signatures, dedup_threshold)]
+            dedup_stats['%s/%s' % (folder, sub_folder)] = {
+                'frames': len(case_frames[(folder, sub_folder)]),
+                'kept': len(file_list),
+                'removed': len(case_frames[(folder, sub_folder)]) - len(file_list)
+            }
+            case_frames[(folder, sub_folder)] = file_list
+        # do not pad the removed duplicates back with augmentation
+        total_images_per_case = min(total_images_per_case, max(len(f) for f in case_frames.values()))
+
+    for folder, sub_folder in cases:
+        case_folder = os.path.join(adaptation_dataset, folder, sub_folder)
+        if not os.path.exists(case_folder):
+            os.makedirs(case_folder)
+        file_list = case_frames[(folder, sub_folder)]
+        # equalize between amount of frames a cross all patients
+        patient_path = os.path.join(input_dataset_path, folder, sub_folder)
+        crop_box = DEFAULT_CROP_BOX
+        if roi:
+            crop_box = case_crop_box(patient_path, file_list)
+        number_of_augmentation = total_images_per_case-len(file_list)
+        augmentation_list = []
+        for j in xrange(number_of_augmentation):
+            img_index = randint(0, len(file_list)-1)
+            image_path_in = os.path.join(patient_path, file_list[img_index])
+            image = cv2.imread(image_path_in)
+            if roi:
+                # the augmentation is made of the region only, it is smaller than the box and is not cut again
+                image = crop_frame(image, crop_box)
+            angel = random.uniform(0.1, 359.9)
+            image_rotated = rotate_image(image, angel)
+            image_height, image_width = image.shape[0:2]
+            image_rotated_cropped = crop_around_center(
+                image_rotated, *largest_rotated_rect(image_width, image_height, math.radians(angel)))
+            # image_rotated_cropped = rotate(image, angel, reshape=False)
+            # image_rotated_cropped = image_rotated_cropped[high_diff:high_diff + img_rows, width_diff:width_diff + img_cols]
+
+            cv2.imwrite(os.path.join(patient_path, 'augmentation%s.png' % j), image_rotated_cropped)
+            augmentation_list.append('augmentation%s.png' % j)
+        if dedup_threshold is not None:
+            dedup_stats['%s/%s' % (folder, sub_folder)]['augmented'] = len(augmentation_list)
+        file_list = file_list + augmentation_list
+        print 'category %s case %s: frames: %s' % (folder, sub_folder, len(file_list))
+        for f in file_list:
+            image_path_in = os.path.join(input_dataset_path, folder, sub_folder, f)
+            image_path_out = os.path.join(adaptation_dataset, folder, sub_folder, f)
+            # same crop and resize the inference path (CNN.predict) goes through
+            img = Image.fromarray(prepare_frame(load_image(image_path_in), img_rows, img_cols, crop_box,
+                                                nb_channel=nb_channel))
+            # img = img.convert('L')
+            # gray = img.convert('L')d
+            # gray.save(output_dtatset+'\\'+f,'JPEG')
+            path_without_extention = os.path.splitext(image_path_out)[0]
+            img.save(path_without_extention, 'PNG')
+            # train_set_size += 1
+    if dedup_threshold is not None:
+        with open(adaptation_dataset + '_dedup.json', 'wb') as output:
+            output.write(json.dumps(dedup_stats, sort_keys=True, indent=4, separators=(',', ': ')))
+    return dedup_stats
     # end_reshape = time.time()
     # print 'train set size: %s' % (train_set_size,)
     # print 'reshape time:   %s' % (end_reshape - start,)
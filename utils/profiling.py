@@ -0,0 +1,127 @@
+'''
+On demand cProfile of training, data set building and request handling.
+
+Profiling is switched on for everything by the REFLUX_PROFILING environment variable, read here only
+(the PROFILING django setting overrides it through set_enabled), or for a single call
+(train_model(profile=True), ?profile=1).
+Every profiled call writes profiles/<name>__<phase>__<time>.prof, readable with pstats or snakeviz.
+'''
+import os
+import re
+import pstats
+import cProfile
+import StringIO
+import threading
+from datetime import datetime
+from functools import wraps
+from contextlib import contextmanager
+
+from manage import ROOT_DIR
+
+PROFILES_DIR = os.path.join(ROOT_DIR, 'profiles')
+PROFILE_EXTENSION = '.prof'
+
+_state = {'enabled': os.environ.get('REFLUX_PROFILING', 'false').lower() in ('1', 'true', 'yes')}
+_local = threading.local()
+
+
+def set_enabled(enabled):
+    _state['enabled'] = bool(enabled)
+
+
+def is_enabled():
+    return _state['enabled']
+
+
+def _profile_file(name, phase):
+    name = re.sub(r'[^\w\-().]', '_', str(name))
+    return '%s__%s__%s%s' % (name, phase, datetime.now().strftime('%Y%m%d-%H%M%S-%f'), PROFILE_EXTENSION)
+
+
+@contextmanager
+def profile(name, phase, force=False):
+    '''
+    Profile the block when profiling is enabled (or force), the stats file is tagged with name and phase.
+    A block inside an already profiled block is part of the outer profile.
+    '''
+    if not (force or is_enabled()) or getattr(_local, 'running', False):
+        yield None
+        return
+    if not os.path.exists(PROFILES_DIR):
+        os.makedirs(PROFILES_DIR)
+    profiler = cProfile.Profile()
+    _local.running = True
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        _local.running = False
+        path = os.path.join(PROFILES_DIR, _profile_file(name, phase))
+        profiler.dump_stats(path)
+        print '\nprofile saved to %s' % (path,)
+
+
+def _requested(request):
+    value = request.GET.get('profile') or request.POST.get('profile')
+    return value is not None and value.lower() in ('1', 'true', 'yes')
+
+
+def profile_view(view_name):
+    '''
+    Profile a view when profiling is enabled or the request has profile=1
+    '''
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            with profile(view_name, 'request', force=_requested(request)):
+                return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def list_profiles(limit=50):
+    '''
+    The most recent stats files first
+    '''
+    if not os.path.exists(PROFILES_DIR):
+        return []
+    profiles = []
+    for _file in os.listdir(PROFILES_DIR):
+        if not _file.endswith(PROFILE_EXTENSION):
+            continue
+        stat = os.stat(os.path.join(PROFILES_DIR, _file))
+        parts = _file[:-len(PROFILE_EXTENSION)].split('__')
+        profiles.append({
+            'file': _file,
+            'name': parts[0],
+            'phase': parts[1] if len(parts) > 1 else '',
+            'size': stat.st_size,
+            'created': datetime.fromtimestamp(stat.st_mtime).strftime('%Y-%m-%d %H:%M:%S')
+        })
+    profiles.sort(key=lambda p: p['created'], reverse=True)
+    return profiles[:limit]
+
+
+def get_profile_path(file_name):
+    '''
+    Path of a stats file in the profiles folder, None for anything else
+    '''
+    file_name = os.path.basename(file_name)
+    path = os.path.join(PROFILES_DIR, file_name)
+    if not file_name.endswith(PROFILE_EXTENSION) or not os.path.exists(path):
+        return None
+    return path
+
+
+def sort_keys():
+    return sorted(pstats.Stats.sort_arg_dict_default.keys())
+
+
+def summary(path, sort='cumulative', limit=40):
+    if sort not in pstats.Stats.sort_arg_dict_default:
+        raise Exception('Unknown sort %s, one of: %s' % (sort, ', '.join(sort_keys())))
+    stream = StringIO.StringIO()
+    stats = pstats.Stats(path, stream=stream)
+    stats.sort_stats(sort).print_stats(limit)
+    return stream.getvalue()
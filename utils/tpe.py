@@ -0,0 +1,240 @@
+'''
+Tree-structured Parzen Estimator (TPE) sampler over the random plan space.
+
+The trials in cnn_models (their params and the avg score of every epoch) are split into the good
+GAMMA part and the rest. Every param gets a density of the good values l(x) and of the rest g(x),
+a Parzen estimator of truncated gaussians for the continuous Gabor params and smoothed counts for
+the categorical ones, and takes the candidate drawn from l(x) with the best l(x) / g(x).
+
+propose(n) gives n configurations to train at once: a proposed configuration joins the history with
+the worst score seen (constant liar) until it is observed, so the next proposals look elsewhere.
+Configurations proposed earlier and still training elsewhere (a trial queue) are added with add_pending.
+'''
+import os
+import re
+import json
+import math
+import numpy as np
+from scipy.special import erf
+
+from manage import ROOT_DIR
+
+MODELS_DIR = os.path.join(ROOT_DIR, 'cnn_models')
+N_STARTUP = 10  # trials drawn from the prior before the model based proposals
+N_CANDIDATES = 24  # candidates drawn from l(x) for every param
+GAMMA = 0.25  # share of the trials that are good
+MAX_GOOD = 25
+PRIOR_WEIGHT = 1.
+
+# the get_random_conf space, (name, 'choice', choices) or (name, 'uniform', (low, high))
+SPACE = [
+    ('split_cases', 'choice', [True, False]),
+    ('dropout', 'choice', [0.25, 0.5]),
+    ('activation_function', 'choice', ['softmax', 'sigmoid']),
+    ('img_size', 'choice', [(50, 50), (75, 75), (100, 100)]),
+    ('nb_filters', 'choice', [32, 64]),
+    ('kernel_size', 'choice', [5, 6, 7, 8, 9, 10]),
+    ('pool_size', 'choice', [2, 4, 6, 8]),
+    ('batch_size', 'choice', [32, 64, 128]),
+    ('sigma', 'uniform', (0., 3.)),
+    ('theta', 'uniform', (0., 180.)),
+    ('lambd', 'uniform', (0., 10.)),
+    ('gamma', 'uniform', (0., 1.)),
+    ('psi', 'uniform', (0., 90.)),
+]
+
+
+def _space_value(name, params):
+    '''
+    The value of a SPACE param in model params (<model>.json or CNN params), None when it is not in the space
+    '''
+    if name == 'img_size':
+        value = (params.get('img_rows'), params.get('img_cols'))
+    else:
+        value = params.get(name)
+    if isinstance(value, (list, tuple)) and name in ('kernel_size', 'pool_size'):
+        value = value[0] if len(set(value)) == 1 else None
+    if isinstance(value, basestring) and name == 'split_cases':
+        value = value.lower() != 'false'
+    for _name, kind, domain in SPACE:
+        if _name != name:
+            continue
+        if kind == 'choice':
+            return value if value in domain else None
+        try:
+            return min(max(float(value), domain[0]), domain[1])
+        except (TypeError, ValueError):
+            return None
+
+
+def trial_score(con_mat_train, con_mat_val):
+    '''
+    Best avg score of the epochs, an epoch with a zero cell in its validation confusion matrix
+    (what random_plan drops) counts as 0
+    '''
+    from core.cnn import calculate_score
+
+    scores = [0.]
+    for train, val in zip(con_mat_train, con_mat_val):
+        if 0 not in val:
+            scores.append((calculate_score(train) + calculate_score(val)) / 2)
+    return max(scores)
+
+
+def load_history(models_dir=MODELS_DIR):
+    '''
+    [(SPACE values, score)] of the trained models in models_dir
+    '''
+    from core.cnn import METRICS_LOG_EXTENSION
+
+    history = []
+    for _file in sorted(os.listdir(models_dir)):
+        if not _file.endswith('.json'):
+            continue
+        model_path = os.path.join(models_dir, _file[:-len('.json')])
+        with open(model_path + '.json', 'rb') as _input:
+            params = json.loads(_input.read())
+        con_mat_train, con_mat_val = params.get('con_mat_train', []), params.get('con_mat_val', [])
+        if os.path.exists(model_path + METRICS_LOG_EXTENSION):
+            with open(model_path + METRICS_LOG_EXTENSION, 'rb') as _input:
+                entries = [json.loads(line) for line in _input if line.strip()]
+            con_mat_train = [e['con_mat_train'] for e in entries if e.get('con_mat_val') is not None]
+            con_mat_val = [e['con_mat_val'] for e in entries if e.get('con_mat_val') is not None]
+        if not con_mat_val:
+            continue
+        history.append(({name: _space_value(name, params) for name, kind, domain in SPACE},
+                        trial_score(con_mat_train, con_mat_val)))
+    return history
+
+
+def _parzen(values, low, high):
+    '''
+    (mus, sigmas, weights) of a mixture of gaussians on values and a wide prior, the bandwidth of a
+    value is the larger gap to its neighbours
+    '''
+    width = high - low
+    mus = np.sort(np.asarray(values, dtype=np.float64))
+    if len(mus):
+        edges = np.concatenate(([low], mus, [high]))
+        sigmas = np.maximum(mus - edges[:-2], edges[2:] - mus)
+        sigmas = np.clip(sigmas, width / min(100., len(mus) + 1.), width)
+    else:
+        sigmas = np.array([])
+    mus = np.append(mus, (low + high) / 2.)
+    sigmas = np.append(sigmas, width)
+    weights = np.append(np.ones(len(mus) - 1), PRIOR_WEIGHT)
+    return mus, sigmas, weights / weights.sum()
+
+
+def _parzen_log_pdf(x, mus, sigmas, weights, low, high):
+    x = np.asarray(x, dtype=np.float64)[:, np.newaxis]
+    # every gaussian is truncated to [low, high]
+    mass = (erf((high - mus) / (sigmas * math.sqrt(2))) - erf((low - mus) / (sigmas * math.sqrt(2)))) / 2
+    pdf = np.exp(-0.5 * ((x - mus) / sigmas) ** 2) / (sigmas * math.sqrt(2 * math.pi) * np.maximum(mass, 1e-12))
+    return np.log(np.maximum((pdf * weights).sum(axis=1), 1e-300))
+
+
+def _parzen_sample(rng, mus, sigmas, weights, low, high, size):
+    components = rng.choice(len(mus), size, p=weights)
+    samples = rng.normal(mus[components], sigmas[components])
+    for _ in xrange(100):
+        outside = (samples < low) | (samples > high)
+        if not outside.any():
+            break
+        samples[outside] = rng.normal(mus[components[outside]], sigmas[components[outside]])
+    return np.clip(samples, low, high)
+
+
+def _choice_weights(values, choices):
+    counts = np.array([sum(1 for v in values if v == c) for c in choices], dtype=np.float64) + PRIOR_WEIGHT
+    return counts / counts.sum()
+
+
+class TPESampler(object):
+    def __init__(self, history=None, models_dir=MODELS_DIR, n_startup=N_STARTUP, n_candidates=N_CANDIDATES,
+                 gamma=GAMMA, seed=None, prefix='tpe', taken_names=()):
+        self.models_dir = models_dir
+        self.history = load_history(models_dir) if history is None else list(history)
+        self.pending = []  # SPACE values of the configurations that are training, they get the liar score
+        self.taken_names = set(taken_names)  # model names in use outside models_dir
+        self.n_startup = n_startup
+        self.n_candidates = n_candidates
+        self.gamma = gamma
+        self.rng = np.random.RandomState(seed)
+        self.prefix = prefix
+        self._next_index = None
+
+    def observe(self, params, score):
+        '''
+        Add a trained configuration (CNN params) with its score (trial_score)
+        '''
+        self.history.append(({name: _space_value(name, params) for name, kind, domain in SPACE}, score))
+
+    def add_pending(self, params):
+        '''
+        Add a configuration (CNN params) that was proposed and is not trained yet
+        '''
+        self.pending.append({name: _space_value(name, params) for name, kind, domain in SPACE})
+        self.taken_names.add(params['model_name'])
+
+    def _split(self, history):
+        ranked = sorted(history, key=lambda trial: -trial[1])
+        n_good = min(MAX_GOOD, max(1, int(math.ceil(self.gamma * len(ranked)))))
+        return [values for values, score in ranked[:n_good]], [values for values, score in ranked[n_good:]]
+
+    def _sample_prior(self, kind, domain):
+        if kind == 'choice':
+            return domain[self.rng.randint(len(domain))]
+        return float(self.rng.uniform(*domain))
+
+    def _propose_values(self, history):
+        if len(history) < self.n_startup:
+            return {name: self._sample_prior(kind, domain) for name, kind, domain in SPACE}
+        good, bad = self._split(history)
+        values = {}
+        for name, kind, domain in SPACE:
+            good_values = [v[name] for v in good if v.get(name) is not None]
+            bad_values = [v[name] for v in bad if v.get(name) is not None]
+            if kind == 'choice':
+                l, g = _choice_weights(good_values, domain), _choice_weights(bad_values, domain)
+                candidates = self.rng.choice(len(domain), self.n_candidates, p=l)
+                best = candidates[np.argmax(np.log(l[candidates]) - np.log(g[candidates]))]
+                values[name] = domain[best]
+            else:
+                low, high = domain
+                l, g = _parzen(good_values, low, high), _parzen(bad_values, low, high)
+                candidates = _parzen_sample(self.rng, *(l + (low, high, self.n_candidates)))
+                scores = _parzen_log_pdf(candidates, *(l + (low, high))) - \
+                    _parzen_log_pdf(candidates, *(g + (low, high)))
+                values[name] = float(candidates[np.argmax(scores)])
+        return values
+
+    def _model_name(self):
+        if self._next_index is None:
+            pattern = re.compile(r'^%s_(\d+)(\.|$)' % (re.escape(self.prefix),))
+            names = os.listdir(self.models_dir) + list(self.taken_names)
+            taken = [int(m.group(1)) for m in (pattern.match(name) for name in names) if m]
+            self._next_index = max(taken) + 1 if taken else 0
+        name = '%s_%s' % (self.prefix, self._next_index)
+        self._next_index += 1
+        return name
+
+    def to_params(self, values):
+        params = {name: values[name] for name, kind, domain in SPACE if name != 'img_size'}
+        params['img_rows'], params['img_cols'] = values['img_size']
+        params['model_name'] = self._model_name()
+        return params
+
+    def propose(self, n=1):
+        '''
+        n configurations (CNN params) to train in parallel
+        '''
+        history = list(self.history)
+        liar = min(score for values, score in history) if history else 0.
+        history += [(values, liar) for values in self.pending]
+        proposals = []
+        for _ in xrange(n):
+            values = self._propose_values(history)
+            history.append((values, liar))
+            proposals.append(self.to_params(values))
+        return proposals